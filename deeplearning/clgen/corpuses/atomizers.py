@@ -4,6 +4,7 @@ An atomizer converts a block of text into a sequence of vocbulary tokens.
 """
 import pathlib
 import pickle
+import re
 import typing
 from collections import Counter
 
@@ -11,7 +12,6 @@ import numpy as np
 from absl import flags
 
 from deeplearning.clgen import errors
-from labm8 import labdate
 
 
 FLAGS = flags.FLAGS
@@ -72,6 +72,27 @@ class AtomizerBase(object):
     """
     raise NotImplementedError("abstract class")
 
+  def AtomizeStrings(
+      self, texts: typing.Iterable[str]) -> typing.Tuple[np.array, np.array]:
+    """Atomize a batch of texts into a single array of vocabulary indices.
+
+    Args:
+      texts: An iterable of input texts.
+
+    Returns:
+      A tuple of an array of the concatenated indices of all texts, and an
+      array of len(texts) + 1 offsets into it, such that the indices of the
+      i-th text are indices[offsets[i]:offsets[i + 1]].
+
+    Raises:
+      VocabError: If any input text contains elements not in the vocabulary.
+    """
+    encoded = [self.AtomizeString(text) for text in texts]
+    offsets = np.cumsum([0] + [len(x) for x in encoded], dtype=np.int64)
+    if not encoded:
+      return np.array([], dtype=np.int32), offsets
+    return np.concatenate(encoded).astype(np.int32), offsets
+
   def TokenizeString(self, text: str) -> typing.List[str]:
     """Split the text into atoms, but do not encode to indices.
 
@@ -152,7 +173,23 @@ class AsciiCharacterAtomizer(AtomizerBase):
     Returns:
       An atomizer instance.
     """
-    counter = Counter(text)
+    return cls.FromCharacterCounts(Counter(text))
+
+  @classmethod
+  def FromCharacterCounts(
+      cls, counter: typing.Counter[str]) -> 'AsciiCharacterAtomizer':
+    """Instantiate an atomizer from the character counts of a corpus.
+
+    Counters of separate chunks of a corpus can be merged using update(). If
+    merged in the order of the chunks, the atomizer is identical to that
+    produced by FromText() on the concatenated chunks.
+
+    Args:
+      counter: A counter of characters, in the order of first appearance.
+
+    Returns:
+      An atomizer instance.
+    """
     count_pairs = sorted(counter.items(), key=lambda x: -x[1])
     atoms, _ = zip(*count_pairs)
     vocab = dict(zip(atoms, range(len(atoms))))
@@ -165,11 +202,34 @@ class GreedyAtomizer(AtomizerBase):
   def __init__(self, vocab: typing.Dict[str, int], determine_chars=False):
     self.determine_chars = determine_chars
     super(GreedyAtomizer, self).__init__(vocab)
+    self._token_regex = None
 
-    multichars = set(k for k in self.atoms if len(k) > 1)
-    first_chars = set(a[0] for a in multichars)
-    self.lookup = dict(
-        (c, [a for a in multichars if a[0] == c]) for c in first_chars)
+  @property
+  def token_regex(self) -> typing.Pattern:
+    """A compiled regular expression which matches a single token.
+
+    The multi-character atoms are arranged into a prefix trie, which is
+    expressed as nested alternations in which the longer continuations are
+    always tried first. A match is therefore the longest multi-character atom
+    at the current position, falling back to a single character. This is the
+    same greedy longest-match tokenization as scanning the candidate atoms
+    for each character, but the scan is performed by the compiled regular
+    expression engine rather than by the interpreter.
+    """
+    # Atomizers which were pickled before the regex was introduced do not have
+    # the attribute, so we cannot rely on __init__() having set it.
+    if getattr(self, '_token_regex', None) is None:
+      trie = {}
+      for atom in self.atoms:
+        if len(atom) > 1:
+          node = trie
+          for char in atom:
+            node = node.setdefault(char, {})
+          node[''] = {}
+      pattern = _TrieToRegex(trie)
+      self._token_regex = re.compile(
+          f'{pattern}|.' if pattern else '.', re.DOTALL)
+    return self._token_regex
 
   def AtomizeString(self, text: str) -> np.array:
     """Atomize a text into an array of vocabulary indices.
@@ -180,47 +240,55 @@ class GreedyAtomizer(AtomizerBase):
     Returns:
       An array of indices into vocabulary for all atoms in text.
     """
+    tokens = self.token_regex.findall(text)
 
-    def _AddToVocab(token: str) -> int:
-      """Add a token to the vocabulary and return its index."""
-      if self.determine_chars and token not in self.vocab:
-        max_index = max(self.vocab.values())
-        self.vocab[token] = max_index + 1
-      return self.vocab[token]
+    if self.determine_chars:
+      max_index = max(self.vocab.values())
+      for token in tokens:
+        if token not in self.vocab:
+          max_index += 1
+          self.vocab[token] = max_index
+      self._UpdateVocabulary()
 
-    indices = []
-    i = 0
-    j = 2
     try:
-      while i < len(text):
-        if self.lookup.get(text[i]):
-          if j <= len(text) and any(
-              x.startswith(text[i:j]) for x in self.lookup[text[i]]):
-            j += 1
-          else:
-            while j > i + 1:
-              if any(x == text[i:j] for x in self.lookup[text[i]]):
-                indices.append(self.vocab[text[i:j]])
-                i = j
-                j += 2
-                break
-              else:
-                j -= 1
-            else:
-              indices.append(_AddToVocab(text[i]))
-              i += 1
-              j += 2
-        else:
-          indices.append(_AddToVocab(text[i]))
-          i += 1
-          j += 2
+      return np.array([self.vocab[token] for token in tokens], dtype=np.int32)
     except KeyError:
       raise errors.VocabError
 
+  def AtomizeStrings(
+      self, texts: typing.Iterable[str]) -> typing.Tuple[np.array, np.array]:
+    """Atomize a batch of texts into a single array of vocabulary indices.
+
+    Args:
+      texts: An iterable of input texts.
+
+    Returns:
+      A tuple of an array of the concatenated indices of all texts, and an
+      array of len(texts) + 1 offsets into it, such that the indices of the
+      i-th text are indices[offsets[i]:offsets[i + 1]].
+
+    Raises:
+      VocabError: If any input text contains elements not in the vocabulary.
+    """
     if self.determine_chars:
-      self._UpdateVocabulary()
+      return super(GreedyAtomizer, self).AtomizeStrings(texts)
+
+    indices = []
+    offsets = [0]
+    findall = self.token_regex.findall
+    try:
+      for text in texts:
+        indices.extend(map(self.vocab.__getitem__, findall(text)))
+        offsets.append(len(indices))
+    except KeyError:
+      raise errors.VocabError
+    return np.array(indices, dtype=np.int32), np.array(offsets, dtype=np.int64)
 
-    return np.array(indices, dtype=np.int32)
+  def __getstate__(self) -> typing.Dict[str, typing.Any]:
+    # The compiled regex is cheap to rebuild, so don't bloat the pickle.
+    state = self.__dict__.copy()
+    state['_token_regex'] = None
+    return state
 
   def __repr__(self) -> str:
     return f'GreedyAtomizer[{self.vocab_size} tokens]'
@@ -243,8 +311,45 @@ class GreedyAtomizer(AtomizerBase):
     full_vocab = dict(zip(atoms, range(len(atoms))))
     c = GreedyAtomizer(full_vocab, determine_chars=True)
     # Derive the subset of the vocabulary required to encode the given text.
-    tokens = sorted(list(set(c.TokenizeString(text))))
+    return cls.FromTokens(set(c.TokenizeString(text)))
+
+  @classmethod
+  def FromTokens(cls, tokens: typing.Set[str]) -> 'GreedyAtomizer':
+    """Instantiate an atomizer from the set of tokens used by a corpus.
+
+    Token sets of separate chunks of a corpus can be merged using a union. The
+    tokens of a chunk are found using the token_regex of an atomizer with the
+    full vocabulary of multi-character atoms.
+
+    Args:
+      tokens: The set of tokens required to encode a corpus.
+
+    Returns:
+      An atomizer instance.
+    """
+    tokens = sorted(list(tokens))
     vocab_subset = dict(zip(tokens, range(len(tokens))))
-    end_time = labdate.MillisecondsTimestamp()
     # Return a new atomizer using the subset vocabulary.
     return GreedyAtomizer(vocab_subset)
+
+
+def _TrieToRegex(node: typing.Dict[str, typing.Any]) -> str:
+  """Express a prefix trie of characters as a regular expression.
+
+  Args:
+    node: A trie node, as a dictionary of character to child node. The empty
+      string key marks the end of an atom.
+
+  Returns:
+    A regular expression which matches the longest atom in the trie. If the
+    trie is empty, an empty string.
+  """
+  alternatives = [re.escape(char) + _TrieToRegex(child)
+                  for char, child in sorted(node.items()) if char]
+  if not alternatives:
+    return ''
+  elif len(alternatives) == 1 and '' not in node:
+    return alternatives[0]
+  pattern = '(?:' + '|'.join(alternatives) + ')'
+  # A greedy optional group tries the longer continuation first.
+  return pattern + '?' if '' in node else pattern
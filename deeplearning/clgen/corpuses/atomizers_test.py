@@ -3,6 +3,7 @@ import pathlib
 import sys
 import tempfile
 
+import numpy as np
 import pytest
 from absl import app
 
@@ -139,6 +140,40 @@ __kernel void A(__global float* a, __global float* b, const int c) {
   assert c.TokenizeString(test_in) == test_out
 
 
+def test_GreedyAtomizer_TokenizeString_regex_metacharacters():
+  test_vocab = {'.*': 0, '(?': 1, '.': 2, '*': 3, '(': 4, '?': 5, '\n': 6}
+  test_in = '.*(?\n.(*?'
+  test_out = ['.*', '(?', '\n', '.', '(', '*', '?']
+  c = atomizers.GreedyAtomizer(test_vocab)
+  assert c.TokenizeString(test_in) == test_out
+
+
+def test_GreedyAtomizer_AtomizeString_vocab_error():
+  c = atomizers.GreedyAtomizer({'ab': 0, 'a': 1})
+  with pytest.raises(deeplearning.clgen.errors.VocabError):
+    c.AtomizeString('abc')
+
+
+def test_GreedyAtomizer_AtomizeStrings():
+  test_vocab = {'abc': 1, 'a': 2, 'b': 3, 'ab': 4, 'c': 5, 'cab': 6, ' ': 7}
+  c = atomizers.GreedyAtomizer(test_vocab)
+  indices, offsets = c.AtomizeStrings(['abcab', '', 'cab c'])
+  assert indices.dtype == np.int32
+  assert list(indices) == [1, 4, 6, 7, 5]
+  assert list(offsets) == [0, 2, 2, 5]
+
+
+def test_GreedyAtomizer_ToFile_FromFile_equivalency():
+  test_vocab = {'abc': 1, 'a': 2, 'b': 3, 'ab': 4, 'c': 5, 'cab': 6, ' ': 7}
+  c1 = atomizers.GreedyAtomizer(test_vocab)
+  c1.AtomizeString('abc')
+  with tempfile.TemporaryDirectory() as d:
+    c1.ToFile(pathlib.Path(d) / 'atomizer.pkl')
+    c2 = atomizers.GreedyAtomizer.FromFile(pathlib.Path(d) / 'atomizer.pkl')
+  assert c1.vocab == c2.vocab
+  assert list(c1.AtomizeString('abcab c')) == list(c2.AtomizeString('abcab c'))
+
+
 def test_GreedyAtomizer_DeatomizeIndices():
   test_in = """\
 __kernel void A(__global float* a, __global float* b, const int c) {
@@ -3,11 +3,14 @@
 A training corpus is a set of one or more "contentfiles", where each contentfile
 is a file containing text to train over.
 """
+import collections
+import multiprocessing
 import os
 import pathlib
 import subprocess
 import tempfile
 import time
+import typing
 
 import checksumdir
 import humanize
@@ -28,6 +31,7 @@ from labm8 import crypto
 from labm8 import hashcache
 from labm8 import lockfile
 from labm8 import pbutil
+from labm8 import ppar
 
 
 FLAGS = flags.FLAGS
@@ -40,6 +44,19 @@ flags.DEFINE_string(
     '"/tmp/", the absolute path of the corpus will resolve to "/tmp/foo/bar". '
     'If the --clgen_local_path_prefix is a directory, the trailing slash must '
     'not be omitted.')
+flags.DEFINE_bool(
+    'clgen_incremental_preprocessing', True,
+    'If True, when pre-processing a corpus, reuse the results of a previously '
+    'pre-processed version of the same corpus (i.e. an earlier version of the '
+    'same local_directory or local_tar_archive) with the same preprocessor '
+    'pipeline. Only the content files which have been added or changed since '
+    'are pre-processed.')
+flags.DEFINE_bool(
+    'clgen_preprocessor_stage_cache', True,
+    'If True, cache the output of every individual preprocessor, keyed by its '
+    'input. Pre-processing a corpus with a pipeline which shares preprocessors '
+    'with a previous pipeline then only runs the preprocessors whose inputs '
+    'have changed. See --clgen_preprocessor_stage_cache_mb.')
 
 
 def AssertConfigIsValid(config: corpus_pb2.Corpus) -> corpus_pb2.Corpus:
@@ -165,7 +182,10 @@ class Corpus(object):
         self.preprocessed.url[len('sqlite:///'):]).parent / 'LOCK'
     with lockfile.LockFile(preprocessed_lock_path).acquire(
         replace_stale=True, block=True):
-      self.preprocessed.Create(self.config)
+      self.preprocessed.Create(
+          self.config, previous=self.GetPreviousPreprocessed(),
+          stage_cache_path=(cache.cachepath('corpus', 'preprocessor_stages.db')
+                            if FLAGS.clgen_preprocessor_stage_cache else None))
     if not self.preprocessed.size:
       raise errors.EmptyCorpusException(
           f"Pre-processed corpus contains no files: '{self.preprocessed.url}'")
@@ -181,6 +201,48 @@ class Corpus(object):
       self.encoded.Create(self.preprocessed, atomizer,
                           self.config.contentfile_separator)
 
+  def GetPreviousPreprocessed(
+      self) -> typing.Optional[preprocessed.PreprocessedContentFiles]:
+    """Find a previously pre-processed version of this corpus.
+
+    A previous version is a completed pre-processed database for the same
+    local_directory or local_tar_archive, using the same preprocessor pipeline,
+    but with different content files.
+
+    Returns:
+      The most recently modified previous version, or None if incremental
+      pre-processing is disabled or there is no previous version.
+    """
+    if not FLAGS.clgen_incremental_preprocessing:
+      return None
+    with self.preprocessed.Session() as session:
+      if self.preprocessed.IsDone(session):
+        return None
+    preprocessed_dir = pathlib.Path(
+        self.preprocessed.url[len('sqlite:///'):]).parent
+    contentfiles = preprocessed_dir / 'contentfiles'
+    if not contentfiles.is_symlink():
+      return None
+
+    candidates = []
+    for path in preprocessed_dir.parent.iterdir():
+      if (path != preprocessed_dir and
+          (path / 'preprocessed.db').is_file() and
+          (path / 'contentfiles').is_symlink() and
+          (path / 'contentfiles').resolve() == contentfiles.resolve()):
+        candidates.append(path / 'preprocessed.db')
+
+    preprocessors_id = preprocessed.GetPreprocessorsId(self.config.preprocessor)
+    for path in sorted(candidates, key=lambda p: p.stat().st_mtime,
+                       reverse=True):
+      previous = preprocessed.PreprocessedContentFiles(path)
+      with previous.Session() as session:
+        if (previous.IsDone(session) and
+            previous.GetPreprocessorsId(session) == preprocessors_id):
+          logging.info("Found previous pre-processed corpus: '%s'.", path)
+          return previous
+    return None
+
   @property
   def is_locked(self) -> bool:
     """Return whether the corpus is locked."""
@@ -213,19 +275,26 @@ class Corpus(object):
   def GetTrainingData(self, shuffle: bool) -> np.ndarray:
     """Concatenate the entire encoded corpus into an array.
 
+    The encoded corpus is read from the memory mapped token store, so no copy
+    is made unless shuffling. Shuffling permutes the order of contentfiles by
+    their offsets into the token store, copying each into a single output array.
+
     Args:
-      shuffle: If true, randomize order of ebcided contentfiles.
+      shuffle: If true, randomize order of encoded contentfiles.
 
     Returns:
       The encoded corpus.
     """
-    # TODO: Can binary numpy strings be concatenated and decoded as one?
-    with self.encoded.Session() as session:
-      query = session.query(encoded.EncodedContentFile.data)
-      if shuffle:
-        query = query.order_by(func.random())
-      return np.concatenate(
-          [np.frombuffer(x[0], dtype=np.int32) for x in query])
+    tokens, offsets = self.encoded.GetTokenStore()
+    if not shuffle:
+      return tokens
+    shuffled = np.empty(len(tokens), dtype=np.int32)
+    i = 0
+    for j in np.random.permutation(len(offsets) - 1):
+      start, end = offsets[j], offsets[j + 1]
+      shuffled[i:i + end - start] = tokens[start:end]
+      i += end - start
+    return shuffled
 
   def GetNumContentFiles(self) -> int:
     """Get the number of contentfiles which were pre-processed."""
@@ -252,17 +321,40 @@ class Corpus(object):
     return self._atomizer
 
   def _CreateAtomizer(self) -> atomizers.AtomizerBase:
-    """Creates and caches an atomizer."""
-    logging.info('Deriving atomizer from preprocessed corpus')
-    corpus_txt = self.GetTextCorpus(shuffle=False)
+    """Creates and caches an atomizer.
 
-    if self.config.HasField('ascii_character_atomizer'):
-      atomizer = atomizers.AsciiCharacterAtomizer.FromText(corpus_txt)
-    elif self.config.HasField('greedy_multichar_atomizer'):
-      atoms = set(self.config.greedy_multichar_atomizer.tokens)
-      atomizer = atomizers.GreedyAtomizer.FromText(corpus_txt, atoms)
-    else:
-      raise NotImplementedError
+    The vocabulary is derived by streaming chunks of the preprocessed corpus
+    through a process pool, and merging the partial results in order. This
+    requires a constant amount of memory, regardless of the size of the corpus.
+    """
+    logging.info('Deriving atomizer from preprocessed corpus')
+    separator = self.config.contentfile_separator
+    chunks = (
+      [text for _, text in chunk] for chunk in self.preprocessed.StreamTexts())
+
+    with multiprocessing.Pool() as pool:
+      if self.config.HasField('ascii_character_atomizer'):
+        counter = collections.Counter()
+        jobs = ((texts, separator) for texts in chunks)
+        for i, chunk_counter in enumerate(
+            ppar.BoundedMap(_CountCharactersWorker, jobs, pool)):
+          # Count the separator between chunks, so that the merged counter is
+          # identical to that of the concatenated corpus.
+          if i:
+            counter.update(separator)
+          counter.update(chunk_counter)
+        atomizer = atomizers.AsciiCharacterAtomizer.FromCharacterCounts(counter)
+      elif self.config.HasField('greedy_multichar_atomizer'):
+        atoms = set(self.config.greedy_multichar_atomizer.tokens)
+        # Contentfiles and the separator are tokenized separately, as they are
+        # when encoding. See EncodedContentFile.FromPreprocessed().
+        tokens = _GetTokensWorker(([separator], atoms))
+        jobs = ((texts, atoms) for texts in chunks)
+        for chunk_tokens in ppar.BoundedMap(_GetTokensWorker, jobs, pool):
+          tokens |= chunk_tokens
+        atomizer = atomizers.GreedyAtomizer.FromTokens(tokens)
+      else:
+        raise NotImplementedError
 
     atomizer.ToFile(self.atomizer_path)
     return atomizer
@@ -286,6 +378,25 @@ class Corpus(object):
     return not self.__eq__(rhs)
 
 
+def _CountCharactersWorker(
+    job: typing.Tuple[typing.List[str], str]) -> typing.Counter[str]:
+  """Count the characters of a chunk of texts, joined by a separator."""
+  texts, separator = job
+  return collections.Counter(separator.join(texts))
+
+
+def _GetTokensWorker(
+    job: typing.Tuple[typing.List[str], typing.Set[str]]) -> typing.Set[str]:
+  """Get the set of tokens required to encode each of a chunk of texts."""
+  texts, atoms = job
+  token_regex = atomizers.GreedyAtomizer(
+      dict(zip(atoms, range(len(atoms))))).token_regex
+  tokens = set()
+  for text in texts:
+    tokens.update(token_regex.findall(text))
+  return tokens
+
+
 def ExpandConfigPath(path: str,
                      path_prefix: str = None) -> pathlib.Path:
   """Resolve an absolute path from a config proto string field.
@@ -3,12 +3,14 @@ import os
 import pathlib
 import sys
 import tempfile
+import time
 
 import pytest
 from absl import app
 from absl import flags
 
 from deeplearning.clgen import errors
+from deeplearning.clgen.corpuses import atomizers
 from deeplearning.clgen.corpuses import corpuses
 from deeplearning.clgen.corpuses import preprocessed
 from deeplearning.clgen.proto import corpus_pb2
@@ -280,6 +282,53 @@ kernel void foo(global int* a) {
   assert c.GetNumPreprocessedFiles() == 1
 
 
+def test_Corpus_Create_incremental_preprocessing(clgen_cache_dir,
+                                                abc_corpus_config):
+  """Test that unchanged content files are not pre-processed again."""
+  del clgen_cache_dir
+  c1 = corpuses.Corpus(abc_corpus_config)
+  c1.Create()
+  # Modify the content files and remove the cached directory checksum.
+  with open(pathlib.Path(abc_corpus_config.local_directory) / 'a', 'w') as f:
+    f.write('The cat sat on the hat.')
+  with open(pathlib.Path(abc_corpus_config.local_directory) / 'd', 'w') as f:
+    f.write('A new file.')
+  pathlib.Path(abc_corpus_config.local_directory + '.sha1.txt').unlink()
+  # The hash cache uses mtimes with second granularity, so make sure that the
+  # modification is detected.
+  mtime = time.time() + 10
+  os.utime(pathlib.Path(abc_corpus_config.local_directory) / 'd',
+           (mtime, mtime))
+
+  c2 = corpuses.Corpus(abc_corpus_config)
+  assert c1.content_id != c2.content_id
+  assert c2.GetPreviousPreprocessed().url == c1.preprocessed.url
+  c2.Create()
+  assert c2.GetNumContentFiles() == 4
+  # Reused rows are copied verbatim, including the date they were added.
+  with c1.preprocessed.Session() as session:
+    dates = set(x.date_added for x in session.query(
+        preprocessed.PreprocessedContentFile))
+  with c2.preprocessed.Session() as session:
+    reused = set(x.input_relpath for x in session.query(
+        preprocessed.PreprocessedContentFile) if x.date_added in dates)
+  assert reused == {'./b', './c'}
+  assert 'The cat sat on the hat.' in c2.GetTextCorpus(shuffle=False)
+
+
+def test_Corpus_Create_incremental_preprocessing_different_preprocessors(
+    clgen_cache_dir, abc_corpus_config):
+  """Test that corpuses with different preprocessors are not reused."""
+  del clgen_cache_dir
+  corpuses.Corpus(abc_corpus_config).Create()
+  with open(pathlib.Path(abc_corpus_config.local_directory) / 'd', 'w') as f:
+    f.write('A new file.')
+  pathlib.Path(abc_corpus_config.local_directory + '.sha1.txt').unlink()
+  abc_corpus_config.preprocessor[:] = [
+    'deeplearning.clgen.preprocessors.common:StripTrailingWhitespace']
+  assert not corpuses.Corpus(abc_corpus_config).GetPreviousPreprocessed()
+
+
 def test_Corpus_GetTextCorpus_no_shuffle(clgen_cache_dir, abc_corpus_config):
   """Test the concatenation of the abc corpus."""
   del clgen_cache_dir
@@ -342,6 +391,44 @@ def test_Corpus_GetTrainingData_decode(clgen_cache_dir, abc_corpus):
              'The cat sat on the mat.\n!!\n') == len(decoded)
 
 
+def test_Corpus_GetTrainingData_shuffle(clgen_cache_dir, abc_corpus):
+  """Test that shuffled training data is a permutation of the contentfiles."""
+  del clgen_cache_dir
+  c = corpuses.Corpus(corpus_pb2.Corpus(local_directory=abc_corpus,
+                                        ascii_character_atomizer=True,
+                                        contentfile_separator='\n!!\n'))
+  c.Create()
+  decoded = c.atomizer.DeatomizeIndices(c.GetTrainingData(shuffle=True))
+  assert '\nSuch corpus.\nVery wow.\n!!\n' in decoded
+  assert 'Hello, world!\n!!\n' in decoded
+  assert 'The cat sat on the mat.\n!!\n' in decoded
+  assert len(c.GetTrainingData(shuffle=False)) == len(decoded)
+
+
+def test_Corpus_ascii_character_atomizer_vocab(clgen_cache_dir, abc_corpus):
+  """Test that the streamed vocabulary is that of the concatenated corpus."""
+  del clgen_cache_dir
+  c = corpuses.Corpus(corpus_pb2.Corpus(local_directory=abc_corpus,
+                                        ascii_character_atomizer=True,
+                                        contentfile_separator='\n!!\n'))
+  c.Create()
+  assert c.atomizer.vocab == atomizers.AsciiCharacterAtomizer.FromText(
+      c.GetTextCorpus(shuffle=False)).vocab
+
+
+def test_Corpus_greedy_multichar_atomizer_vocab(clgen_cache_dir, abc_corpus):
+  """Test that the streamed vocabulary can encode every contentfile."""
+  del clgen_cache_dir
+  c = corpuses.Corpus(corpus_pb2.Corpus(
+      local_directory=abc_corpus, contentfile_separator='\n\n',
+      greedy_multichar_atomizer=corpus_pb2.GreedyMulticharAtomizer(
+          tokens=['cat', 'Hello', '\n\n', 'mat.'])))
+  c.Create()
+  assert {'cat', 'Hello', 'mat.', '\n\n'}.issubset(set(c.atomizer.atoms))
+  assert 'sat' not in c.atomizer.atoms
+  assert c.encoded.size == 3
+
+
 def test_Corpus_preprocessed_symlink(clgen_cache_dir, abc_corpus_config):
   """Test path of symlink to pre-preprocessed files."""
   del clgen_cache_dir
@@ -2,8 +2,8 @@
 import binascii
 import datetime
 import multiprocessing
+import os
 import pathlib
-import pickle
 import time
 import typing
 
@@ -19,7 +19,7 @@ from sqlalchemy.sql import func
 from deeplearning.clgen import errors
 from deeplearning.clgen.corpuses import atomizers
 from deeplearning.clgen.corpuses import preprocessed
-from deeplearning.clgen.proto import internal_pb2
+from labm8 import ppar
 from labm8 import sqlutil
 
 
@@ -95,19 +95,53 @@ class EncodedContentFile(Base):
         date_added=datetime.datetime.utcnow())
 
 
-def EncoderWorker(
-    job: internal_pb2.EncoderWorker) -> typing.Optional[EncodedContentFile]:
-  """Encode a single content file."""
-  # TODO(cec): There is a bug in the atomizer creation logic such that the
-  # derived atomizer is not always capable of encoding the preprocessed files.
-  # Once this has been fixed, there is no need to catch the VocabError here,
-  # and EncoderWorker can always return an EncodedContentFile instance.
-  try:
-    return EncodedContentFile.FromPreprocessed(
-        preprocessed.PreprocessedContentFile(id=job.id, text=job.text),
-        pickle.loads(job.pickled_atomizer), job.contentfile_separator)
-  except errors.VocabError:
-    return None
+# The atomizer and contentfile separator of an encoder worker process. These
+# are set once per process by EncoderWorkerInit(), rather than being pickled
+# and sent with every job.
+_encoder_worker_atomizer: typing.Optional[atomizers.AtomizerBase] = None
+_encoder_worker_contentfile_separator: typing.Optional[str] = None
+
+
+def EncoderWorkerInit(atomizer: atomizers.AtomizerBase,
+                      contentfile_separator: str) -> None:
+  """Initialize an encoder worker process.
+
+  This is used as the initializer of a multiprocessing pool.
+  """
+  global _encoder_worker_atomizer
+  global _encoder_worker_contentfile_separator
+  _encoder_worker_atomizer = atomizer
+  _encoder_worker_contentfile_separator = contentfile_separator
+
+
+def EncoderWorker(chunk: typing.List[typing.Tuple[int, str]]) -> typing.List[
+  typing.Dict[str, typing.Any]]:
+  """Encode a chunk of content files.
+
+  Args:
+    chunk: A list of (id, text) tuples of preprocessed content files.
+
+  Returns:
+    A list of EncodedContentFile column values, one for every content file
+    that could be encoded.
+  """
+  rows = []
+  for id_, text in chunk:
+    # TODO(cec): There is a bug in the atomizer creation logic such that the
+    # derived atomizer is not always capable of encoding the preprocessed
+    # files. Once this has been fixed, there is no need to catch the
+    # VocabError here, and EncoderWorker can always encode every file.
+    try:
+      encoded_cf = EncodedContentFile.FromPreprocessed(
+          preprocessed.PreprocessedContentFile(id=id_, text=text),
+          _encoder_worker_atomizer, _encoder_worker_contentfile_separator)
+    except errors.VocabError:
+      continue
+    rows.append({
+      column.name: getattr(encoded_cf, column.name)
+      for column in EncodedContentFile.__table__.columns
+    })
+  return rows
 
 
 class EncodedContentFiles(sqlutil.Database):
@@ -116,6 +150,10 @@ class EncodedContentFiles(sqlutil.Database):
   def __init__(self, path: pathlib.Path):
     super(EncodedContentFiles, self).__init__(
         f'sqlite:///{path.absolute()}', Base)
+    # The flat token store, which is exported from the database once encoding
+    # is complete. See ExportTokenStore().
+    self.tokens_path = path.absolute().parent / f'{path.stem}.tokens.npy'
+    self.offsets_path = path.absolute().parent / f'{path.stem}.offsets.npy'
 
   def Create(self, p: preprocessed.PreprocessedContentFiles,
              atomizer: atomizers.AtomizerBase,
@@ -139,6 +177,8 @@ class EncodedContentFiles(sqlutil.Database):
         self.Import(session, p, atomizer, contentfile_separator)
         self.SetDone(session)
         session.commit()
+      if not self.HasTokenStore():
+        self.ExportTokenStore(session)
 
       # Logging output.
       num_files = session.query(EncodedContentFile).count()
@@ -150,7 +190,7 @@ class EncodedContentFiles(sqlutil.Database):
     logging.info('Encoded %s files in %s ms (%.2fx speedup).',
                  humanize.intcomma(num_files),
                  humanize.intcomma(total_walltime),
-                 total_time / total_walltime)
+                 (total_time or 0) / (total_walltime or 1))
     logging.info('Encoded corpus: %s tokens, %s files.',
                  humanize.intcomma(token_count), humanize.intcomma(num_files))
 
@@ -169,6 +209,72 @@ class EncodedContentFiles(sqlutil.Database):
     with self.Session() as session:
       return session.query(func.sum(EncodedContentFile.tokencount)).scalar()
 
+  def HasTokenStore(self) -> bool:
+    """Return whether the flat token store has been exported."""
+    return self.tokens_path.is_file() and self.offsets_path.is_file()
+
+  def ExportTokenStore(self, session: sqlutil.Session) -> None:
+    """Write the encoded contentfiles to a flat, memory-mappable token store.
+
+    The token store is a pair of numpy files. The first is a contiguous int32
+    array of every encoded contentfile, in order of ID. The second is an int64
+    array of num_files + 1 offsets into the first, such that the tokens of the
+    i-th contentfile are tokens[offsets[i]:offsets[i + 1]].
+
+    Args:
+      session: A database session.
+    """
+    start_time = time.time()
+    lengths = np.array([
+      x[0] // np.dtype(np.int32).itemsize for x in
+      session.query(func.length(EncodedContentFile.data)).order_by(
+          EncodedContentFile.id)
+    ], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+
+    # Write to temporary paths and rename so that a partially written token
+    # store is never read.
+    tokens_tmp_path = self.tokens_path.with_suffix('.tmp')
+    offsets_tmp_path = self.offsets_path.with_suffix('.tmp')
+    if offsets[-1]:
+      tokens = np.lib.format.open_memmap(
+          str(tokens_tmp_path), mode='w+', dtype=np.int32,
+          shape=(int(offsets[-1]),))
+      query = session.query(EncodedContentFile.data).order_by(
+          EncodedContentFile.id).yield_per(1000)
+      for i, (data,) in enumerate(query):
+        tokens[offsets[i]:offsets[i + 1]] = np.frombuffer(data, dtype=np.int32)
+      tokens.flush()
+      del tokens
+    else:
+      with open(tokens_tmp_path, 'wb') as f:
+        np.save(f, np.array([], dtype=np.int32))
+    with open(offsets_tmp_path, 'wb') as f:
+      np.save(f, offsets)
+    os.rename(tokens_tmp_path, self.tokens_path)
+    os.rename(offsets_tmp_path, self.offsets_path)
+    logging.info('Exported token store of %s tokens in %s ms.',
+                 humanize.intcomma(int(offsets[-1])),
+                 humanize.intcomma(int((time.time() - start_time) * 1000)))
+
+  def GetTokenStore(self) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Return the flat token store, exporting it if required.
+
+    Returns:
+      A tuple of a read-only memory mapped int32 array of the concatenated
+      encoded contentfiles, and an int64 array of contentfile offsets into it.
+    """
+    if not self.HasTokenStore():
+      with self.Session() as session:
+        self.ExportTokenStore(session)
+    offsets = np.load(str(self.offsets_path))
+    if offsets[-1]:
+      tokens = np.load(str(self.tokens_path), mmap_mode='r')
+    else:
+      # An empty file cannot be memory mapped.
+      tokens = np.load(str(self.tokens_path))
+    return tokens, offsets
+
   def IsDone(self, session: sqlutil.Session):
     if session.query(Meta).filter(Meta.key == 'done').first():
       return True
@@ -181,41 +287,71 @@ class EncodedContentFiles(sqlutil.Database):
   def Import(self, session: sqlutil.Session,
              preprocessed_db: preprocessed.PreprocessedContentFiles,
              atomizer: atomizers.AtomizerBase,
-             contentfile_separator: str) -> None:
+             contentfile_separator: str, chunk_size: int = 1000) -> None:
+    """Encode the preprocessed content files which are not yet encoded.
+
+    Content files are streamed from the preprocessed database in chunks,
+    encoded by a pool of workers, and written back using bulk inserts.
+
+    Args:
+      session: A database session.
+      preprocessed_db: A PreprocessedContentFiles database.
+      atomizer: The atomizer to encode using.
+      contentfile_separator: The contentfile separator.
+      chunk_size: The number of content files in each job.
+
+    Raises:
+      EmptyCorpusException: If there are no content files to encode.
+    """
+    num_encoded = session.query(EncodedContentFile).count()
     with preprocessed_db.Session() as p_session:
-      query = p_session.query(preprocessed.PreprocessedContentFile).filter(
-          preprocessed.PreprocessedContentFile.preprocessing_succeeded == True,
-          ~preprocessed.PreprocessedContentFile.id.in_(
-              session.query(EncodedContentFile.id).all()))
-      jobs = [
-        internal_pb2.EncoderWorker(
-            id=x.id, text=x.text, contentfile_separator=contentfile_separator,
-            pickled_atomizer=pickle.dumps(atomizer))
-        for x in query
-      ]
-      if not jobs:
-        raise errors.EmptyCorpusException(
-            "Pre-processed corpus contains no files: "
-            f"'{preprocessed_db.url}'")
-
-      logging.info('Encoding %s of %s preprocessed files',
-                   humanize.intcomma(query.count()),
-                   humanize.intcomma(p_session.query(
-                       preprocessed.PreprocessedContentFile).filter(
-                       preprocessed.PreprocessedContentFile.preprocessing_succeeded == True).count()))
-      pool = multiprocessing.Pool()
-      bar = progressbar.ProgressBar(max_value=len(jobs))
-      last_commit = time.time()
-      wall_time_start = time.time()
-      for encoded_cf in bar(pool.imap_unordered(EncoderWorker, jobs)):
+      num_preprocessed = p_session.query(
+          preprocessed.PreprocessedContentFile).filter(
+          preprocessed.PreprocessedContentFile.preprocessing_succeeded == True
+      ).count()
+    num_todo = num_preprocessed - num_encoded
+    if num_todo <= 0:
+      raise errors.EmptyCorpusException(
+          "Pre-processed corpus contains no files: "
+          f"'{preprocessed_db.url}'")
+
+    logging.info('Encoding %s of %s preprocessed files',
+                 humanize.intcomma(num_todo),
+                 humanize.intcomma(num_preprocessed))
+
+    def UnencodedChunks():
+      """Filter the files which are already encoded from each chunk.
+
+      The encoded and preprocessed files are in separate databases, so they
+      cannot be joined. Instead, only the encoded IDs in the range of each
+      chunk are looked up, so memory is bounded by the chunk size.
+      """
+      for chunk in preprocessed_db.StreamTexts(chunk_size=chunk_size):
+        done = set(x[0] for x in session.query(EncodedContentFile.id).filter(
+            EncodedContentFile.id.between(chunk[0][0], chunk[-1][0])))
+        yield [(id_, text) for id_, text in chunk if id_ not in done]
+
+    chunks = UnencodedChunks()
+    bar = progressbar.ProgressBar(max_value=num_todo)
+    num_done = 0
+    last_commit = time.time()
+    wall_time_start = time.time()
+    with multiprocessing.Pool(
+        initializer=EncoderWorkerInit,
+        initargs=(atomizer, contentfile_separator)) as pool:
+      for rows in ppar.BoundedMap(EncoderWorker, chunks, pool):
         wall_time_end = time.time()
-        # TODO(cec): Remove the if check once EncoderWorker no longer returns
-        # None on atomizer encode error.
-        if encoded_cf:
-          encoded_cf.wall_time_ms = int(
-              (wall_time_end - wall_time_start) * 1000)
-          session.add(encoded_cf)
+        num_done += len(rows)
+        bar.update(min(num_done, num_todo))
+        if rows:
+          # Divide the wall time of this chunk evenly between its files.
+          wall_time_ms = int((wall_time_end - wall_time_start) * 1000)
+          for row in rows:
+            row['wall_time_ms'] = wall_time_ms // len(rows)
+          rows[0]['wall_time_ms'] += wall_time_ms % len(rows)
+          session.execute(EncodedContentFile.__table__.insert(), rows)
         wall_time_start = wall_time_end
         if wall_time_end - last_commit > 10:
           session.commit()
           last_commit = wall_time_end
+    bar.finish()
@@ -122,6 +122,102 @@ def test_EncodedContentFiles_token_count(
   assert 20 == temp_db.token_count
 
 
+def test_EncodedContentFiles_GetTokenStore_tokens(
+    temp_db: encoded.EncodedContentFiles,
+    abc_preprocessed: preprocessed.PreprocessedContentFile,
+    abc_atomizer: atomizers.AsciiCharacterAtomizer):
+  """Test that token store is the concatenation of encoded files by ID."""
+  enc1 = encoded.EncodedContentFile.FromPreprocessed(
+      abc_preprocessed, abc_atomizer, 'a')
+  enc2 = encoded.EncodedContentFile.FromPreprocessed(
+      preprocessed.PreprocessedContentFile(id=1, text='edcba'), abc_atomizer,
+      'b')
+  with temp_db.Session(commit=True) as session:
+    session.add(enc1)
+    session.add(enc2)
+  assert not temp_db.HasTokenStore()
+  tokens, offsets = temp_db.GetTokenStore()
+  assert temp_db.HasTokenStore()
+  np.testing.assert_array_equal(
+      np.array([4, 3, 2, 1, 0, 1, 0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 0],
+               dtype=np.int32), tokens)
+  np.testing.assert_array_equal(np.array([0, 6, 17]), offsets)
+
+
+def test_EncodedContentFiles_GetTokenStore_empty(
+    temp_db: encoded.EncodedContentFiles):
+  """Test that token store of an empty database is empty."""
+  tokens, offsets = temp_db.GetTokenStore()
+  assert not len(tokens)
+  np.testing.assert_array_equal(np.array([0]), offsets)
+
+
+# EncoderWorker() tests.
+
+def test_EncoderWorker_rows(abc_atomizer: atomizers.AsciiCharacterAtomizer):
+  """Test that worker returns a row of column values for each file."""
+  encoded.EncoderWorkerInit(abc_atomizer, 'a')
+  rows = encoded.EncoderWorker([(1, 'abc'), (2, 'xyz'), (3, 'e')])
+  # The second file cannot be encoded with the atomizer's vocabulary.
+  assert [row['id'] for row in rows] == [1, 3]
+  assert rows[0]['tokencount'] == 3
+  np.testing.assert_array_equal(
+      np.array([0, 1, 2, 0], dtype=np.int32),
+      np.frombuffer(rows[0]['data'], dtype=np.int32))
+
+
+def test_EncodedContentFiles_Create(
+    temp_db: encoded.EncodedContentFiles,
+    abc_atomizer: atomizers.AsciiCharacterAtomizer):
+  """Test that Create() encodes every pre-processed file."""
+  with tempfile.TemporaryDirectory() as d:
+    p = preprocessed.PreprocessedContentFiles(
+        pathlib.Path(d) / 'preprocessed.db')
+    with p.Session(commit=True) as session:
+      for i, text in enumerate(['abc', 'xyz', 'ed', 'Unicode error']):
+        session.add(preprocessed.PreprocessedContentFile(
+            id=i, input_relpath=str(i), input_sha256=b'', input_charcount=0,
+            input_linecount=0, sha256=b'', charcount=0, linecount=0,
+            text=text, preprocessing_succeeded=(i != 3), preprocess_time_ms=0,
+            wall_time_ms=0))
+    temp_db.Create(p, abc_atomizer, 'a')
+  with temp_db.Session() as session:
+    assert [x.id for x in session.query(encoded.EncodedContentFile).order_by(
+        encoded.EncodedContentFile.id)] == [0, 2]
+  np.testing.assert_array_equal(
+      np.array([0, 1, 2, 0, 4, 3, 0], dtype=np.int32),
+      temp_db.GetTokenStore()[0])
+
+
+def test_EncodedContentFiles_Import_skips_encoded_files(
+    temp_db: encoded.EncodedContentFiles,
+    abc_atomizer: atomizers.AsciiCharacterAtomizer):
+  """Test that Import() encodes only the files which are not yet encoded."""
+  with tempfile.TemporaryDirectory() as d:
+    p = preprocessed.PreprocessedContentFiles(
+        pathlib.Path(d) / 'preprocessed.db')
+    with p.Session(commit=True) as session:
+      for i, text in enumerate(['abc', 'bcd', 'cde', 'ed', 'e']):
+        session.add(preprocessed.PreprocessedContentFile(
+            id=i, input_relpath=str(i), input_sha256=b'', input_charcount=0,
+            input_linecount=0, sha256=b'', charcount=0, linecount=0,
+            text=text, preprocessing_succeeded=True, preprocess_time_ms=0,
+            wall_time_ms=0))
+    with temp_db.Session(commit=True) as session:
+      for i in [1, 2]:
+        session.add(encoded.EncodedContentFile.FromPreprocessed(
+            preprocessed.PreprocessedContentFile(id=i, text='a'),
+            abc_atomizer, 'a'))
+    with temp_db.Session(commit=True) as session:
+      temp_db.Import(session, p, abc_atomizer, 'a', chunk_size=2)
+  with temp_db.Session() as session:
+    files = session.query(encoded.EncodedContentFile).order_by(
+        encoded.EncodedContentFile.id).all()
+    assert [x.id for x in files] == [0, 1, 2, 3, 4]
+    # The files which were already encoded are not re-encoded.
+    assert [x.tokencount for x in files] == [3, 1, 1, 2, 1]
+
+
 def test_EncodedContentFiles_empty_preprocessed_db(
     temp_db: encoded.EncodedContentFiles,
     abc_atomizer: atomizers.AsciiCharacterAtomizer):
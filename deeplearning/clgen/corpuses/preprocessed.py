@@ -1,5 +1,6 @@
 """This file defines a database for pre-preprocessed content files."""
 import binascii
+import collections
 import contextlib
 import datetime
 import hashlib
@@ -21,9 +22,10 @@ from sqlalchemy.sql import func
 
 from deeplearning.clgen import errors
 from deeplearning.clgen.preprocessors import preprocessors
+from deeplearning.clgen.preprocessors import stage_cache
 from deeplearning.clgen.proto import corpus_pb2
 from deeplearning.clgen.proto import internal_pb2
-from labm8 import fs
+from labm8 import crypto
 from labm8 import sqlutil
 
 
@@ -81,14 +83,16 @@ class PreprocessedContentFile(Base):
   @classmethod
   def FromContentFile(
       cls, contentfile_root: pathlib.Path, relpath: pathlib.Path,
-      preprocessors_: typing.List[str]) -> 'PreprocessedContentFile':
+      preprocessors_: typing.List[str],
+      cache: typing.Optional[stage_cache.StageCache] = None
+  ) -> 'PreprocessedContentFile':
     """Instantiate a PreprocessedContentFile."""
     start_time = time.time()
     preprocessing_succeeded = False
     try:
       with open(contentfile_root / relpath) as f:
         input_text = f.read()
-      text = preprocessors.Preprocess(input_text, preprocessors_)
+      text = preprocessors.Preprocess(input_text, preprocessors_, cache)
       preprocessing_succeeded = True
     except UnicodeDecodeError as e:
       text = 'Unicode error'
@@ -116,8 +120,11 @@ class PreprocessedContentFile(Base):
 def PreprocessorWorker(
     job: internal_pb2.PreprocessorWorker) -> PreprocessedContentFile:
   """The inner loop of a parallelizable pre-processing job."""
+  cache = (stage_cache.GetStageCache(pathlib.Path(job.stage_cache_path))
+           if job.stage_cache_path else None)
   return PreprocessedContentFile.FromContentFile(
-      pathlib.Path(job.contentfile_root), job.relpath, job.preprocessors)
+      pathlib.Path(job.contentfile_root), job.relpath, job.preprocessors,
+      cache)
 
 
 class PreprocessedContentFiles(sqlutil.Database):
@@ -127,10 +134,25 @@ class PreprocessedContentFiles(sqlutil.Database):
     super(PreprocessedContentFiles, self).__init__(
         f'sqlite:///{path.absolute()}', Base)
 
-  def Create(self, config: corpus_pb2.Corpus):
+  def Create(self, config: corpus_pb2.Corpus,
+             previous: typing.Optional['PreprocessedContentFiles'] = None,
+             stage_cache_path: typing.Optional[pathlib.Path] = None):
+    """Populate the pre-processed contentfiles database.
+
+    Args:
+      config: The corpus config proto.
+      previous: An optional database of content files which were pre-processed
+        using the same pipeline. Rows of this database whose input checksums
+        match an input content file are reused rather than pre-processed again.
+      stage_cache_path: An optional path to a StageCache database, used to
+        memoize the individual preprocessors of the pipeline.
+    """
     with self.Session() as session:
       if not self.IsDone(session):
-        self.Import(session, config)
+        session.merge(Meta(key='preprocessors',
+                           value=GetPreprocessorsId(config.preprocessor)))
+        self.Import(session, config, previous=previous,
+                    stage_cache_path=stage_cache_path)
         self.SetDone(session)
         session.commit()
 
@@ -171,20 +193,36 @@ class PreprocessedContentFiles(sqlutil.Database):
   def SetDone(self, session: sqlutil.Session):
     session.add(Meta(key='done', value='yes'))
 
+  def GetPreprocessorsId(self, session: sqlutil.Session) -> typing.Optional[
+    str]:
+    """Return the ID of the pipeline used to pre-process the content files.
+
+    Databases created before the ID was recorded return None.
+    """
+    meta = session.query(Meta).filter(Meta.key == 'preprocessors').first()
+    return meta.value if meta else None
+
   def Import(self, session: sqlutil.Session,
-             config: corpus_pb2.Corpus) -> None:
+             config: corpus_pb2.Corpus,
+             previous: typing.Optional['PreprocessedContentFiles'] = None,
+             stage_cache_path: typing.Optional[pathlib.Path] = None) -> None:
     with self.GetContentFileRoot(config) as contentfile_root:
       relpaths = set(self.GetImportRelpaths(contentfile_root))
       done = set(
           [x[0] for x in session.query(PreprocessedContentFile.input_relpath)])
       todo = relpaths - done
+      if previous and todo:
+        todo -= self.ImportFromPrevious(
+            session, contentfile_root, todo, previous)
+        session.commit()
       logging.info('Preprocessing %s of %s content files',
                    humanize.intcomma(len(todo)),
                    humanize.intcomma(len(relpaths)))
       jobs = [
         internal_pb2.PreprocessorWorker(
             contentfile_root=str(contentfile_root),
-            relpath=t, preprocessors=config.preprocessor)
+            relpath=t, preprocessors=config.preprocessor,
+            stage_cache_path=str(stage_cache_path or ''))
         for t in todo]
       pool = multiprocessing.Pool()
       bar = progressbar.ProgressBar(max_value=len(jobs))
@@ -200,6 +238,62 @@ class PreprocessedContentFiles(sqlutil.Database):
           session.commit()
           last_commit = wall_time_end
 
+  def ImportFromPrevious(
+      self, session: sqlutil.Session, contentfile_root: pathlib.Path,
+      relpaths: typing.Set[str],
+      previous: 'PreprocessedContentFiles') -> typing.Set[str]:
+    """Copy the rows of a previous database which match input content files.
+
+    A row is reused if its input_sha256 is equal to the checksum of a content
+    file. This assumes that the previous database was pre-processed using the
+    same pipeline.
+
+    Args:
+      session: A database session.
+      contentfile_root: The root of the content files directory.
+      relpaths: The relative paths of the content files to import.
+      previous: The previous database.
+
+    Returns:
+      The set of relative paths which were imported.
+    """
+    start_time = time.time()
+    relpaths = sorted(relpaths)
+    with multiprocessing.Pool() as pool:
+      checksums = pool.map(
+          GetFileSha256, [contentfile_root / relpath for relpath in relpaths],
+          chunksize=256)
+    relpaths_by_checksum = collections.defaultdict(list)
+    for relpath, checksum in zip(relpaths, checksums):
+      relpaths_by_checksum[checksum].append(relpath)
+
+    imported = set()
+    columns = [c for c in PreprocessedContentFile.__table__.columns
+               if c.name not in {'id', 'input_relpath'}]
+    unique_checksums = list(relpaths_by_checksum.keys())
+    with previous.Session() as previous_session:
+      # Batch the lookups so as not to exceed the maximum number of SQLite host
+      # parameters in a single query.
+      for i in range(0, len(unique_checksums), 500):
+        query = previous_session.query(*columns).filter(
+            PreprocessedContentFile.input_sha256.in_(
+                unique_checksums[i:i + 500]))
+        rows = []
+        for row in query:
+          values = dict(zip([c.name for c in columns], row))
+          # No time was spent pre-processing a reused row.
+          values['wall_time_ms'] = 0
+          for relpath in relpaths_by_checksum.pop(values['input_sha256'], []):
+            rows.append(dict(values, input_relpath=relpath))
+            imported.add(relpath)
+        if rows:
+          session.execute(PreprocessedContentFile.__table__.insert(), rows)
+    logging.info('Reused %s of %s pre-processed content files from %s in %s '
+                 'ms', humanize.intcomma(len(imported)),
+                 humanize.intcomma(len(relpaths)), previous.url,
+                 humanize.intcomma(int((time.time() - start_time) * 1000)))
+    return imported
+
   @contextlib.contextmanager
   def GetContentFileRoot(self, config: corpus_pb2.Corpus) -> pathlib.Path:
     """Get the path of the directory containing content files.
@@ -285,6 +379,33 @@ class PreprocessedContentFiles(sqlutil.Database):
       return session.query(
           func.sum(PreprocessedContentFile.input_linecount)).scalar()
 
+  def StreamTexts(
+      self, chunk_size: int = 1000) -> typing.Iterator[
+    typing.List[typing.Tuple[int, str]]]:
+    """Stream the successfully pre-processed texts in chunks.
+
+    Rows are read in order of ID, one chunk per query, so the memory required
+    is bounded by the chunk size rather than the size of the corpus.
+
+    Args:
+      chunk_size: The maximum number of texts in each chunk.
+
+    Returns:
+      A generator of lists of (id, text) tuples.
+    """
+    last_id = -1
+    while True:
+      with self.Session() as session:
+        chunk = session.query(
+            PreprocessedContentFile.id, PreprocessedContentFile.text).filter(
+            PreprocessedContentFile.preprocessing_succeeded == True,
+            PreprocessedContentFile.id > last_id).order_by(
+            PreprocessedContentFile.id).limit(chunk_size).all()
+      if not chunk:
+        return
+      last_id = chunk[-1][0]
+      yield [(id_, text) for id_, text in chunk]
+
   def GetImportRelpaths(
       self, contentfile_root: pathlib.Path) -> typing.List[str]:
     """Get relative paths to all files in the content files directory.
@@ -298,19 +419,29 @@ class PreprocessedContentFiles(sqlutil.Database):
     Raises:
       EmptyCorpusException: If the content files directory is empty.
     """
-    with fs.chdir(contentfile_root):
-      find_output = subprocess.check_output(['find', '.', '-type', 'f']).decode(
-          'utf-8').strip()
-      if not find_output:
-        raise errors.EmptyCorpusException(
-            f"Empty content files directory: '{contentfile_root}'")
-      return find_output.split('\n')
+    # Relative paths are of the form './foo/bar', as produced by find(1).
+    relpaths = []
+    for root, _, files in os.walk(contentfile_root):
+      relroot = os.path.relpath(root, contentfile_root)
+      relroot = '.' if relroot == '.' else os.path.join('.', relroot)
+      relpaths += [
+        os.path.join(relroot, f) for f in files
+        if not os.path.islink(os.path.join(root, f))]
+    if not relpaths:
+      raise errors.EmptyCorpusException(
+          f"Empty content files directory: '{contentfile_root}'")
+    return relpaths
 
 
 def ExpandConfigPath(path: str) -> pathlib.Path:
   return pathlib.Path(os.path.expandvars(path)).expanduser().absolute()
 
 
+def GetPreprocessorsId(preprocessors_: typing.Iterable[str]) -> str:
+  """Return a checksum which identifies an ordered preprocessor pipeline."""
+  return crypto.sha1_str('\n'.join(preprocessors_))
+
+
 def GetFileSha256(path: pathlib.Path):
   with open(path, 'rb') as f:
     return hashlib.sha256(f.read()).digest()
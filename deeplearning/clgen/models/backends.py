@@ -8,6 +8,7 @@ from deeplearning.clgen import samplers
 from deeplearning.clgen.corpuses import atomizers
 from deeplearning.clgen.proto import model_pb2
 from labm8 import cache
+from labm8 import labdate
 
 
 FLAGS = flags.FLAGS
@@ -46,3 +47,116 @@ class BackendBase(object):
       A numpy array of int32 values with shape (batch_size,).
     """
     raise NotImplementedError
+
+  def ResetSampleBatchRows(self, sampler: samplers.Sampler,
+                           rows: np.ndarray) -> None:
+    """Restart samples of the current sample batch from the start text.
+
+    The other samples of the batch are unaffected. Only called after
+    InitSampleBatch().
+
+    Args:
+      sampler: The sampler.
+      rows: The row numbers of the samples to restart.
+    """
+    raise NotImplementedError
+
+
+def WeightedPickBatch(predictions: np.ndarray, temperature: float,
+                      rng: np.random.RandomState = np.random) -> np.ndarray:
+  """Make a weighted choice from every row of a predictions matrix.
+
+  This uses the Gumbel-max trick: adding Gumbel noise to the temperature-scaled
+  log probabilities and taking the argmax of each row is equivalent to drawing
+  from the temperature-scaled distribution, but requires no per-row
+  normalization or Python loop.
+
+  Args:
+    predictions: A matrix of probabilities with shape (batch_size, vocab_size).
+    temperature: The sampling temperature.
+    rng: The random number generator to draw from.
+
+  Returns:
+    A numpy array of int32 values with shape (batch_size,).
+  """
+  predictions = np.asarray(predictions, dtype=np.float64)
+  # Zero probabilities become -inf, and so are never picked.
+  with np.errstate(divide='ignore'):
+    logits = np.log(predictions) / temperature
+  noise = rng.gumbel(size=logits.shape)
+  return np.argmax(logits + noise, axis=1).astype(np.int32)
+
+
+def SampleBatch(backend: BackendBase, sampler: samplers.Sampler,
+                atomizer: atomizers.AtomizerBase,
+                batch_size: int) -> typing.Iterator[model_pb2.Sample]:
+  """Sample a batch of samples.
+
+  Args:
+    backend: A backend which has been initialized for sampling.
+    sampler: The specialized sampler to sample using.
+    atomizer: The atomizer that the sampler is specialized to.
+    batch_size: The number of samples in the batch.
+
+  Returns:
+    An iterator over samples, in the order that they are completed.
+  """
+  batch = samplers.SampleBatch(sampler, batch_size)
+  start_time = labdate.MillisecondsTimestamp()
+  wall_time_start = start_time
+
+  backend.InitSampleBatch(sampler, batch_size)
+
+  # Sampling loop. Continues until all samples in the batch are done.
+  while not batch.done.all():
+    indices = backend.SampleNextIndices(sampler, batch_size)
+    for i in batch.Append(indices):
+      end_time = labdate.MillisecondsTimestamp()
+      yield model_pb2.Sample(
+          text=batch.GetText(i, atomizer),
+          sample_start_epoch_ms_utc=start_time,
+          sample_time_ms=end_time - start_time,
+          wall_time_ms=end_time - wall_time_start,
+          num_tokens=batch.GetNumTokens(i))
+      wall_time_start = labdate.MillisecondsTimestamp()
+
+
+def SampleStream(backend: BackendBase, sampler: samplers.Sampler,
+                 atomizer: atomizers.AtomizerBase,
+                 batch_size: int) -> typing.Iterator[model_pb2.Sample]:
+  """Produce an endless stream of samples using continuous batching.
+
+  Rather than waiting for every sample in a batch to complete before starting
+  a new batch, each sample is restarted as soon as it completes, so that every
+  row of the batch is always in use.
+
+  Args:
+    backend: A backend which has been initialized for sampling.
+    sampler: The specialized sampler to sample using.
+    atomizer: The atomizer that the sampler is specialized to.
+    batch_size: The number of samples in the batch.
+
+  Returns:
+    An iterator over samples, in the order that they are completed.
+  """
+  batch = samplers.SampleBatch(sampler, batch_size)
+  backend.InitSampleBatch(sampler, batch_size)
+  start_times = np.full(batch_size, labdate.MillisecondsTimestamp())
+  wall_time_start = labdate.MillisecondsTimestamp()
+
+  while True:
+    indices = backend.SampleNextIndices(sampler, batch_size)
+    complete = batch.Append(indices)
+    for i in complete:
+      end_time = labdate.MillisecondsTimestamp()
+      yield model_pb2.Sample(
+          text=batch.GetText(i, atomizer),
+          sample_start_epoch_ms_utc=int(start_times[i]),
+          sample_time_ms=end_time - int(start_times[i]),
+          wall_time_ms=end_time - wall_time_start,
+          num_tokens=batch.GetNumTokens(i))
+      wall_time_start = labdate.MillisecondsTimestamp()
+    if len(complete):
+      batch.Reset(complete)
+      backend.ResetSampleBatchRows(sampler, complete)
+      start_times[complete] = labdate.MillisecondsTimestamp()
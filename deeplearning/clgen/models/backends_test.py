@@ -0,0 +1,154 @@
+"""Unit tests for //deeplearning/clgen/models/backends.py."""
+import itertools
+import sys
+import typing
+
+import numpy as np
+import pytest
+from absl import app
+from absl import flags
+
+from deeplearning.clgen import samplers
+from deeplearning.clgen.corpuses import atomizers
+from deeplearning.clgen.models import backends
+from deeplearning.clgen.proto import sampler_pb2
+
+
+FLAGS = flags.FLAGS
+
+
+# WeightedPickBatch() tests.
+
+def test_WeightedPickBatch_output_shape():
+  """Test that an index is returned for every row of predictions."""
+  predictions = np.full((8, 4), .25)
+  indices = backends.WeightedPickBatch(predictions, 1.0)
+  assert indices.shape == (8,)
+  assert indices.dtype == np.int32
+  assert ((0 <= indices) & (indices < 4)).all()
+
+
+def test_WeightedPickBatch_zero_probability():
+  """Test that indices with zero probability are never picked."""
+  predictions = np.array([[0, 1, 0], [.5, 0, .5]] * 500)
+  indices = backends.WeightedPickBatch(predictions, 1.0)
+  assert (indices[::2] == 1).all()
+  assert (indices[1::2] != 1).all()
+
+
+def test_WeightedPickBatch_seeded_rng():
+  """Test that a seeded RNG produces a reproducible stream of indices."""
+  predictions = np.random.dirichlet(np.ones(10), size=16)
+  rng1, rng2 = np.random.RandomState(204), np.random.RandomState(204)
+  for _ in range(10):
+    np.testing.assert_array_equal(
+        backends.WeightedPickBatch(predictions, .5, rng1),
+        backends.WeightedPickBatch(predictions, .5, rng2))
+
+
+def test_WeightedPickBatch_distribution():
+  """Test that indices are drawn from the temperature-scaled distribution."""
+  probabilities = np.array([.1, .2, .3, .4])
+  rng = np.random.RandomState(0)
+  for temperature in [.5, 1.0, 2.0]:
+    indices = backends.WeightedPickBatch(
+        np.tile(probabilities, (100000, 1)), temperature, rng)
+    expected = probabilities ** (1 / temperature)
+    expected /= expected.sum()
+    actual = np.bincount(indices, minlength=4) / len(indices)
+    np.testing.assert_allclose(actual, expected, atol=.01)
+
+
+# SampleBatch() and SampleStream() tests.
+
+class MockBackend(backends.BackendBase):
+  """A backend which replays a fixed sequence of tokens for every row.
+
+  Row i of the batch produces the tokens of sequences[i], and restarts from
+  the beginning of the sequence when reset.
+  """
+
+  def __init__(self, atomizer: atomizers.AtomizerBase,
+               sequences: typing.List[str]):
+    self.sequences = [atomizer.AtomizeString(s) for s in sequences]
+    self.positions = np.zeros(len(sequences), dtype=np.int64)
+    self.num_resets = 0
+
+  def InitSampleBatch(self, sampler, batch_size):
+    self.positions[:] = 0
+
+  def SampleNextIndices(self, sampler, batch_size):
+    indices = np.array([seq[pos % len(seq)] for seq, pos in
+                        zip(self.sequences, self.positions)])
+    self.positions += 1
+    return indices
+
+  def ResetSampleBatchRows(self, sampler, rows):
+    self.positions[rows] = 0
+    self.num_resets += len(rows)
+
+
+def test_SampleBatch_completion_order():
+  """Test that a batch ends once every sample in it is complete."""
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText('ab{}')
+  config = sampler_pb2.Sampler(start_text='a', batch_size=2,
+                               temperature_micros=1000000)
+  config.termination_criteria.add().symtok.CopyFrom(
+      sampler_pb2.SymmetricalTokenDepth(depth_increase_token='{',
+                                        depth_decrease_token='}'))
+  sampler = samplers.Sampler(config)
+  sampler.Specialize(atomizer)
+  backend = MockBackend(atomizer, ['{bbbb}', '{}'])
+  samples = list(backends.SampleBatch(backend, sampler, atomizer, 2))
+  assert [s.text for s in samples] == ['a{}', 'a{bbbb}']
+  assert [s.num_tokens for s in samples] == [3, 7]
+  assert backend.num_resets == 0
+
+
+def test_SampleStream_continuous_batching():
+  """Test that completed rows are restarted while other rows continue."""
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText('ab{}')
+  config = sampler_pb2.Sampler(start_text='a', batch_size=2,
+                               temperature_micros=1000000)
+  config.termination_criteria.add().symtok.CopyFrom(
+      sampler_pb2.SymmetricalTokenDepth(depth_increase_token='{',
+                                        depth_decrease_token='}'))
+  sampler = samplers.Sampler(config)
+  sampler.Specialize(atomizer)
+  # Row 0 completes a sample every two tokens, row 1 every six tokens.
+  backend = MockBackend(atomizer, ['{}', '{bbbb}'])
+  samples = list(itertools.islice(
+      backends.SampleStream(backend, sampler, atomizer, 2), 7))
+  assert [s.text for s in samples] == [
+    'a{}', 'a{}', 'a{}', 'a{bbbb}', 'a{}', 'a{}', 'a{}']
+  assert [s.num_tokens for s in samples] == [3, 3, 3, 7, 3, 3, 3]
+  assert backend.num_resets == 6
+
+
+def test_SampleStream_long_samples():
+  """Test that samples longer than the initial buffer are decoded."""
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText('ab{}')
+  config = sampler_pb2.Sampler(start_text='a', batch_size=3,
+                               temperature_micros=1000000)
+  config.termination_criteria.add().symtok.CopyFrom(
+      sampler_pb2.SymmetricalTokenDepth(depth_increase_token='{',
+                                        depth_decrease_token='}'))
+  sampler = samplers.Sampler(config)
+  sampler.Specialize(atomizer)
+  long_sample = '{' + 'b' * 1000 + '}'
+  backend = MockBackend(atomizer, [long_sample, '{b}', '{bb}'])
+  samples = list(itertools.islice(
+      backends.SampleStream(backend, sampler, atomizer, 3), 1000))
+  texts = set(s.text for s in samples)
+  assert texts == {'a' + long_sample, 'a{b}', 'a{bb}'}
+
+
+def main(argv):
+  """Main entry point."""
+  if len(argv) > 1:
+    raise app.UsageError('Unrecognized command line flags.')
+  sys.exit(pytest.main([__file__, '-vv']))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -176,8 +176,7 @@ class KerasBackend(backends.BackendBase):
   def InitSampling(self, sampler: samplers.Sampler,
                    seed: typing.Optional[int] = None) -> int:
     self.inference_model, batch_size = self.GetInferenceModel()
-    if seed is not None:
-      np.random.seed(seed)
+    self.inference_rng = np.random.RandomState(seed)
     return batch_size
 
   def InitSampleBatch(self, sampler: samplers.Sampler, batch_size: int) -> None:
@@ -188,19 +187,43 @@ class KerasBackend(backends.BackendBase):
       # input shape: (batch_size, 1)
       self.inference_model.predict(x)
 
-    self.inference_indices = sampler.encoded_start_text[-1]
+    self.inference_indices = np.full(
+        (batch_size, 1), sampler.encoded_start_text[-1], dtype=np.int32)
+    # Every row of the batch is now in the same state, which is the state that
+    # restarted rows are reset to.
+    self.inference_seed_states = self.GetInferenceStates()
+
+  def ResetSampleBatchRows(self, sampler: samplers.Sampler,
+                           rows: np.ndarray) -> None:
+    states = self.GetInferenceStates()
+    for state, seed_state in zip(states, self.inference_seed_states):
+      state[rows] = seed_state[rows]
+    self.SetInferenceStates(states)
+    self.inference_indices[rows] = sampler.encoded_start_text[-1]
+
+  def GetInferenceStates(self) -> typing.List[np.ndarray]:
+    """Get the values of the states of the stateful inference model layers."""
+    from keras import backend as K
+    return K.batch_get_value(self._GetInferenceStateVariables())
+
+  def SetInferenceStates(self, values: typing.List[np.ndarray]) -> None:
+    """Set the values of the states of the stateful inference model layers."""
+    from keras import backend as K
+    K.batch_set_value(list(zip(self._GetInferenceStateVariables(), values)))
+
+  def _GetInferenceStateVariables(self) -> typing.List['tf.Variable']:
+    return [state for layer in self.inference_model.layers
+            if getattr(layer, 'stateful', False) for state in layer.states]
 
   def SampleNextIndices(self, sampler: samplers.Sampler, batch_size: int):
     # Predict the next index for the entire batch.
-    x = np.array([self.inference_indices] * batch_size)
-    # Input shape: (bath_size, 1).
-    probabilities = self.inference_model.predict(x)
+    # Input shape: (batch_size, 1).
+    probabilities = self.inference_model.predict(self.inference_indices)
     # Output shape: (batch_size, 1, vocab_size).
-    self.inference_indices = [
-      WeightedPick(p.squeeze(), sampler.temperature)
-      for p in probabilities
-    ]
-    return self.inference_indices
+    indices = backends.WeightedPickBatch(
+        probabilities[:, 0, :], sampler.temperature, self.inference_rng)
+    self.inference_indices[:, 0] = indices
+    return indices
 
   def InferenceManifest(self) -> typing.List[pathlib.Path]:
     """Return the list of files which are required for model inference.
@@ -233,9 +256,5 @@ class KerasBackend(backends.BackendBase):
 
 def WeightedPick(predictions: np.ndarray, temperature: float) -> int:
   """Make a weighted choice from a predictions array."""
-  predictions = np.log(np.asarray(predictions).astype('float64')) / temperature
-  predictions_exp = np.exp(predictions)
-  # Normalize the probabilities.
-  predictions = predictions_exp / np.sum(predictions_exp)
-  predictions = np.random.multinomial(1, predictions, 1)
-  return np.argmax(predictions)
+  return int(backends.WeightedPickBatch(
+      np.asarray(predictions)[np.newaxis, :], temperature)[0])
@@ -39,6 +39,16 @@ class MockSampler(object):
     """Crude 'maxlen' mock."""
     return len(sample_in_progress) >= 10
 
+  def InitSampleBatch(self, batch_size):
+    """Crude 'maxlen' mock."""
+    del batch_size
+    self.num_tokens = len(self.tokenized_start_text)
+
+  def SampleBatchIsComplete(self, indices):
+    """Crude 'maxlen' mock."""
+    self.num_tokens += 1
+    return np.full(len(indices), self.num_tokens >= 10, dtype=np.bool)
+
 
 @pytest.fixture(scope='function')
 def abc_keras_model_config(abc_model_config: model_pb2.Model):
@@ -3,13 +3,13 @@ import pathlib
 import typing
 
 import humanize
-import numpy as np
 from absl import flags
 from absl import logging
 
 from deeplearning.clgen import samplers
 from deeplearning.clgen import telemetry
 from deeplearning.clgen.corpuses import atomizers
+from deeplearning.clgen.models import backends
 from deeplearning.clgen.models import keras_backend
 from deeplearning.clgen.models import tensorflow_backend
 from deeplearning.clgen.proto import internal_pb2
@@ -84,43 +84,10 @@ class PreTrainedModel(object):
     # Per-sample batch outer loop. Continues until we have as many samples
     # as we want.
     while True:
-      samples_in_progress = [
-        sampler.tokenized_start_text.copy()
-        for _ in range(batch_size)]
-      done = np.zeros(batch_size, dtype=np.bool)
-      start_time = labdate.MillisecondsTimestamp()
-      wall_time_start = start_time
-
-      self.backend.InitSampleBatch(sampler, batch_size)
-
-      # Sampling loop. Continues until all samples in the batch are done.
-      while True:
-        indices = self.backend.SampleNextIndices(sampler, batch_size)
-
-        # Iterate over all samples in batch to determine whether they're
-        # done.
-        for i in range(batch_size):
-          if done[i]:
-            continue
-
-          token = atomizer.decoder[indices[i]]
-          samples_in_progress[i].append(token)
-          if sampler.SampleIsComplete(samples_in_progress[i]):
-            end_time = labdate.MillisecondsTimestamp()
-            done[i] = 1
-            sample = model_pb2.Sample(
-                text=''.join(samples_in_progress[i]),
-                sample_start_epoch_ms_utc=start_time,
-                sample_time_ms=end_time - start_time,
-                wall_time_ms=end_time - wall_time_start,
-                num_tokens=len(samples_in_progress[i]))
-            sample_count += 1
-            yield sample
-            wall_time_start = labdate.MillisecondsTimestamp()
-
-        # Complete the batch.
-        if done.all():
-          break
+      for sample in backends.SampleBatch(self.backend, sampler, atomizer,
+                                         batch_size):
+        sample_count += 1
+        yield sample
 
       # Complete sampling. Note that sample_count starts at 1.
       if sample_count > min_num_samples:
@@ -132,6 +99,32 @@ class PreTrainedModel(object):
                 int((now - sample_start_time) / max(sample_count - 1, 1))))
         break
 
+  def SampleStream(
+      self, sampler: samplers.Sampler,
+      seed: int = None) -> typing.Iterator[model_pb2.Sample]:
+    """Produce an endless stream of samples.
+
+    Unlike Sample(), samples are produced using continuous batching: as soon
+    as a sample in the batch completes, a new sample is started in its place.
+
+    Args:
+      sampler: The sampler to sample using.
+      seed: A numeric value to seed the RNG with. If not present, the RNG is
+        seeded randomly.
+
+    Returns:
+      An iterator over samples, in the order that they are completed.
+
+    Raises:
+      InvalidStartText: If the sampler start text cannot be encoded.
+      InvalidSymtokTokens: If the sampler symmetrical depth tokens cannot be
+        encoded.
+    """
+    sampler.Specialize(self.atomizer)
+    batch_size = self.backend.InitSampling(sampler, seed)
+    return backends.SampleStream(self.backend, sampler, self.atomizer,
+                                 batch_size)
+
 
 class NullCorpus(object):
   """Corpus for a pre-trained model."""
@@ -335,8 +335,8 @@ class TensorFlowBackend(backends.BackendBase):
       del self.inference_sess
 
     # Seed the RNG.
+    self.inference_rng = np.random.RandomState(seed)
     if seed is not None:
-      np.random.seed(seed)
       self.inference_tf.set_random_seed(seed)
 
     self.inference_tf = self.InitTfGraph(inference=True)
@@ -373,6 +373,15 @@ class TensorFlowBackend(backends.BackendBase):
       }
       [self.inference_state] = self.inference_sess.run([self.final_state], feed)
     self.inference_indices[:] = sampler.encoded_start_text[-1]
+    # Every row of the batch is now in the same state, which is the state that
+    # restarted rows are reset to.
+    self.inference_seed_state = self.inference_state
+
+  def ResetSampleBatchRows(self, sampler: samplers.Sampler,
+                           rows: np.ndarray) -> None:
+    self.inference_state = ResetStateRows(
+        self.inference_state, self.inference_seed_state, rows)
+    self.inference_indices[rows] = sampler.encoded_start_text[-1]
 
   def SampleNextIndices(self, sampler: samplers.Sampler, batch_size: int):
     # Sample distribution to pick next symbol.
@@ -382,9 +391,10 @@ class TensorFlowBackend(backends.BackendBase):
     }
     [predictions, self.inference_state] = self.inference_sess.run(
         [self.probs, self.final_state], feed)
-    self.inference_indices[:, 0] = [
-      WeightedPick(p, sampler.temperature) for p in predictions]
-    return [i[0] for i in self.inference_indices]
+    indices = backends.WeightedPickBatch(
+        predictions, sampler.temperature, self.inference_rng)
+    self.inference_indices[:, 0] = indices
+    return indices
 
   @property
   def is_trained(self) -> bool:
@@ -397,11 +407,30 @@ class TensorFlowBackend(backends.BackendBase):
     return self.config.training.num_epochs in epoch_nums
 
 
+def ResetStateRows(state, seed_state, rows: np.ndarray):
+  """Reset rows of an RNN state to the values of the seed state.
+
+  Args:
+    state: An RNN cell state, as returned by Session.run(). This is a numpy
+      array, or a (possibly nested) tuple of numpy arrays.
+    seed_state: An RNN cell state of the same structure to copy rows from.
+    rows: The row numbers to reset.
+
+  Returns:
+    A new RNN cell state.
+  """
+  if isinstance(state, np.ndarray):
+    state = state.copy()
+    state[rows] = seed_state[rows]
+    return state
+  values = [ResetStateRows(s, seed, rows) for s, seed in zip(state, seed_state)]
+  # Namedtuples, such as LSTMStateTuple, are constructed from positional args.
+  if hasattr(state, '_fields'):
+    return type(state)(*values)
+  return type(state)(values)
+
+
 def WeightedPick(predictions: np.ndarray, temperature: float) -> np.ndarray:
   """Make a weighted choice from a predictions array."""
-  predictions = np.log(np.asarray(predictions).astype('float64')) / temperature
-  predictions_exp = np.exp(predictions)
-  # Normalize the probabilities.
-  predictions = predictions_exp / np.sum(predictions_exp)
-  predictions = np.random.multinomial(1, predictions, 1)
-  return np.argmax(predictions)
+  return backends.WeightedPickBatch(
+      np.asarray(predictions)[np.newaxis, :], temperature)[0]
@@ -37,6 +37,16 @@ class MockSampler(object):
     """Crude 'maxlen' mock."""
     return len(sample_in_progress) >= 10
 
+  def InitSampleBatch(self, batch_size):
+    """Crude 'maxlen' mock."""
+    del batch_size
+    self.num_tokens = len(self.tokenized_start_text)
+
+  def SampleBatchIsComplete(self, indices):
+    """Crude 'maxlen' mock."""
+    self.num_tokens += 1
+    return np.full(len(indices), self.num_tokens >= 10, dtype=np.bool)
+
 
 @pytest.fixture(scope='function')
 def abc_tensorflow_model_config(abc_model_config: model_pb2.Model):
@@ -200,6 +210,19 @@ def test_WeightedPick_output_range():
   assert 0 <= tensorflow_backend.WeightedPick(np.array(a), 1.0) <= len(a)
 
 
+# ResetStateRows() tests.
+
+def test_ResetStateRows_nested_state():
+  """Test that only the reset rows of a nested state are replaced."""
+  state = (np.ones((3, 2)), (np.ones((3, 2)) * 2, np.ones((3, 2)) * 3))
+  seed = (np.zeros((3, 2)), (np.zeros((3, 2)), np.zeros((3, 2))))
+  new_state = tensorflow_backend.ResetStateRows(state, seed, np.array([1]))
+  np.testing.assert_array_equal([[1, 1], [0, 0], [1, 1]], new_state[0])
+  np.testing.assert_array_equal([[3, 3], [0, 0], [3, 3]], new_state[1][1])
+  # The original state is unmodified.
+  np.testing.assert_array_equal(np.ones((3, 2)), state[0])
+
+
 # Benchmarks.
 
 def test_benchmark_TensorFlowModel_Train_already_trained(
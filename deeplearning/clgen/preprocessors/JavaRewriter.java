@@ -2,7 +2,12 @@
 package deeplearning.clgen.preprocessors;
 
 import com.google.common.io.ByteStreams;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
 import java.io.IOException;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
 import java.nio.charset.Charset;
 import java.nio.file.Files;
 import java.nio.file.Paths;
@@ -169,7 +174,64 @@ public class JavaRewriter {
     return new String(encoded, encoding);
   }
 
+  /**
+   * Rewrite source files read from stdin until stdin is closed.
+   *
+   * Each request is a big-endian uint32 length followed by that many bytes of
+   * UTF-8 encoded source code. Each response is a status byte (zero on
+   * success), followed by a big-endian uint32 length and that many bytes of
+   * UTF-8 encoded rewritten source code, or an error message.
+   *
+   * @throws IOException In case of IO error.
+   */
+  private static void Serve() throws IOException {
+    final DataInputStream in = new DataInputStream(System.in);
+    final DataOutputStream out = new DataOutputStream(System.out);
+    // Stdout is reserved for responses, so divert any other output.
+    System.setOut(new PrintStream(System.err));
+
+    while (true) {
+      final int length;
+      try {
+        length = in.readInt();
+      } catch (EOFException e) {
+        return;
+      }
+      final byte[] request = new byte[length];
+      in.readFully(request);
+
+      byte status = 0;
+      String response;
+      try {
+        response = new JavaRewriter().RewriteSource(
+            new String(request, StandardCharsets.UTF_8));
+        if (response == null) {
+          status = 1;
+          response = "fatal: RewriteSource() returned null.";
+        }
+      } catch (RuntimeException e) {
+        status = 1;
+        response = "fatal: " + e.toString();
+      }
+      final byte[] payload = response.getBytes(StandardCharsets.UTF_8);
+      out.writeByte(status);
+      out.writeInt(payload.length);
+      out.write(payload);
+      out.flush();
+    }
+  }
+
   public static void main(final String[] args) {
+    if (args.length == 1 && args[0].equals("--server")) {
+      try {
+        Serve();
+      } catch (IOException e) {
+        System.err.println("fatal: I/O error");
+        System.exit(1);
+      }
+      return;
+    }
+
     JavaRewriter rewriter = new JavaRewriter();
 
     try {
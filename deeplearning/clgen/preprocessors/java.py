@@ -12,6 +12,7 @@ from absl import logging
 from deeplearning.clgen import errors
 from deeplearning.clgen.preprocessors import clang
 from deeplearning.clgen.preprocessors import public
+from deeplearning.clgen.preprocessors import server
 from labm8 import bazelutil
 
 
@@ -139,6 +140,8 @@ def JavaRewrite(text: str) -> str:
     RewriterError: If rewriter found nothing to rewrite.
     ClangTimeout: If rewriter fails to complete within timeout_seconds.
   """
+  if FLAGS.clgen_preprocessor_servers:
+    return JavaRewriteWithServer(text)
   cmd = ['timeout', '-s9', '60', str(JAVA_REWRITER)]
   process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
@@ -150,3 +153,30 @@ def JavaRewrite(text: str) -> str:
   elif process.returncode:
     raise errors.RewriterException(stderr)
   return stdout.strip() + '\n'
+
+
+def JavaRewriteWithServer(text: str) -> str:
+  """Run the Java rewriter on the text using a long-lived rewriter process.
+
+  This is equivalent to JavaRewrite(), but amortizes the cost of starting a
+  JVM across all of the inputs processed by the calling process.
+
+  Args:
+    text: The source code to rewrite.
+
+  Returns:
+    Source code with identifier names normalized.
+
+  Raises:
+    RewriterError: If rewriter found nothing to rewrite.
+  """
+  helper = server.GetHelper([str(JAVA_REWRITER), '--server'],
+                            timeout_seconds=60)
+  try:
+    stdout = helper.Call(text.encode('utf-8')).decode('utf-8')
+  except server.HelperTimeout as e:
+    raise errors.RewriterException(
+        'JavaRewriter failed to complete after 60s') from e
+  except (server.HelperError, server.HelperException) as e:
+    raise errors.RewriterException(str(e)) from e
+  return stdout.strip() + '\n'
@@ -7,6 +7,7 @@ from absl import flags
 
 from deeplearning.clgen import errors
 from deeplearning.clgen.preprocessors import public
+from deeplearning.clgen.preprocessors import stage_cache
 
 
 FLAGS = flags.FLAGS
@@ -46,7 +47,8 @@ def GetPreprocessorFunction(name: str) -> public.PreprocessorFunction:
   return function_
 
 
-def Preprocess(text: str, preprocessors: typing.List[str]) -> str:
+def Preprocess(text: str, preprocessors: typing.List[str],
+               cache: typing.Optional[stage_cache.StageCache] = None) -> str:
   """Preprocess a text using the given preprocessor pipeline.
 
   If preprocessing succeeds, the preprocessed text is returned. If preprocessing
@@ -58,6 +60,9 @@ def Preprocess(text: str, preprocessors: typing.List[str]) -> str:
     text: The input to be preprocessed.
     preprocessors: The list of preprocessor functions to run. These will be
       passed to GetPreprocessorFunction() to resolve the python implementations.
+    cache: An optional cache of preprocessor results. If provided, the result
+      of each preprocessor is looked up in the cache before running it, and
+      added to the cache after.
 
   Returns:
     Preprocessed source input as a string.
@@ -68,6 +73,10 @@ def Preprocess(text: str, preprocessors: typing.List[str]) -> str:
     InternalException: In case of some other error.
   """
   preprocessor_functions = [GetPreprocessorFunction(p) for p in preprocessors]
+  if cache:
+    for name, preprocessor in zip(preprocessors, preprocessor_functions):
+      text = cache.Apply(name, preprocessor, text)
+    return text
   for preprocessor in preprocessor_functions:
     text = preprocessor(text)
   return text
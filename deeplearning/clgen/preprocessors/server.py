@@ -0,0 +1,167 @@
+"""Long-lived helper processes for preprocessors.
+
+Preprocessors which are implemented by external binaries pay the cost of
+process start-up for every input, which for a JVM can be far greater than the
+cost of processing the input itself. A HelperProcess keeps a single instance
+of such a binary alive and exchanges requests and responses with it over its
+stdin and stdout using length-prefixed frames:
+
+  request:  <uint32 length><payload>
+  response: <uint8 status><uint32 length><payload>
+
+All integers are big-endian. A status of zero indicates success, in which case
+the payload is the result. Any other status indicates that the helper rejected
+the input, in which case the payload is a UTF-8 error message. A helper
+terminates when its stdin is closed.
+
+Requests which do not complete within the timeout cause the helper to be
+killed, and a helper which crashes is restarted transparently on the next
+request.
+"""
+import atexit
+import os
+import struct
+import subprocess
+import threading
+import time
+import typing
+
+from absl import flags
+
+from deeplearning.clgen import errors
+from labm8 import framedproc
+
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_bool(
+    'clgen_preprocessor_servers', True,
+    'If set, preprocessors which support it keep a long-lived helper process '
+    'and send it inputs over a pipe, rather than starting a new process for '
+    'every input.')
+
+_RESPONSE_HEADER = struct.Struct('>BI')
+
+
+class HelperException(errors.InternalError):
+  """Raised if a helper process crashes or violates the protocol."""
+  pass
+
+
+class HelperTimeout(HelperException):
+  """Raised if a helper process fails to respond within the time limit."""
+  pass
+
+
+class HelperError(errors.BadCodeException):
+  """Raised if a helper process rejects an input."""
+  pass
+
+
+class HelperProcess(object):
+  """A long-lived helper process which processes one request at a time.
+
+  The process is started lazily on the first call to Call(). Instances may be
+  shared between threads, but requests are serialized.
+  """
+
+  def __init__(self, cmd: typing.List[str], timeout_seconds: int = 60):
+    """Instantiate a helper process.
+
+    Args:
+      cmd: The command which launches the helper.
+      timeout_seconds: The maximum number of seconds to wait for a response
+        to a single request.
+    """
+    self.cmd = cmd
+    self.timeout_seconds = timeout_seconds
+    # Helpers may be chatty on stderr. Since nothing reads it, it must not be a
+    # pipe or the helper would block once the pipe buffer fills.
+    self._process = framedproc.FramedProcess(cmd, stderr=subprocess.DEVNULL)
+    self._lock = threading.Lock()
+
+  @property
+  def pid(self) -> typing.Optional[int]:
+    """The pid of the helper, or None if it is not running."""
+    return self._process.pid
+
+  def Call(self, data: bytes) -> bytes:
+    """Send a request to the helper and wait for the response.
+
+    Args:
+      data: The request payload.
+
+    Returns:
+      The response payload.
+
+    Raises:
+      HelperError: If the helper rejects the input.
+      HelperTimeout: If the helper does not respond in time. The helper is
+        killed, and will be restarted by the next call.
+      HelperException: If the helper crashes or sends a malformed response.
+    """
+    with self._lock:
+      if not self._process.running:
+        self._process.Start()
+      deadline = time.time() + self.timeout_seconds
+      try:
+        self._process.WriteFrame(data)
+        status, length = _RESPONSE_HEADER.unpack(
+            self._process.Read(_RESPONSE_HEADER.size, deadline))
+        payload = self._process.Read(length, deadline)
+      except framedproc.FrameTimeout:
+        self._process.Stop()
+        raise HelperTimeout(
+            f'{self.cmd[0]} failed to respond within {self.timeout_seconds}s')
+      except EOFError:
+        self._process.Stop()
+        raise HelperException(
+            f'{self.cmd[0]} crashed: unexpected end of stream')
+      except OSError as e:
+        self._process.Stop()
+        raise HelperException(f'{self.cmd[0]} crashed: {e}')
+    if status:
+      raise HelperError(payload.decode('utf-8', errors='replace'))
+    return payload
+
+  def Stop(self) -> None:
+    """Terminate the helper, if it is running."""
+    with self._lock:
+      self._process.Stop()
+
+
+# The helpers of the current process, keyed by command. Helpers are not
+# inherited across fork(), so that each worker of a multiprocessing pool starts
+# its own.
+_helpers: typing.Dict[typing.Tuple[str, ...], HelperProcess] = {}
+_helpers_pid = os.getpid()
+
+
+def GetHelper(cmd: typing.List[str], timeout_seconds: int = 60) -> HelperProcess:
+  """Get the helper process for a command, creating it if required.
+
+  Args:
+    cmd: The command which launches the helper.
+    timeout_seconds: The maximum number of seconds to wait for a response.
+
+  Returns:
+    A HelperProcess owned by the calling process.
+  """
+  global _helpers
+  global _helpers_pid
+  if _helpers_pid != os.getpid():
+    # We are in a forked child. The parent's helpers belong to the parent.
+    _helpers = {}
+    _helpers_pid = os.getpid()
+  key = tuple(cmd)
+  if key not in _helpers:
+    _helpers[key] = HelperProcess(cmd, timeout_seconds)
+  return _helpers[key]
+
+
+@atexit.register
+def StopHelpers() -> None:
+  """Terminate all of the helpers started by the current process."""
+  if _helpers_pid == os.getpid():
+    for helper in _helpers.values():
+      helper.Stop()
@@ -0,0 +1,105 @@
+"""Unit tests for //deeplearning/clgen/preprocessors/server.py."""
+import sys
+
+import pytest
+from absl import app
+from absl import flags
+
+from deeplearning.clgen.preprocessors import server
+
+
+FLAGS = flags.FLAGS
+
+# A helper which upper-cases its inputs, and misbehaves on demand.
+HELPER_SCRIPT = """
+import os
+import struct
+import sys
+import time
+
+while True:
+  header = sys.stdin.buffer.read(4)
+  if not header:
+    break
+  data = sys.stdin.buffer.read(struct.unpack('>I', header)[0])
+  if data == b'crash':
+    os._exit(1)
+  elif data == b'sleep':
+    time.sleep(10)
+  status, payload = (1, b'bad input') if data == b'bad' else (0, data.upper())
+  sys.stdout.buffer.write(struct.pack('>BI', status, len(payload)) + payload)
+  sys.stdout.buffer.flush()
+"""
+
+
+@pytest.fixture(scope='function')
+def helper() -> server.HelperProcess:
+  """A test fixture which returns a helper process."""
+  helper = server.HelperProcess([sys.executable, '-c', HELPER_SCRIPT],
+                                timeout_seconds=1)
+  yield helper
+  helper.Stop()
+
+
+# HelperProcess tests.
+
+def test_HelperProcess_Call(helper: server.HelperProcess):
+  """Test that requests are answered."""
+  assert helper.Call(b'hello') == b'HELLO'
+  assert helper.Call(b'') == b''
+
+
+def test_HelperProcess_Call_reuses_process(helper: server.HelperProcess):
+  """Test that a single process serves multiple requests."""
+  assert helper.pid is None
+  helper.Call(b'a')
+  pid = helper.pid
+  helper.Call(b'b')
+  assert helper.pid == pid
+
+
+def test_HelperProcess_Call_error(helper: server.HelperProcess):
+  """Test that a rejected input raises HelperError."""
+  with pytest.raises(server.HelperError) as e_ctx:
+    helper.Call(b'bad')
+  assert str(e_ctx.value) == 'bad input'
+  # The helper is still usable.
+  assert helper.Call(b'good') == b'GOOD'
+
+
+def test_HelperProcess_Call_timeout(helper: server.HelperProcess):
+  """Test that a helper which does not respond is killed and restarted."""
+  helper.Call(b'a')
+  pid = helper.pid
+  with pytest.raises(server.HelperTimeout):
+    helper.Call(b'sleep')
+  assert helper.pid is None
+  assert helper.Call(b'a') == b'A'
+  assert helper.pid != pid
+
+
+def test_HelperProcess_Call_crash(helper: server.HelperProcess):
+  """Test that a helper which crashes is restarted."""
+  with pytest.raises(server.HelperException):
+    helper.Call(b'crash')
+  assert helper.Call(b'a') == b'A'
+
+
+# GetHelper() tests.
+
+def test_GetHelper_same_command():
+  """Test that the same helper is returned for the same command."""
+  cmd = [sys.executable, '-c', HELPER_SCRIPT]
+  assert server.GetHelper(cmd) is server.GetHelper(cmd)
+  assert server.GetHelper(cmd) is not server.GetHelper(cmd + ['--foo'])
+
+
+def main(argv):
+  """Main entry point."""
+  if len(argv) > 1:
+    raise app.UsageError('Unrecognized command line flags.')
+  sys.exit(pytest.main([__file__, '-vv']))
+
+
+if __name__ == '__main__':
+  app.run(main)
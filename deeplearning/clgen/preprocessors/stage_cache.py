@@ -0,0 +1,227 @@
+"""A content-addressed cache of the outputs of individual preprocessors.
+
+Preprocessors are pure functions of their input text, so the result of running
+a preprocessor on a text can be reused by any pipeline which feeds it the same
+text. Results are keyed by the name of the preprocessor and the checksum of its
+input, so that pipelines which share a common prefix of preprocessors reuse
+every intermediate result of that prefix. Rejections (BadCodeExceptions) are
+cached too, since those are often the most expensive results to compute.
+
+The cache is an SQLite database which may be shared by concurrent processes.
+Its size is bounded by evicting the least recently used results.
+"""
+import hashlib
+import os
+import pathlib
+import time
+import typing
+
+import humanize
+import sqlalchemy as sql
+from absl import flags
+from absl import logging
+from sqlalchemy.ext import declarative
+from sqlalchemy.sql import func
+
+from deeplearning.clgen import errors
+from deeplearning.clgen.preprocessors import public
+from deeplearning.clgen.preprocessors import server
+from labm8 import sqlutil
+
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+    'clgen_preprocessor_stage_cache_mb', 4096,
+    'The maximum size of the cache of preprocessor results, in megabytes. '
+    'When exceeded, the least recently used results are evicted.')
+
+Base = declarative.declarative_base()
+
+# Rejections which depend on the load of the machine rather than on the input,
+# and so must not be cached.
+_UNCACHEABLE_EXCEPTIONS = (
+  errors.ClangTimeout,
+  errors.GPUVerifyTimeoutException,
+)
+
+
+class StageResult(Base):
+  __tablename__ = 'stage_results'
+
+  # The fully qualified name of the preprocessor.
+  stage: str = sql.Column(sql.String(1024), primary_key=True)
+  # Checksum of the preprocessor input.
+  input_sha256: bytes = sql.Column(sql.Binary(32), primary_key=True)
+  # True if the preprocessor accepted the input, else False.
+  succeeded: bool = sql.Column(sql.Boolean, nullable=False)
+  # The preprocessor output if it succeeded, else the error message.
+  text: str = sql.Column(sql.UnicodeText(), nullable=False)
+  # The size of the text, in bytes.
+  size: int = sql.Column(sql.Integer, nullable=False)
+  # The time that this result was last produced or read, in seconds since the
+  # epoch.
+  last_used: float = sql.Column(sql.Float, nullable=False, index=True)
+
+
+class StageCache(sqlutil.Database):
+  """A cache of preprocessor results."""
+
+  # The number of results to add between checks for eviction.
+  evict_interval = 1000
+
+  def __init__(self, path: pathlib.Path, max_size_bytes: int):
+    super(StageCache, self).__init__(f'sqlite:///{path.absolute()}', Base)
+    # Let readers proceed concurrently with a writer.
+    self.engine.execute('PRAGMA journal_mode=WAL')
+    self.max_size_bytes = max_size_bytes
+    self._puts_since_evict = 0
+
+  def Apply(self, stage: str, preprocessor: public.PreprocessorFunction,
+            text: str) -> str:
+    """Run a preprocessor on a text, reusing the cached result if possible.
+
+    Args:
+      stage: The fully qualified name of the preprocessor.
+      preprocessor: The preprocessor function.
+      text: The input to the preprocessor.
+
+    Returns:
+      The output of the preprocessor.
+
+    Raises:
+      BadCodeException: If the preprocessor rejects the input. If the rejection
+        is cached, the exception is a BadCodeException with the original
+        error message, not the original exception type. Timeouts and helper
+        process failures are not cached.
+    """
+    input_sha256 = hashlib.sha256(text.encode('utf-8')).digest()
+    result = self.Get(stage, input_sha256)
+    if result:
+      succeeded, output = result
+      if not succeeded:
+        raise errors.BadCodeException(output)
+      return output
+    try:
+      output = preprocessor(text)
+    except errors.BadCodeException as e:
+      # A rejection raised because a helper process timed out or crashed is
+      # chained to the HelperException which caused it.
+      if not (isinstance(e, _UNCACHEABLE_EXCEPTIONS) or
+              isinstance(e.__cause__, server.HelperException)):
+        self.Put(stage, input_sha256, False, str(e))
+      raise
+    self.Put(stage, input_sha256, True, output)
+    return output
+
+  def Get(self, stage: str, input_sha256: bytes
+          ) -> typing.Optional[typing.Tuple[bool, str]]:
+    """Look up a cached result and mark it as used.
+
+    Args:
+      stage: The fully qualified name of the preprocessor.
+      input_sha256: The checksum of the preprocessor input.
+
+    Returns:
+      A <succeeded, text> tuple, or None if the result is not cached.
+    """
+    try:
+      with self.Session(commit=True) as session:
+        result = session.query(StageResult.succeeded, StageResult.text).filter(
+            StageResult.stage == stage,
+            StageResult.input_sha256 == input_sha256).first()
+        if result:
+          session.query(StageResult).filter(
+              StageResult.stage == stage,
+              StageResult.input_sha256 == input_sha256).update(
+              {'last_used': time.time()}, synchronize_session=False)
+        return tuple(result) if result else None
+    except sql.exc.DBAPIError as e:
+      # The cache is an optimization. Failing to read it is not fatal.
+      logging.warning('Failed to read preprocessor cache: %s', e)
+      return None
+
+  def Put(self, stage: str, input_sha256: bytes, succeeded: bool,
+          text: str) -> None:
+    """Add a result to the cache.
+
+    Args:
+      stage: The fully qualified name of the preprocessor.
+      input_sha256: The checksum of the preprocessor input.
+      succeeded: Whether the preprocessor accepted the input.
+      text: The preprocessor output, or the error message.
+    """
+    try:
+      with self.Session(commit=True) as session:
+        session.merge(StageResult(
+            stage=stage, input_sha256=input_sha256, succeeded=succeeded,
+            text=text, size=len(text.encode('utf-8')), last_used=time.time()))
+      self._puts_since_evict += 1
+      if self._puts_since_evict >= self.evict_interval:
+        self.Evict()
+    except sql.exc.DBAPIError as e:
+      logging.warning('Failed to write preprocessor cache: %s', e)
+
+  def Evict(self) -> int:
+    """Evict least recently used results until the cache fits in its bound.
+
+    To avoid evicting on every subsequent put, the cache is reduced to 90% of
+    its maximum size.
+
+    Returns:
+      The number of results evicted.
+    """
+    self._puts_since_evict = 0
+    with self.Session(commit=True) as session:
+      total_size = session.query(func.sum(StageResult.size)).scalar() or 0
+      if total_size <= self.max_size_bytes:
+        return 0
+      excess = total_size - int(self.max_size_bytes * .9)
+      freed, cutoff = 0, None
+      for size, last_used in session.query(
+          StageResult.size, StageResult.last_used).order_by(
+          StageResult.last_used).all():
+        freed += size
+        cutoff = last_used
+        if freed >= excess:
+          break
+      num_evicted = session.query(StageResult).filter(
+          StageResult.last_used <= cutoff).delete(synchronize_session=False)
+    logging.info('Evicted %s preprocessor results (%s) from cache',
+                 humanize.intcomma(num_evicted), humanize.naturalsize(freed))
+    return num_evicted
+
+  @property
+  def size(self) -> int:
+    """Return the total size of the cached results, in bytes."""
+    with self.Session() as session:
+      return session.query(func.sum(StageResult.size)).scalar() or 0
+
+
+# The caches of the current process, keyed by path. Database connections must
+# not be shared across fork(), so each worker of a multiprocessing pool opens
+# its own.
+_caches: typing.Dict[pathlib.Path, StageCache] = {}
+_caches_pid = os.getpid()
+
+
+def GetStageCache(path: pathlib.Path) -> StageCache:
+  """Get the stage cache at a path, opening it if required.
+
+  The size of the cache is bounded by --clgen_preprocessor_stage_cache_mb.
+
+  Args:
+    path: The path of the cache database.
+
+  Returns:
+    A StageCache owned by the calling process.
+  """
+  global _caches
+  global _caches_pid
+  if _caches_pid != os.getpid():
+    _caches = {}
+    _caches_pid = os.getpid()
+  if path not in _caches:
+    _caches[path] = StageCache(
+        path, FLAGS.clgen_preprocessor_stage_cache_mb * 1024 * 1024)
+  return _caches[path]
@@ -0,0 +1,195 @@
+"""Unit tests for //deeplearning/clgen/preprocessors/stage_cache.py."""
+import importlib
+import pathlib
+import sys
+import tempfile
+
+import pytest
+from absl import app
+from absl import flags
+
+from deeplearning.clgen import errors
+from deeplearning.clgen.preprocessors import preprocessors
+from deeplearning.clgen.preprocessors import public
+from deeplearning.clgen.preprocessors import server
+from deeplearning.clgen.preprocessors import stage_cache
+
+
+FLAGS = flags.FLAGS
+
+# The number of times that each mock preprocessor has been called.
+CALL_COUNTS = {}
+
+
+@public.clgen_preprocessor
+def MockUpper(text: str) -> str:
+  """A mock preprocessor which upper-cases its input."""
+  CALL_COUNTS['MockUpper'] = CALL_COUNTS.get('MockUpper', 0) + 1
+  return text.upper()
+
+
+@public.clgen_preprocessor
+def MockStrip(text: str) -> str:
+  """A mock preprocessor which strips its input."""
+  CALL_COUNTS['MockStrip'] = CALL_COUNTS.get('MockStrip', 0) + 1
+  return text.strip()
+
+
+@public.clgen_preprocessor
+def MockRejectEmpty(text: str) -> str:
+  """A mock preprocessor which rejects empty input."""
+  CALL_COUNTS['MockRejectEmpty'] = CALL_COUNTS.get('MockRejectEmpty', 0) + 1
+  if not text:
+    raise errors.BadCodeException('empty')
+  return text
+
+
+@public.clgen_preprocessor
+def MockTimeout(text: str) -> str:
+  """A mock preprocessor which times out."""
+  CALL_COUNTS['MockTimeout'] = CALL_COUNTS.get('MockTimeout', 0) + 1
+  raise errors.ClangTimeout('timeout')
+
+
+@public.clgen_preprocessor
+def MockHelperCrash(text: str) -> str:
+  """A mock preprocessor whose helper process crashes."""
+  CALL_COUNTS['MockHelperCrash'] = CALL_COUNTS.get('MockHelperCrash', 0) + 1
+  try:
+    raise server.HelperException('crashed')
+  except server.HelperException as e:
+    raise errors.RewriterException(str(e)) from e
+
+
+UPPER = 'deeplearning.clgen.preprocessors.stage_cache_test:MockUpper'
+STRIP = 'deeplearning.clgen.preprocessors.stage_cache_test:MockStrip'
+REJECT_EMPTY = (
+  'deeplearning.clgen.preprocessors.stage_cache_test:MockRejectEmpty')
+TIMEOUT = 'deeplearning.clgen.preprocessors.stage_cache_test:MockTimeout'
+HELPER_CRASH = (
+  'deeplearning.clgen.preprocessors.stage_cache_test:MockHelperCrash')
+
+
+@pytest.fixture(scope='function')
+def cache() -> stage_cache.StageCache:
+  """A test fixture which returns an empty stage cache."""
+  CALL_COUNTS.clear()
+  with tempfile.TemporaryDirectory() as d:
+    yield stage_cache.StageCache(pathlib.Path(d) / 'cache.db', 1024 * 1024)
+
+
+# StageCache.Apply() tests.
+
+def test_StageCache_Apply_hit(cache: stage_cache.StageCache):
+  """Test that a cached result is reused."""
+  assert cache.Apply(UPPER, MockUpper, 'abc') == 'ABC'
+  assert cache.Apply(UPPER, MockUpper, 'abc') == 'ABC'
+  assert CALL_COUNTS['MockUpper'] == 1
+  assert cache.Apply(UPPER, MockUpper, 'abcd') == 'ABCD'
+  assert CALL_COUNTS['MockUpper'] == 2
+
+
+def test_StageCache_Apply_keyed_by_stage(cache: stage_cache.StageCache):
+  """Test that results of different stages are not confused."""
+  assert cache.Apply(UPPER, MockUpper, ' a ') == ' A '
+  assert cache.Apply(STRIP, MockStrip, ' a ') == 'a'
+
+
+def test_StageCache_Apply_bad_code(cache: stage_cache.StageCache):
+  """Test that rejections are cached."""
+  with pytest.raises(errors.BadCodeException) as e_ctx:
+    cache.Apply(REJECT_EMPTY, MockRejectEmpty, '')
+  assert str(e_ctx.value) == 'empty'
+  with pytest.raises(errors.BadCodeException) as e_ctx:
+    cache.Apply(REJECT_EMPTY, MockRejectEmpty, '')
+  assert str(e_ctx.value) == 'empty'
+  assert CALL_COUNTS['MockRejectEmpty'] == 1
+
+
+def test_StageCache_Apply_timeout_not_cached(cache: stage_cache.StageCache):
+  """Test that timeouts are not cached as rejections."""
+  for _ in range(2):
+    with pytest.raises(errors.ClangTimeout):
+      cache.Apply(TIMEOUT, MockTimeout, 'abc')
+  assert CALL_COUNTS['MockTimeout'] == 2
+  assert not cache.size
+
+
+def test_StageCache_Apply_helper_failure_not_cached(
+    cache: stage_cache.StageCache):
+  """Test that rejections caused by a helper process crash are not cached."""
+  for _ in range(2):
+    with pytest.raises(errors.RewriterException):
+      cache.Apply(HELPER_CRASH, MockHelperCrash, 'abc')
+  assert CALL_COUNTS['MockHelperCrash'] == 2
+  assert not cache.size
+
+
+# StageCache.Evict() tests.
+
+def test_StageCache_Evict_least_recently_used(
+    cache: stage_cache.StageCache):
+  """Test that the least recently used results are evicted first."""
+  cache.max_size_bytes = 10
+  cache.Apply(UPPER, MockUpper, 'aaaa')
+  cache.Apply(UPPER, MockUpper, 'bbbb')
+  # Touch the first result, so that the second is least recently used.
+  cache.Apply(UPPER, MockUpper, 'aaaa')
+  cache.Apply(UPPER, MockUpper, 'cccc')
+  assert cache.size == 12
+  assert cache.Evict() == 1
+  assert cache.size == 8
+  CALL_COUNTS.clear()
+  cache.Apply(UPPER, MockUpper, 'aaaa')
+  cache.Apply(UPPER, MockUpper, 'cccc')
+  assert 'MockUpper' not in CALL_COUNTS
+  cache.Apply(UPPER, MockUpper, 'bbbb')
+  assert CALL_COUNTS['MockUpper'] == 1
+
+
+def test_StageCache_Evict_within_bound(cache: stage_cache.StageCache):
+  """Test that nothing is evicted from a cache within its bound."""
+  cache.Apply(UPPER, MockUpper, 'aaaa')
+  assert cache.Evict() == 0
+  assert cache.size == 4
+
+
+# Preprocess() tests.
+
+def test_Preprocess_shared_prefix(cache: stage_cache.StageCache):
+  """Test that pipelines with a common prefix reuse intermediate results."""
+  # Preprocess() resolves the mock preprocessors by importing this module,
+  # which is a different module object when this file is run as __main__.
+  call_counts = importlib.import_module(
+      'deeplearning.clgen.preprocessors.stage_cache_test').CALL_COUNTS
+  call_counts.clear()
+  assert preprocessors.Preprocess(' abc ', [UPPER], cache) == ' ABC '
+  assert preprocessors.Preprocess(' abc ', [UPPER, STRIP], cache) == 'ABC'
+  assert call_counts == {'MockUpper': 1, 'MockStrip': 1}
+
+
+def test_Preprocess_equivalence(cache: stage_cache.StageCache):
+  """Test that cached and uncached pipelines produce the same output."""
+  pipeline = [STRIP, UPPER, REJECT_EMPTY]
+  for text in ['abc', ' abc', '\n', 'a b\nc']:
+    try:
+      expected = preprocessors.Preprocess(text, pipeline)
+    except errors.BadCodeException:
+      expected = None
+    for _ in range(2):
+      try:
+        actual = preprocessors.Preprocess(text, pipeline, cache)
+      except errors.BadCodeException:
+        actual = None
+      assert actual == expected
+
+
+def main(argv):
+  """Main entry point."""
+  if len(argv) > 1:
+    raise app.UsageError('Unrecognized command line flags.')
+  sys.exit(pytest.main([__file__, '-vv']))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -5,6 +5,7 @@ determines the shape of the generated samples.
 """
 import typing
 
+import numpy as np
 from absl import flags
 
 from deeplearning.clgen import errors
@@ -47,6 +48,11 @@ class TerminationCriterionBase(object):
   A TerminationCriterion is an object with a single public function
   SampleIsComplete(), which accepts as its sole argument a sample-in-progress,
   and returns whether to stop sampling.
+
+  For sampling in batches, InitSampleBatch() and SampleBatchIsComplete()
+  provide an equivalent interface which updates the state of every sample in
+  the batch incrementally, one token at a time. ResetSampleBatchRows() restarts
+  individual samples within a batch.
   """
 
   def Specialize(self, atomizer: atomizers.AtomizerBase) -> None:
@@ -73,6 +79,36 @@ class TerminationCriterionBase(object):
     """
     raise NotImplementedError('abstract class')
 
+  def InitSampleBatch(self, encoded_start_text: np.ndarray,
+                      batch_size: int) -> None:
+    """Begin a batch of samples.
+
+    Args:
+      encoded_start_text: The encoded start text, which begins every sample.
+      batch_size: The number of samples in the batch.
+    """
+    raise NotImplementedError('abstract class')
+
+  def SampleBatchIsComplete(self, indices: np.ndarray) -> np.ndarray:
+    """Append a token to every sample in a batch and determine which are done.
+
+    Args:
+      indices: The vocabulary index of the next token of every sample.
+
+    Returns:
+      An array of bools, one per sample, which is True if the sample is
+      "complete".
+    """
+    raise NotImplementedError('abstract class')
+
+  def ResetSampleBatchRows(self, rows: np.ndarray) -> None:
+    """Restart samples in a batch from the start text.
+
+    Args:
+      rows: The row numbers of the samples to restart.
+    """
+    raise NotImplementedError('abstract class')
+
 
 class MaxlenTerminationCriterion(TerminationCriterionBase):
   """A termination criterion which limits the maximum length of a sample."""
@@ -89,6 +125,21 @@ class MaxlenTerminationCriterion(TerminationCriterionBase):
     """Determine whether to stop sampling."""
     return len(sample_in_progress) >= self.max_len
 
+  def InitSampleBatch(self, encoded_start_text: np.ndarray,
+                      batch_size: int) -> None:
+    """Begin a batch of samples."""
+    self.start_length = len(encoded_start_text)
+    self.batch_sample_lengths = np.full(batch_size, self.start_length)
+
+  def SampleBatchIsComplete(self, indices: np.ndarray) -> np.ndarray:
+    """Determine which samples in a batch to stop sampling."""
+    self.batch_sample_lengths += 1
+    return self.batch_sample_lengths >= self.max_len
+
+  def ResetSampleBatchRows(self, rows: np.ndarray) -> None:
+    """Restart samples in a batch from the start text."""
+    self.batch_sample_lengths[rows] = self.start_length
+
 
 class SymmetricalTokenDepthCriterion(TerminationCriterionBase):
   """A termination criterion which counts symmetrical token depth.
@@ -113,6 +164,9 @@ class SymmetricalTokenDepthCriterion(TerminationCriterionBase):
       raise errors.UserError(e)
     if self.left_token == self.right_token:
       raise errors.UserError('SymmetricalTokenDepth tokens must be different')
+    # Set in Specialize().
+    self.left_index = None
+    self.right_index = None
 
   def Specialize(self, atomizer: atomizers.AtomizerBase) -> None:
     """Specialize a termination criteria to a vocabulary.
@@ -140,6 +194,7 @@ class SymmetricalTokenDepthCriterion(TerminationCriterionBase):
       raise errors.InvalidSymtokTokens(
           'Sampler symmetrical depth tokens cannot be encoded using the '
           'corpus vocabulary')
+    self.left_index, self.right_index = l[0], r[0]
 
   def SampleIsComplete(self, sample_in_progress: typing.List[str]) -> bool:
     """Determine whether to stop sampling."""
@@ -157,6 +212,37 @@ class SymmetricalTokenDepthCriterion(TerminationCriterionBase):
       return False
     return left_token_count - right_token_count == 0
 
+  def InitSampleBatch(self, encoded_start_text: np.ndarray,
+                      batch_size: int) -> None:
+    """Begin a batch of samples."""
+    self.start_left_count = np.count_nonzero(
+        encoded_start_text == self.left_index)
+    self.start_right_count = np.count_nonzero(
+        encoded_start_text == self.right_index)
+    self.batch_left_counts = np.full(batch_size, self.start_left_count)
+    self.batch_right_counts = np.full(batch_size, self.start_right_count)
+
+  def SampleBatchIsComplete(self, indices: np.ndarray) -> np.ndarray:
+    """Determine which samples in a batch to stop sampling.
+
+    This is equivalent to SampleIsComplete(), but maintains running counts of
+    the depth tokens, rather than counting them in the whole sample for every
+    new token.
+    """
+    is_right = indices == self.right_index
+    self.batch_left_counts += indices == self.left_index
+    self.batch_right_counts += is_right
+    # A sample is complete when it ends with the depth decrease token and
+    # either the depth is balanced, or it descended into negative depth before
+    # reaching any depth increase token.
+    return is_right & ((self.batch_left_counts == 0) |
+                       (self.batch_left_counts == self.batch_right_counts))
+
+  def ResetSampleBatchRows(self, rows: np.ndarray) -> None:
+    """Restart samples in a batch from the start text."""
+    self.batch_left_counts[rows] = self.start_left_count
+    self.batch_right_counts[rows] = self.start_right_count
+
 
 def GetTerminationCriteria(
     config: typing.List[sampler_pb2.SampleTerminationCriterion]) \
@@ -254,6 +340,39 @@ class Sampler(object):
     """
     return any(t.SampleIsComplete(sample_in_progress) for t in self.terminators)
 
+  def InitSampleBatch(self, batch_size: int) -> None:
+    """Begin a batch of samples, which start with the encoded start text.
+
+    Args:
+      batch_size: The number of samples in the batch.
+    """
+    for terminator in self.terminators:
+      terminator.InitSampleBatch(self.encoded_start_text, batch_size)
+
+  def SampleBatchIsComplete(self, indices: np.ndarray) -> np.ndarray:
+    """Append a token to every sample in a batch and determine which are done.
+
+    Args:
+      indices: The vocabulary index of the next token of every sample.
+
+    Returns:
+      An array of bools, one per sample, which is True if the sample is
+      "complete".
+    """
+    done = np.zeros(len(indices), dtype=np.bool)
+    for terminator in self.terminators:
+      done |= terminator.SampleBatchIsComplete(indices)
+    return done
+
+  def ResetSampleBatchRows(self, rows: np.ndarray) -> None:
+    """Restart samples in a batch from the start text.
+
+    Args:
+      rows: The row numbers of the samples to restart.
+    """
+    for terminator in self.terminators:
+      terminator.ResetSampleBatchRows(rows)
+
   @staticmethod
   def _ComputeHash(config: sampler_pb2.Sampler) -> str:
     """Compute sampler hash.
@@ -270,3 +389,100 @@ class Sampler(object):
 
   def __ne__(self, rhs) -> bool:
     return not self.__eq__(rhs)
+
+
+class SampleBatch(object):
+  """A batch of samples in progress.
+
+  Samples are stored as a single array of vocabulary indices, with one row per
+  sample, and the termination criteria of the sampler are evaluated for the
+  whole batch at once. Samples are decoded to text only once complete. A
+  complete sample may be restarted using Reset(), so that a batch can be kept
+  full of samples in progress.
+  """
+
+  def __init__(self, sampler: Sampler, batch_size: int):
+    """Begin a batch of samples.
+
+    Args:
+      sampler: A specialized sampler.
+      batch_size: The number of samples in the batch.
+    """
+    sampler.InitSampleBatch(batch_size)
+    self.sampler = sampler
+    self.start_text = ''.join(sampler.tokenized_start_text)
+    self.num_start_tokens = len(sampler.tokenized_start_text)
+    self.done = np.zeros(batch_size, dtype=np.bool)
+    # The indices sampled so far, excluding the start text. Column j holds the
+    # j-th token appended to the batch. Sample i is the columns in the range
+    # [_starts[i], _ends[i]) of row i.
+    self._indices = np.zeros((batch_size, 256), dtype=np.int32)
+    self._length = 0
+    self._starts = np.zeros(batch_size, dtype=np.int64)
+    self._ends = np.zeros(batch_size, dtype=np.int64)
+
+  def Append(self, indices: typing.Iterable[int]) -> np.ndarray:
+    """Append the next token to every sample in the batch.
+
+    Args:
+      indices: The vocabulary index of the next token of every sample. Tokens
+        of samples which are already complete are ignored.
+
+    Returns:
+      The row numbers of the samples which were completed by this token.
+    """
+    indices = np.asarray(indices, dtype=np.int32)
+    if self._length == self._indices.shape[1]:
+      self._MakeRoom()
+    self._indices[:, self._length] = indices
+    self._length += 1
+    complete = self.sampler.SampleBatchIsComplete(indices) & ~self.done
+    self.done |= complete
+    self._ends[complete] = self._length
+    return np.flatnonzero(complete)
+
+  def Reset(self, rows: np.ndarray) -> None:
+    """Restart complete samples from the start text.
+
+    Args:
+      rows: The row numbers of the samples to restart.
+    """
+    self.done[rows] = False
+    self._starts[rows] = self._length
+    self.sampler.ResetSampleBatchRows(rows)
+
+  def GetNumTokens(self, i: int) -> int:
+    """Get the number of tokens in a complete sample, including start text."""
+    return self.num_start_tokens + int(self._ends[i] - self._starts[i])
+
+  def GetText(self, i: int, atomizer: atomizers.AtomizerBase) -> str:
+    """Decode a sample.
+
+    Args:
+      i: The row number of a complete sample.
+      atomizer: The atomizer which the sampler is specialized to.
+
+    Returns:
+      The sample text, including the start text.
+    """
+    return self.start_text + atomizer.DeatomizeIndices(
+        self._indices[i, self._starts[i]:self._ends[i]])
+
+  def _MakeRoom(self) -> None:
+    """Make room for another column of indices.
+
+    Columns which precede every sample in progress are discarded. If that does
+    not free at least half of the array, its size is doubled.
+    """
+    offset = self._starts[~self.done].min(initial=self._length)
+    num_columns = self._length - offset
+    size = self._indices.shape[1]
+    if num_columns > size // 2:
+      size *= 2
+    indices = np.zeros((len(self._indices), size), dtype=np.int32)
+    indices[:, :num_columns] = self._indices[:, offset:self._length]
+    self._indices = indices
+    self._length = num_columns
+    # Complete samples which began before the offset can no longer be decoded.
+    self._starts = np.maximum(self._starts - offset, 0)
+    self._ends = np.maximum(self._ends - offset, 0)
@@ -8,6 +8,7 @@ from absl import app
 
 from deeplearning.clgen import errors
 from deeplearning.clgen import samplers
+from deeplearning.clgen.corpuses import atomizers
 from deeplearning.clgen.proto import sampler_pb2
 
 
@@ -179,6 +180,101 @@ def test_SymmetrcalTokenDepthCriterion_SampleIsComplete_reverse_order():
   assert t.SampleIsComplete(['-', 'a', 'b', 'c', '+', '+', '-'])
 
 
+def test_SymmetricalTokenDepthCriterion_SampleBatchIsComplete_equivalence():
+  """Test that batched and unbatched criteria agree on random samples."""
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText('+-ab')
+  t = samplers.SymmetricalTokenDepthCriterion(sampler_pb2.SymmetricalTokenDepth(
+      depth_increase_token='+', depth_decrease_token='-'))
+  t.Specialize(atomizer)
+  start_text = atomizer.AtomizeString('a+')
+  samples = np.random.RandomState(0).randint(0, 4, (100, 20))
+  t.InitSampleBatch(start_text, len(samples))
+  for j in range(samples.shape[1]):
+    complete = t.SampleBatchIsComplete(samples[:, j])
+    for i in range(len(samples)):
+      tokens = atomizer.TokenizeString('a+') + [
+        atomizer.decoder[x] for x in samples[i, :j + 1]]
+      assert complete[i] == t.SampleIsComplete(tokens)
+
+
+def test_MaxlenTerminationCriterion_SampleBatchIsComplete():
+  """Test that batch is complete when maximum length is reached."""
+  t = samplers.MaxlenTerminationCriterion(
+      sampler_pb2.MaxTokenLength(maximum_tokens_in_sample=3))
+  t.InitSampleBatch(np.array([1]), 2)
+  assert not t.SampleBatchIsComplete(np.array([1, 2])).any()
+  assert t.SampleBatchIsComplete(np.array([1, 2])).all()
+
+
+# SampleBatch tests.
+
+def test_SampleBatch_Append(abc_sampler_config: sampler_pb2.Sampler):
+  """Test that samples are completed and decoded independently."""
+  abc_sampler_config.start_text = 'a'
+  abc_sampler_config.ClearField('termination_criteria')
+  abc_sampler_config.termination_criteria.add().symtok.CopyFrom(
+      sampler_pb2.SymmetricalTokenDepth(depth_increase_token='{',
+                                        depth_decrease_token='}'))
+  abc_sampler_config.termination_criteria.add().maxlen.CopyFrom(
+      sampler_pb2.MaxTokenLength(maximum_tokens_in_sample=5))
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText('ab{}')
+  s = samplers.Sampler(abc_sampler_config)
+  s.Specialize(atomizer)
+  batch = samplers.SampleBatch(s, 3)
+  # The next token of each of the three samples, at each step.
+  steps = ['{b}', '{{b', 'b}b', 'bbb']
+  completed = [list(batch.Append(atomizer.AtomizeString(step)))
+               for step in steps]
+  assert completed == [[2], [], [1], [0]]
+  assert batch.done.all()
+  assert batch.GetText(0, atomizer) == 'a{{bb'
+  assert batch.GetText(1, atomizer) == 'ab{}'
+  assert batch.GetText(2, atomizer) == 'a}'
+  assert batch.GetNumTokens(0) == 5
+  assert batch.GetNumTokens(2) == 2
+
+
+def test_SampleBatch_Reset(abc_sampler_config: sampler_pb2.Sampler):
+  """Test that a reset row starts a new sample while other rows continue."""
+  abc_sampler_config.start_text = 'a'
+  abc_sampler_config.ClearField('termination_criteria')
+  abc_sampler_config.termination_criteria.add().symtok.CopyFrom(
+      sampler_pb2.SymmetricalTokenDepth(depth_increase_token='{',
+                                        depth_decrease_token='}'))
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText('ab{}')
+  s = samplers.Sampler(abc_sampler_config)
+  s.Specialize(atomizer)
+  batch = samplers.SampleBatch(s, 2)
+  assert list(batch.Append(atomizer.AtomizeString('{{'))) == []
+  assert list(batch.Append(atomizer.AtomizeString('}b'))) == [0]
+  assert batch.GetText(0, atomizer) == 'a{}'
+  batch.Reset(np.array([0]))
+  assert not batch.done.any()
+  assert list(batch.Append(atomizer.AtomizeString('{}'))) == [1]
+  assert list(batch.Append(atomizer.AtomizeString('}b'))) == [0]
+  assert batch.GetText(0, atomizer) == 'a{}'
+  assert batch.GetText(1, atomizer) == 'a{b}'
+
+
+def test_SampleBatch_Reset_compaction(abc_sampler_config: sampler_pb2.Sampler):
+  """Test that long-running batches do not grow without bound."""
+  abc_sampler_config.start_text = 'a'
+  abc_sampler_config.ClearField('termination_criteria')
+  abc_sampler_config.termination_criteria.add().symtok.CopyFrom(
+      sampler_pb2.SymmetricalTokenDepth(depth_increase_token='{',
+                                        depth_decrease_token='}'))
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText('ab{}')
+  s = samplers.Sampler(abc_sampler_config)
+  s.Specialize(atomizer)
+  batch = samplers.SampleBatch(s, 1)
+  for _ in range(10000):
+    batch.Append(atomizer.AtomizeString('{'))
+    assert list(batch.Append(atomizer.AtomizeString('}'))) == [0]
+    assert batch.GetText(0, atomizer) == 'a{}'
+    batch.Reset(np.array([0]))
+  assert batch._indices.shape[1] <= 256
+
+
 # Sampler tests.
 
 def test_Sampler_config_type_error():
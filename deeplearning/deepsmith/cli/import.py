@@ -1,8 +1,22 @@
-"""A command-line interface for importing protos to the datastore."""
+"""A command-line interface for importing protos to the datastore.
+
+Importing is pipelined: a pool of worker processes parses the proto files and
+computes their digests and set IDs, while the main process adds the parsed
+protos to the datastore in large batches, using a single transaction per
+batch. Every worker is kept busy, but
+the number of parsed batches that may wait for the writer is bounded, so that
+a slow datastore does not cause parsed protos to accumulate in memory.
+
+If --import_checkpoint is set, the path of every file which is committed to the
+datastore is appended to the checkpoint file. Files listed in the checkpoint
+are skipped, so that an interrupted import can be resumed.
+"""
+import multiprocessing
 import pathlib
 import time
+import typing
 
-import progressbar
+import humanize
 from absl import app
 from absl import flags
 from absl import logging
@@ -11,6 +25,9 @@ import deeplearning.deepsmith.result
 import deeplearning.deepsmith.testcase
 from deeplearning.deepsmith import datastore
 from deeplearning.deepsmith import db
+from deeplearning.deepsmith.proto import deepsmith_pb2
+from labm8 import pbutil
+from labm8 import ppar
 
 
 FLAGS = flags.FLAGS
@@ -22,6 +39,154 @@ flags.DEFINE_string('testcases_dir', None,
                     'Directory containing testcase protos')
 flags.DEFINE_bool('delete_after_import', False,
                   'Delete the proto files after importing.')
+flags.DEFINE_integer('import_batch_size', 1000,
+                     'The number of protos to add to the datastore in a '
+                     'single transaction.')
+flags.DEFINE_integer('import_workers', None,
+                     'The number of processes used to parse protos. If not '
+                     'set, one process per CPU is used.')
+flags.DEFINE_integer('import_max_pending_batches', 4,
+                     'The maximum number of parsed batches which may be '
+                     'waiting to be added to the datastore, in addition to '
+                     'the batches being parsed.')
+flags.DEFINE_string('import_checkpoint', None,
+                    'Path of a file which records the protos that have been '
+                    'imported. Protos which are listed in this file are '
+                    'skipped.')
+
+
+# A parsed proto file, as a tuple of path, serialized proto, and the digest
+# of the proto which is computed by the table's Digest() method. If the file
+# cannot be parsed, the serialized proto and digest are None.
+parsed_proto_t = typing.Tuple[
+  pathlib.Path, typing.Optional[bytes],
+  typing.Optional[typing.Dict[str, typing.Any]]]
+
+
+def _ParseProtoFiles(
+    job: typing.Tuple[typing.List[str], typing.Type[pbutil.ProtocolBuffer],
+                      typing.Type[db.Table]]
+) -> typing.List[parsed_proto_t]:
+  """Parse a batch of proto files, and compute their digests.
+
+  This is the worker function of the parsing process pool. Parsed protos are
+  returned in their binary encoding, which is cheaper to transfer between
+  processes than the message objects.
+
+  Args:
+    job: A tuple of paths, the message class to parse them as, and the table
+      class to compute the digests of the messages using.
+
+  Returns:
+    A list of parsed protos.
+  """
+  paths, message_class, table = job
+  parsed = []
+  for path in paths:
+    try:
+      proto = pbutil.FromFile(pathlib.Path(path), message_class())
+      parsed.append((pathlib.Path(path), proto.SerializeToString(),
+                     table.Digest(proto)))
+    except (pbutil.DecodeError, OSError) as e:
+      logging.warning('Failed to parse %s: %s', path, e)
+      parsed.append((pathlib.Path(path), None, None))
+  return parsed
+
+
+def ParseProtoFiles(
+    pool: multiprocessing.Pool, num_workers: int,
+    paths: typing.List[pathlib.Path],
+    message_class: typing.Type[pbutil.ProtocolBuffer],
+    table: typing.Type[db.Table], batch_size: int,
+    max_pending_batches: int) -> typing.Iterator[typing.List[parsed_proto_t]]:
+  """Parse proto files in parallel, yielding batches in order.
+
+  At most num_workers + max_pending_batches batches are scheduled ahead of the
+  consumer, so that every worker has a batch to parse while up to
+  max_pending_batches parsed batches wait to be consumed.
+
+  Args:
+    pool: The process pool to parse protos in.
+    num_workers: The number of processes in the pool.
+    paths: The paths of the proto files.
+    message_class: The message class to parse the files as.
+    table: The table class to compute the digests of the messages using. This
+      must provide a Digest() method.
+    batch_size: The number of files per batch.
+    max_pending_batches: The maximum number of parsed batches which may be
+      waiting to be consumed.
+
+  Returns:
+    An iterator over batches of parsed protos.
+  """
+  jobs = (([str(p) for p in paths[i:i + batch_size]], message_class, table)
+          for i in range(0, len(paths), batch_size))
+  return ppar.BoundedMap(_ParseProtoFiles, jobs, pool,
+                         max_pending=num_workers + max_pending_batches)
+
+
+def ReadCheckpoint(path: typing.Optional[pathlib.Path]) -> typing.Set[str]:
+  """Read the paths of the files which have already been imported.
+
+  Args:
+    path: The path of the checkpoint file, or None.
+
+  Returns:
+    A set of absolute paths.
+  """
+  if not path or not path.is_file():
+    return set()
+  with open(path) as f:
+    return set(line.rstrip('\n') for line in f if line.strip())
+
+
+def ImportProtos(session: db.session_t, paths: typing.List[pathlib.Path],
+                 message_class: typing.Type[pbutil.ProtocolBuffer],
+                 table: typing.Type[db.Table]) -> None:
+  """Import protos from files.
+
+  Args:
+    session: A database session.
+    paths: The paths of the proto files.
+    message_class: The message class to parse the files as.
+    table: The table class to add the protos to. This must provide
+      GetOrAddMany() and Digest() methods.
+  """
+  checkpoint = pathlib.Path(
+      FLAGS.import_checkpoint) if FLAGS.import_checkpoint else None
+  imported = ReadCheckpoint(checkpoint)
+  paths = [p for p in paths if str(p.absolute()) not in imported]
+  if imported:
+    logging.info('Skipping %s protos which are listed in the checkpoint',
+                 humanize.intcomma(len(imported)))
+
+  start_time = time.time()
+  num_imported = 0
+  num_workers = FLAGS.import_workers or multiprocessing.cpu_count()
+  with multiprocessing.Pool(num_workers) as pool:
+    for batch in ParseProtoFiles(pool, num_workers, paths, message_class,
+                                 table, FLAGS.import_batch_size,
+                                 FLAGS.import_max_pending_batches):
+      batch = [(path, s, digest) for path, s, digest in batch if s is not None]
+      protos = [message_class.FromString(s) for _, s, _ in batch]
+      table.GetOrAddMany(session, protos, [digest for _, _, digest in batch])
+      session.commit()
+
+      committed = [path for path, _, _ in batch]
+      if checkpoint:
+        with open(checkpoint, 'a') as f:
+          for path in committed:
+            f.write(f'{path.absolute()}\n')
+      if FLAGS.delete_after_import:
+        for path in committed:
+          path.unlink()
+
+      num_imported += len(protos)
+      elapsed = time.time() - start_time
+      logging.info('Imported %s of %s %s protos (%.1f protos/s)',
+                   humanize.intcomma(num_imported),
+                   humanize.intcomma(len(paths)), message_class.__name__,
+                   num_imported / elapsed if elapsed else 0)
 
 
 def ImportResultsFromDirectory(session: db.session_t,
@@ -32,26 +197,10 @@ def ImportResultsFromDirectory(session: db.session_t,
     session: A database session.
     results_dir: Directory containing (only) Result protos.
   """
-  files_to_delete = []
-  last_commit_time = time.time()
   if not results_dir.is_dir():
     logging.fatal('directory %s does not exist', results_dir)
-  for path in progressbar.ProgressBar()(results_dir.iterdir()):
-    deeplearning.deepsmith.result.Result.FromFile(session, path)
-    files_to_delete.append(path)
-    logging.info('Imported result %s', path)
-    if time.time() - last_commit_time > 10:
-      session.commit()
-      if FLAGS.delete_after_import:
-        for path in files_to_delete:
-          path.unlink()
-      files_to_delete = []
-      last_commit_time = time.time()
-      logging.info('Committed database')
-  session.commit()
-  if FLAGS.delete_after_import:
-    for path in files_to_delete:
-      path.unlink()
+  ImportProtos(session, sorted(results_dir.iterdir()), deepsmith_pb2.Result,
+               deeplearning.deepsmith.result.Result)
 
 
 def ImportTestcasesFromDirectory(session: db.session_t,
@@ -62,44 +211,25 @@ def ImportTestcasesFromDirectory(session: db.session_t,
     session: A database session.
     testcases_dir: Directory containing (only) Testcase protos.
   """
-  files_to_delete = []
-  last_commit_time = time.time()
   if not testcases_dir.is_dir():
     logging.fatal('directory %s does not exist', testcases_dir)
-  for path in progressbar.ProgressBar()(testcases_dir.iterdir()):
-    deeplearning.deepsmith.testcase.Testcase.FromFile(session, path)
-    files_to_delete.append(path)
-    logging.info('Imported testcase %s', path)
-    if time.time() - last_commit_time > 10:
-      session.commit()
-      if FLAGS.delete_after_import:
-        for path in files_to_delete:
-          path.unlink()
-      files_to_delete = []
-      last_commit_time = time.time()
-      logging.info('Committed database')
-  session.commit()
-  if FLAGS.delete_after_import:
-    for path in files_to_delete:
-      path.unlink()
+  ImportProtos(session, sorted(testcases_dir.iterdir()),
+               deepsmith_pb2.Testcase, deeplearning.deepsmith.testcase.Testcase)
 
 
 def main(argv):
   del argv
   ds = datastore.DataStore.FromFlags()
   with ds.Session(commit=True) as session:
-    last_commit_time = time.time()
-    for path in FLAGS.results:
-      deeplearning.deepsmith.result.Result.FromFile(session, pathlib.Path(path))
-      if time.time() - last_commit_time > 10:
-        session.commit()
-        last_commit_time = time.time()
+    if FLAGS.results:
+      ImportProtos(session, [pathlib.Path(p) for p in FLAGS.results],
+                   deepsmith_pb2.Result, deeplearning.deepsmith.result.Result)
     if FLAGS.results_dir:
       ImportResultsFromDirectory(session, pathlib.Path(FLAGS.results_dir))
-    for path in FLAGS.testcases:
-      deeplearning.deepsmith.testcase.Testcase.FromFile(
-          session, pathlib.Path(path))
-    session.commit()
+    if FLAGS.testcases:
+      ImportProtos(session, [pathlib.Path(p) for p in FLAGS.testcases],
+                   deepsmith_pb2.Testcase,
+                   deeplearning.deepsmith.testcase.Testcase)
     if FLAGS.testcases_dir:
       ImportTestcasesFromDirectory(session, pathlib.Path(FLAGS.testcases_dir))
 
@@ -0,0 +1,175 @@
+"""Unit tests for //deeplearning/deepsmith/cli:import."""
+import importlib
+import multiprocessing
+import pathlib
+import sys
+import tempfile
+import typing
+
+import pytest
+from absl import app
+from absl import flags
+
+import deeplearning.deepsmith.result
+import deeplearning.deepsmith.testcase
+from deeplearning.deepsmith import datastore
+from deeplearning.deepsmith.proto import deepsmith_pb2
+from labm8 import pbutil
+
+
+# The module name is a reserved word, so it cannot be imported by a statement.
+import_ = importlib.import_module('deeplearning.deepsmith.cli.import')
+
+FLAGS = flags.FLAGS
+
+
+@pytest.fixture(scope='function')
+def tempdir() -> pathlib.Path:
+  """A pytest fixture for a temporary directory."""
+  with tempfile.TemporaryDirectory(prefix='phd_') as d:
+    yield pathlib.Path(d)
+
+
+@pytest.fixture(scope='function')
+def import_flags(tempdir: pathlib.Path):
+  """A pytest fixture which sets the import flags for testing.
+
+  The original flag values are restored afterwards.
+  """
+  names = ['import_batch_size', 'import_workers', 'import_checkpoint',
+           'delete_after_import']
+  original_values = {name: getattr(FLAGS, name) for name in names}
+  FLAGS.import_batch_size = 2
+  FLAGS.import_workers = 2
+  FLAGS.import_checkpoint = str(tempdir / 'checkpoint.txt')
+  yield
+  for name, value in original_values.items():
+    setattr(FLAGS, name, value)
+
+
+def _WriteTestcases(directory: pathlib.Path, testcase_factory,
+                    n: int) -> None:
+  directory.mkdir()
+  for i in range(n):
+    pbutil.ToFile(testcase_factory.Testcase(i), directory / f'{i:02d}.pbtxt')
+
+
+def _ImportTestcases(ds: datastore.DataStore, directory: pathlib.Path) -> None:
+  with ds.Session(commit=True) as session:
+    import_.ImportTestcasesFromDirectory(session, directory)
+
+
+def _Sources(ds: datastore.DataStore, testcase_factory) -> typing.Set[str]:
+  with ds.Session() as session:
+    return set(testcase_factory.Sources(t.ToProto() for t in session.query(
+        deeplearning.deepsmith.testcase.Testcase)))
+
+
+def test_ParseProtoFiles_order(tempdir: pathlib.Path, testcase_factory):
+  """Test that batches are yielded in order of paths."""
+  _WriteTestcases(tempdir / 'testcases', testcase_factory, 9)
+  paths = sorted((tempdir / 'testcases').iterdir())
+  with multiprocessing.Pool(2) as pool:
+    batches = list(import_.ParseProtoFiles(
+        pool, 2, paths, deepsmith_pb2.Testcase,
+        deeplearning.deepsmith.testcase.Testcase, 2, 1))
+  assert [len(batch) for batch in batches] == [2, 2, 2, 2, 1]
+  assert [path for batch in batches for path, _, _ in batch] == paths
+  assert (deepsmith_pb2.Testcase.FromString(batches[0][1][1]) ==
+          testcase_factory.Testcase(1))
+
+
+def test_ParseProtoFiles_digests(tempdir: pathlib.Path, testcase_factory):
+  """Test that the digests of the protos are computed by the workers."""
+  _WriteTestcases(tempdir / 'testcases', testcase_factory, 2)
+  paths = sorted((tempdir / 'testcases').iterdir())
+  with multiprocessing.Pool(2) as pool:
+    batches = list(import_.ParseProtoFiles(
+        pool, 2, paths, deepsmith_pb2.Testcase,
+        deeplearning.deepsmith.testcase.Testcase, 2, 1))
+  assert [digest for _, _, digest in batches[0]] == [
+    deeplearning.deepsmith.testcase.Testcase.Digest(
+        testcase_factory.Testcase(i)) for i in range(2)]
+
+
+def test_ImportProtos(ds: datastore.DataStore, tempdir: pathlib.Path,
+                      import_flags, testcase_factory):
+  """Test that protos are imported."""
+  _WriteTestcases(tempdir / 'testcases', testcase_factory, 5)
+  _ImportTestcases(ds, tempdir / 'testcases')
+  assert _Sources(ds, testcase_factory) == set(
+      testcase_factory.Source(i) for i in range(5))
+
+
+def test_ImportProtos_results(ds: datastore.DataStore, tempdir: pathlib.Path,
+                              import_flags, testcase_factory):
+  """Test that results and their testcases are imported."""
+  (tempdir / 'results').mkdir()
+  for i in range(3):
+    pbutil.ToFile(deepsmith_pb2.Result(
+        testcase=testcase_factory.Testcase(i),
+        testbed=deepsmith_pb2.Testbed(toolchain='opencl', name='cpu'),
+        outputs={'stdout': str(i)}), tempdir / 'results' / f'{i:02d}.pbtxt')
+  with ds.Session(commit=True) as session:
+    import_.ImportResultsFromDirectory(session, tempdir / 'results')
+  assert _Sources(ds, testcase_factory) == set(
+      testcase_factory.Source(i) for i in range(3))
+  with ds.Session() as session:
+    assert set(r.ToProto().outputs['stdout'] for r in session.query(
+        deeplearning.deepsmith.result.Result)) == {'0', '1', '2'}
+
+
+def test_ImportProtos_unparseable_file_skipped(ds: datastore.DataStore,
+                                               tempdir: pathlib.Path,
+                                               import_flags, testcase_factory):
+  """Test that a file which cannot be parsed is skipped, and not recorded."""
+  _WriteTestcases(tempdir / 'testcases', testcase_factory, 3)
+  (tempdir / 'testcases' / '01.pbtxt').write_text('not a proto')
+  _ImportTestcases(ds, tempdir / 'testcases')
+
+  assert _Sources(ds, testcase_factory) == set(
+      testcase_factory.Source(i) for i in (0, 2))
+  assert import_.ReadCheckpoint(tempdir / 'checkpoint.txt') == {
+    str((tempdir / 'testcases' / name).absolute())
+    for name in ('00.pbtxt', '02.pbtxt')}
+
+
+def test_ImportProtos_checkpoint_round_trip(ds: datastore.DataStore,
+                                            tempdir: pathlib.Path,
+                                            import_flags, testcase_factory):
+  """Test that files listed in the checkpoint are not imported again."""
+  _WriteTestcases(tempdir / 'testcases', testcase_factory, 3)
+  _ImportTestcases(ds, tempdir / 'testcases')
+  assert len(import_.ReadCheckpoint(tempdir / 'checkpoint.txt')) == 3
+
+  # Change an imported file, and add a new file. Only the new file is
+  # imported.
+  pbutil.ToFile(testcase_factory.Testcase(10),
+                tempdir / 'testcases' / '00.pbtxt')
+  pbutil.ToFile(testcase_factory.Testcase(3),
+                tempdir / 'testcases' / '03.pbtxt')
+  _ImportTestcases(ds, tempdir / 'testcases')
+
+  assert _Sources(ds, testcase_factory) == set(
+      testcase_factory.Source(i) for i in range(4))
+  assert len(import_.ReadCheckpoint(tempdir / 'checkpoint.txt')) == 4
+
+
+def test_ImportProtos_delete_after_import(ds: datastore.DataStore,
+                                          tempdir: pathlib.Path,
+                                          import_flags, testcase_factory):
+  """Test that imported files are deleted, and unparseable files kept."""
+  _WriteTestcases(tempdir / 'testcases', testcase_factory, 3)
+  (tempdir / 'testcases' / '01.pbtxt').write_text('not a proto')
+  FLAGS.delete_after_import = True
+  _ImportTestcases(ds, tempdir / 'testcases')
+  assert [p.name for p in (tempdir / 'testcases').iterdir()] == ['01.pbtxt']
+
+
+def main(argv):  # pylint: disable=missing-docstring
+  del argv
+  sys.exit(pytest.main([__file__, '-v']))
+
+
+if __name__ == '__main__':
+  app.run(main)
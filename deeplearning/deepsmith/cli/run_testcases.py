@@ -1,5 +1,17 @@
-import collections
+"""Run testcases from a datastore on a harness, and submit the results.
+
+Every testbed of the harness is driven concurrently, by a pipeline of three
+threads: one fetches batches of testcases from the datastore, one runs them on
+the harness, and one submits the results to the datastore. The stages are
+connected by bounded queues, so that the next batch of testcases is fetched and
+the previous batch of results is submitted while the harness is busy, without
+fetching an unbounded number of testcases ahead.
+"""
+import queue
+import threading
+import time
 import typing
+from concurrent import futures
 
 from absl import app
 from absl import flags
@@ -29,6 +41,11 @@ flags.DEFINE_integer(
 flags.DEFINE_integer(
     'harness_batch_size', 100,
     'The number of results to collect in each batch.')
+flags.DEFINE_integer(
+    'harness_max_pending_batches', 2,
+    'The maximum number of batches of testcases which are fetched ahead of '
+    'the harness, and of batches of results waiting to be submitted, per '
+    'testbed.')
 
 
 def GetHarnessCapabilities(
@@ -63,7 +80,6 @@ def GetNumberOfTestcases(
   request = services.BuildDefaultRequest(datastore_pb2.GetTestcasesRequest)
   request.return_total_matching_count = True
   request.return_testcases = False
-  request.mark_pending_results = False
   request.include_testcases_with_results = True
   request.include_testcases_with_pending_results = True
   request.toolchain = testbed.toolchain
@@ -84,12 +100,15 @@ def GetTestcasesToRun(
         datastore_stub, harness, testbed)
     total_testcases = GetNumberOfTestcases(
         datastore_stub, harness, testbed)
-    batch_size = min(batch_size, total_results - total_testcases)
+    # There cannot be more results than testcases.
+    target_total_results = min(target_total_results, total_testcases)
+    batch_size = min(batch_size, target_total_results - total_results)
+    if batch_size <= 0:
+      return []
 
   request = services.BuildDefaultRequest(datastore_pb2.GetTestcasesRequest)
   request.toolchain = testbed.toolchain
   request.harness.CopyFrom(harness)
-  request.testbed.CopyFrom(testbed)
   request.max_num_testcases_to_return = batch_size
   request.mark_results_pending.extend([testbed])
   response = datastore_stub.GetTestcases(request)
@@ -115,15 +134,191 @@ def SubmitResults(
     results: typing.List[deepsmith_pb2.Result]) -> None:
   request = services.BuildDefaultRequest(datastore_pb2.SubmitResultsRequest)
   request.results.extend(results)
-  response = datastore_stub.SubmitTestcases(request)
+  response = datastore_stub.SubmitResults(request)
   services.AssertResponseStatus(response.status)
 
 
+def _IsRunning(thread: threading.Thread) -> bool:
+  """Return whether a thread has not yet finished.
+
+  A thread which has not yet been started counts as running, so that a stage
+  does not mistake a neighbour which is still starting for one which has
+  exited.
+  """
+  return thread.ident is None or thread.is_alive()
+
+
+def _Put(queue_: queue.Queue, item: typing.Any,
+         consumer: threading.Thread) -> bool:
+  """Put an item on a queue, unless the consumer of the queue has exited.
+
+  Returns:
+    True if the item was put on the queue, else False.
+  """
+  while _IsRunning(consumer):
+    try:
+      queue_.put(item, timeout=1)
+      return True
+    except queue.Full:
+      pass
+  return False
+
+
+def _Get(queue_: queue.Queue, producer: threading.Thread) -> typing.Any:
+  """Get an item from a queue, unless the producer of the queue has exited.
+
+  Returns:
+    The item, or None if the queue is empty and the producer has exited.
+  """
+  while True:
+    try:
+      return queue_.get(timeout=1)
+    except queue.Empty:
+      if not _IsRunning(producer):
+        try:
+          return queue_.get_nowait()
+        except queue.Empty:
+          return None
+
+
+class TestbedRunner(object):
+  """Runs testcases on a single testbed until there are none left.
+
+  Each of the fetch, run, and submit stages runs in its own thread. A stage
+  passes None to the next stage once it has finished. If a stop is requested,
+  no more testcases are fetched or run, but the results of testcases which
+  have already been run are still submitted.
+
+  If a target number of results is set, the size of each batch depends on the
+  number of results in the datastore. Testcases are then not fetched ahead of
+  the harness: the next batch is fetched once the results of the previous
+  batch have been submitted, so that the target is not overshot.
+  """
+
+  def __init__(self, datastore_stub: datastore_pb2_grpc.DataStoreServiceStub,
+               harness_stub: harness_pb2_grpc.HarnessServiceStub,
+               harness: deepsmith_pb2.Harness,
+               testbed: deepsmith_pb2.Testbed,
+               target_total_results: int, batch_size: int,
+               max_pending_batches: int, stop_event: threading.Event):
+    """Instantiate a testbed runner.
+
+    Args:
+      datastore_stub: The datastore to fetch testcases from and submit
+        results to.
+      harness_stub: The harness to run testcases on.
+      harness: The harness description.
+      testbed: The testbed to run testcases on.
+      target_total_results: The number of results to collect, or a negative
+        value to collect results for all testcases.
+      batch_size: The number of testcases to run in each batch.
+      max_pending_batches: The maximum number of batches queued between
+        stages.
+      stop_event: An event which is set to request a stop. The runner sets
+        it if a stage fails, so that a single event stops all runners.
+    """
+    self.datastore_stub = datastore_stub
+    self.harness_stub = harness_stub
+    self.harness = harness
+    self.testbed = testbed
+    self.target_total_results = target_total_results
+    self.batch_size = batch_size
+    self.stop_event = stop_event
+    self.num_results = 0
+    self.harness_seconds = 0
+    self._testcases = queue.Queue(max_pending_batches)
+    self._results = queue.Queue(max_pending_batches)
+    self._error: typing.Optional[Exception] = None
+    self._fetch_slot = (threading.Semaphore(1) if target_total_results >= 0
+                        else None)
+    self._fetch_thread = threading.Thread(
+        target=self._Stage, args=(self._Fetch,))
+    self._run_thread = threading.Thread(target=self._Stage, args=(self._Run,))
+    self._submit_thread = threading.Thread(
+        target=self._Stage, args=(self._Submit,))
+
+  def Run(self) -> None:
+    """Run testcases until there are none left, or a stop is requested.
+
+    Raises:
+      Exception: If any of the stages fail.
+    """
+    start_time = time.time()
+    threads = [self._fetch_thread, self._run_thread, self._submit_thread]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    elapsed = time.time() - start_time
+    logging.info('Submitted %d results for %s. Harness utilization: %.1f%%',
+                 self.num_results, self.testbed.name,
+                 100 * self.harness_seconds / elapsed if elapsed else 0)
+    if self._error:
+      raise self._error
+
+  def _Stage(self, stage: typing.Callable[[], None]) -> None:
+    try:
+      stage()
+    except Exception as e:
+      logging.error('Error on %s: %s', self.testbed.name, e)
+      self._error = self._error or e
+      self.stop_event.set()
+
+  def _AcquireFetchSlot(self) -> bool:
+    """Wait until the results of the previous batch have been submitted.
+
+    Returns:
+      True if the next batch may be fetched, or False if a stop was requested.
+    """
+    while not self.stop_event.is_set():
+      if self._fetch_slot.acquire(timeout=1):
+        return True
+    return False
+
+  def _Fetch(self) -> None:
+    while not self.stop_event.is_set():
+      if self._fetch_slot and not self._AcquireFetchSlot():
+        break
+      testcases = GetTestcasesToRun(
+          self.datastore_stub, self.harness, self.testbed,
+          self.target_total_results, self.batch_size)
+      logging.info('Received %d testcases to execute on %s', len(testcases),
+                   self.testbed.name)
+      if not testcases or not _Put(self._testcases, testcases,
+                                   self._run_thread):
+        break
+    _Put(self._testcases, None, self._run_thread)
+
+  def _Run(self) -> None:
+    while not self.stop_event.is_set():
+      testcases = _Get(self._testcases, self._fetch_thread)
+      if testcases is None:
+        break
+      start_time = time.time()
+      results = RunTestcases(self.harness_stub, self.testbed, testcases)
+      self.harness_seconds += time.time() - start_time
+      if not _Put(self._results, results, self._submit_thread):
+        break
+    _Put(self._results, None, self._submit_thread)
+
+  def _Submit(self) -> None:
+    while True:
+      results = _Get(self._results, self._run_thread)
+      if results is None:
+        break
+      SubmitResults(self.datastore_stub, results)
+      self.num_results += len(results)
+      if self._fetch_slot:
+        self._fetch_slot.release()
+
+
 def main(argv):
   if len(argv) > 1:
     raise app.UsageError('Unrecognized arguments')
   if FLAGS.harness_batch_size <= 0:
     raise app.UsageError('--harness_batch_size must be positive')
+  if FLAGS.harness_max_pending_batches <= 0:
+    raise app.UsageError('--harness_max_pending_batches must be positive')
   datastore_config = services.ServiceConfigFromFlag(
       'datastore_config', datastore_pb2.DataStore())
   harness_config = services.ServiceConfigFromFlag(
@@ -134,27 +329,25 @@ def main(argv):
   harness_stub = services.GetServiceStub(
       harness_config, harness_pb2_grpc.HarnessServiceStub)
 
-  target_total_results = FLAGS.target_total_results
-  harness_batch_size = FLAGS.harness_batch_size
   capabilities = GetHarnessCapabilities(harness_stub)
-  testbeds = collections.deque(capabilities.testbeds)
-  if testbeds:
-    logging.info('%d testbeds: %s', len(capabilities.testbeds),
-                 ', '.join(x.name for x in capabilities.testbeds))
-    while testbeds:
-      testbed = testbeds.popleft()
-      testcases = GetTestcasesToRun(
-          datastore_stub, capabilities.harness, testbed, target_total_results,
-          harness_batch_size)
-      logging.info(
-          'Received %d testcases to execute on %s', len(testcases),
-          testbed.name)
-      if testcases:
-        results = RunTestcases(harness_stub, testbed, testcases)
-        SubmitResults(datastore_stub, results)
-        # If there are testcases to run, then we add it back to the testbeds
-        # queue, as there may be more.
-        testbeds.append(testbed)
+  if capabilities.testbed:
+    logging.info('%d testbeds: %s', len(capabilities.testbed),
+                 ', '.join(x.name for x in capabilities.testbed))
+    stop_event = threading.Event()
+    runners = [TestbedRunner(
+        datastore_stub, harness_stub, capabilities.harness, testbed,
+        FLAGS.target_total_results, FLAGS.harness_batch_size,
+        FLAGS.harness_max_pending_batches, stop_event)
+      for testbed in capabilities.testbed]
+    with futures.ThreadPoolExecutor(len(runners)) as executor:
+      runs = [executor.submit(runner.Run) for runner in runners]
+      try:
+        for run in futures.as_completed(runs):
+          run.result()
+      except KeyboardInterrupt:
+        logging.info('Interrupted, submitting pending results')
+        stop_event.set()
+        raise
     logging.info('done')
   else:
     logging.warning('No testbeds, nothing to do!')
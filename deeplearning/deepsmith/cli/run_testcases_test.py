@@ -0,0 +1,264 @@
+"""Unit tests for //deeplearning/deepsmith/cli:run_testcases."""
+import sys
+import threading
+import typing
+
+import pytest
+from absl import app
+from absl import flags
+
+from deeplearning.deepsmith import services
+from deeplearning.deepsmith.cli import run_testcases
+from deeplearning.deepsmith.proto import datastore_pb2
+from deeplearning.deepsmith.proto import deepsmith_pb2
+from deeplearning.deepsmith.proto import harness_pb2
+
+
+FLAGS = flags.FLAGS
+
+
+class MockDataStoreStub(object):
+  """A datastore stub which serves a fixed list of testcases in batches.
+
+  The fetching and submitting of batches is recorded in the events list.
+  """
+
+  def __init__(self, num_testcases: int):
+    self.testcases = [
+      deepsmith_pb2.Testcase(toolchain='opencl', inputs={'src': str(i)})
+      for i in range(num_testcases)]
+    self.num_testcases = num_testcases
+    self.submitted: typing.List[typing.List[deepsmith_pb2.Result]] = []
+    self.get_testcases_count = 0
+    self.events: typing.List[str] = []
+
+  def GetTestcases(self, request: datastore_pb2.GetTestcasesRequest
+                   ) -> datastore_pb2.GetTestcasesResponse:
+    response = services.BuildDefaultResponse(
+        datastore_pb2.GetTestcasesResponse)
+    # Count requests, as sent by GetNumberOfResultsForTestbed() and
+    # GetNumberOfTestcases().
+    if isinstance(request, datastore_pb2.GetResultsRequest):
+      response.total_matching_count = sum(len(x) for x in self.submitted)
+      return response
+    if not request.return_testcases:
+      response.total_matching_count = self.num_testcases
+      return response
+    self.get_testcases_count += 1
+    self.events.append('fetch')
+    batch = self.testcases[:request.max_num_testcases_to_return]
+    self.testcases = self.testcases[request.max_num_testcases_to_return:]
+    response.testcases.extend(batch)
+    return response
+
+  def SubmitResults(self, request: datastore_pb2.SubmitResultsRequest
+                    ) -> datastore_pb2.SubmitResultsResponse:
+    self.submitted.append(list(request.results))
+    self.events.append('submit')
+    return services.BuildDefaultResponse(datastore_pb2.SubmitResultsResponse)
+
+
+class MockHarnessStub(object):
+  """A harness stub which returns one result per testcase.
+
+  If a callback is provided, it is called with the number of the batch before
+  the batch is run.
+  """
+
+  def __init__(self, callback: typing.Optional[
+    typing.Callable[[int], None]] = None):
+    self.callback = callback
+    self.run_testcases_count = 0
+
+  def RunTestcases(self, request: harness_pb2.RunTestcasesRequest
+                   ) -> harness_pb2.RunTestcasesResponse:
+    self.run_testcases_count += 1
+    if self.callback:
+      self.callback(self.run_testcases_count)
+    response = services.BuildDefaultResponse(harness_pb2.RunTestcasesResponse)
+    for testcase in request.testcases:
+      result = response.results.add()
+      result.testcase.CopyFrom(testcase)
+      result.testbed.CopyFrom(request.testbed)
+      result.outcome = deepsmith_pb2.Result.PASS
+    return response
+
+
+def _MakeRunner(datastore_stub: MockDataStoreStub,
+                harness_stub: MockHarnessStub,
+                stop_event: threading.Event,
+                target_total_results: int = -1) -> run_testcases.TestbedRunner:
+  return run_testcases.TestbedRunner(
+      datastore_stub, harness_stub, deepsmith_pb2.Harness(name='cldrive'),
+      deepsmith_pb2.Testbed(name='testbed', toolchain='opencl'),
+      target_total_results=target_total_results, batch_size=3,
+      max_pending_batches=1, stop_event=stop_event)
+
+
+def _Srcs(batches: typing.List[typing.List[deepsmith_pb2.Result]]
+          ) -> typing.List[typing.List[str]]:
+  return [[r.testcase.inputs['src'] for r in batch] for batch in batches]
+
+
+def test_TestbedRunner_Run_results_submitted_in_order():
+  """Test that every testcase is run, and results are submitted in order."""
+  datastore_stub = MockDataStoreStub(10)
+  harness_stub = MockHarnessStub()
+  stop_event = threading.Event()
+  runner = _MakeRunner(datastore_stub, harness_stub, stop_event)
+  runner.Run()
+  assert _Srcs(datastore_stub.submitted) == [
+    ['0', '1', '2'], ['3', '4', '5'], ['6', '7', '8'], ['9']]
+  assert all(r.testbed.name == 'testbed'
+             for batch in datastore_stub.submitted for r in batch)
+  assert runner.num_results == 10
+  assert not stop_event.is_set()
+
+
+def test_TestbedRunner_Run_target_total_results():
+  """Test that no more than the target number of results are collected, and
+  that testcases are not fetched ahead of the harness."""
+  datastore_stub = MockDataStoreStub(10)
+  harness_stub = MockHarnessStub(lambda _: datastore_stub.events.append('run'))
+  stop_event = threading.Event()
+  runner = _MakeRunner(datastore_stub, harness_stub, stop_event,
+                       target_total_results=7)
+  runner.Run()
+  assert _Srcs(datastore_stub.submitted) == [
+    ['0', '1', '2'], ['3', '4', '5'], ['6']]
+  assert datastore_stub.events == ['fetch', 'run', 'submit'] * 3
+  assert runner.num_results == 7
+
+
+def test_TestbedRunner_Run_target_total_results_reached():
+  """Test that no testcases are fetched once the target has been reached."""
+  datastore_stub = MockDataStoreStub(10)
+  datastore_stub.submitted = [[deepsmith_pb2.Result()] * 5]
+  harness_stub = MockHarnessStub()
+  stop_event = threading.Event()
+  runner = _MakeRunner(datastore_stub, harness_stub, stop_event,
+                       target_total_results=5)
+  runner.Run()
+  assert datastore_stub.get_testcases_count == 0
+  assert runner.num_results == 0
+
+
+def test_TestbedRunner_Run_no_testcases():
+  """Test that the runner exits when there are no testcases to run."""
+  datastore_stub = MockDataStoreStub(0)
+  harness_stub = MockHarnessStub()
+  stop_event = threading.Event()
+  runner = _MakeRunner(datastore_stub, harness_stub, stop_event)
+  runner.Run()
+  assert datastore_stub.get_testcases_count == 1
+  assert harness_stub.run_testcases_count == 0
+  assert not datastore_stub.submitted
+  assert runner.num_results == 0
+
+
+def test_TestbedRunner_Run_stopped_before_start():
+  """Test that no testcases are fetched once a stop has been requested."""
+  datastore_stub = MockDataStoreStub(10)
+  harness_stub = MockHarnessStub()
+  stop_event = threading.Event()
+  stop_event.set()
+  runner = _MakeRunner(datastore_stub, harness_stub, stop_event)
+  runner.Run()
+  assert datastore_stub.get_testcases_count == 0
+  assert harness_stub.run_testcases_count == 0
+  assert not datastore_stub.submitted
+
+
+def test_TestbedRunner_Run_harness_error():
+  """Test that a harness error stops the runner, and is raised by Run()."""
+
+  def Callback(batch_num: int) -> None:
+    if batch_num == 2:
+      raise ValueError('harness failed')
+
+  datastore_stub = MockDataStoreStub(10)
+  harness_stub = MockHarnessStub(Callback)
+  stop_event = threading.Event()
+  runner = _MakeRunner(datastore_stub, harness_stub, stop_event)
+  with pytest.raises(ValueError) as e_info:
+    runner.Run()
+  assert str(e_info.value) == 'harness failed'
+  assert stop_event.is_set()
+  assert harness_stub.run_testcases_count == 2
+  # The results of the batch run before the error are still submitted.
+  assert _Srcs(datastore_stub.submitted) == [['0', '1', '2']]
+  assert runner.num_results == 3
+
+
+def test_TestbedRunner_Run_submit_error():
+  """Test that a datastore error stops the runner, and is raised by Run()."""
+
+  class FailingDataStoreStub(MockDataStoreStub):
+
+    def SubmitResults(self, request):
+      raise OSError('datastore failed')
+
+  datastore_stub = FailingDataStoreStub(10)
+  harness_stub = MockHarnessStub()
+  stop_event = threading.Event()
+  runner = _MakeRunner(datastore_stub, harness_stub, stop_event)
+  with pytest.raises(OSError) as e_info:
+    runner.Run()
+  assert str(e_info.value) == 'datastore failed'
+  assert stop_event.is_set()
+  # No more than the batches which fit in the queues are run.
+  assert harness_stub.run_testcases_count < 4
+  assert runner.num_results == 0
+
+
+def test_TestbedRunner_Run_stop_submits_pending_results():
+  """Test that results which have already been computed are submitted after a
+  stop is requested, but no further testcases are run."""
+  stop_event = threading.Event()
+
+  def Callback(batch_num: int) -> None:
+    if batch_num == 2:
+      stop_event.set()
+
+  datastore_stub = MockDataStoreStub(10)
+  harness_stub = MockHarnessStub(Callback)
+  runner = _MakeRunner(datastore_stub, harness_stub, stop_event)
+  runner.Run()
+  assert harness_stub.run_testcases_count == 2
+  assert _Srcs(datastore_stub.submitted) == [['0', '1', '2'], ['3', '4', '5']]
+  assert runner.num_results == 6
+
+
+def test_TestbedRunner_Run_stop_shared_between_runners():
+  """Test that an error on one runner stops every runner sharing the event."""
+  stop_event = threading.Event()
+  started = threading.Event()
+
+  def FailingCallback(batch_num: int) -> None:
+    started.wait()
+    raise ValueError('harness failed')
+
+  def Callback(batch_num: int) -> None:
+    started.set()
+    stop_event.wait()
+
+  failing_runner = _MakeRunner(
+      MockDataStoreStub(10), MockHarnessStub(FailingCallback), stop_event)
+  datastore_stub = MockDataStoreStub(10)
+  runner = _MakeRunner(datastore_stub, MockHarnessStub(Callback), stop_event)
+  thread = threading.Thread(target=runner.Run)
+  thread.start()
+  with pytest.raises(ValueError):
+    failing_runner.Run()
+  thread.join()
+  assert stop_event.is_set()
+  assert _Srcs(datastore_stub.submitted) == [['0', '1', '2']]
+
+
+def main(argv):  # pylint: disable=missing-docstring
+  del argv
+  sys.exit(pytest.main([__file__, '-v']))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -7,12 +7,14 @@ See the conftest.py documentation for more details:
 https://docs.pytest.org/en/latest/fixture.html#conftest-py-sharing-fixture-functions
 """
 import pathlib
+import typing
 
 import pytest
 
 from deeplearning.deepsmith import datastore
 from deeplearning.deepsmith import db
 from deeplearning.deepsmith.proto import datastore_pb2
+from deeplearning.deepsmith.proto import deepsmith_pb2
 from labm8 import pbutil
 
 
@@ -75,3 +77,33 @@ def session(request) -> db.session_t:
   """
   with ds(request).Session() as session_:
     yield session_
+
+
+class TestcaseFactory(object):
+  """A factory of distinct OpenCL testcases."""
+
+  @staticmethod
+  def Testcase(i: int) -> deepsmith_pb2.Testcase:
+    """Return the i-th testcase, whose 'src' input is unique to i."""
+    return deepsmith_pb2.Testcase(
+        toolchain='opencl',
+        generator=deepsmith_pb2.Generator(name='clgen'),
+        harness=deepsmith_pb2.Harness(name='cldrive'),
+        inputs={'src': TestcaseFactory.Source(i)})
+
+  @staticmethod
+  def Source(i: int) -> str:
+    """Return the 'src' input of the i-th testcase."""
+    return f'kernel void A() {{ {i}; }}'
+
+  @staticmethod
+  def Sources(testcases: typing.Iterable[deepsmith_pb2.Testcase]
+              ) -> typing.List[str]:
+    """Return the 'src' inputs of testcases."""
+    return [t.inputs['src'] for t in testcases]
+
+
+@pytest.fixture(scope='function')
+def testcase_factory() -> TestcaseFactory:
+  """A test fixture which returns a factory of distinct OpenCL testcases."""
+  return TestcaseFactory()
@@ -1,8 +1,11 @@
 """The datastore acts as the bridge between the RPC frontend and the db backend.
 """
 import contextlib
+import datetime
 import pathlib
+import typing
 
+import sqlalchemy as sql
 from absl import flags
 from absl import logging
 from sqlalchemy import orm
@@ -15,15 +18,20 @@ import deeplearning.deepsmith.testbed
 import deeplearning.deepsmith.testcase
 import deeplearning.deepsmith.testcase
 import deeplearning.deepsmith.toolchain
-import labm8.sqlutil
 from deeplearning.deepsmith import db
 from deeplearning.deepsmith.proto import datastore_pb2
-from deeplearning.deepsmith.proto import deepsmith_pb2
+from labm8 import labdate
 from labm8 import pbutil
 
 
 FLAGS = flags.FLAGS
 
+flags.DEFINE_integer(
+    'deepsmith_pending_result_timeout_seconds', 3600,
+    'The number of seconds that a testbed has to return the result of a '
+    'testcase which it has been issued before the testcase may be issued to '
+    'the testbed again.')
+
 
 class InvalidRequest(ValueError):
   """Exception raised if request cannot be served."""
@@ -108,102 +116,175 @@ class DataStore(object):
   def SubmitTestcases(self, request: datastore_pb2.SubmitTestcasesRequest,
                       response: datastore_pb2.SubmitTestcasesResponse) -> None:
     """Add a sequence of testcases to the datastore.
+
+    The testcases are added in bulk, using a fixed number of queries per
+    request rather than per testcase.
+    """
+    del response
+    with self.Session(commit=True) as session:
+      deeplearning.deepsmith.testcase.Testcase.GetOrAddMany(
+          session, list(request.testcases))
+
+  def SubmitResults(self, request: datastore_pb2.SubmitResultsRequest,
+                    response: datastore_pb2.SubmitResultsResponse) -> None:
+    """Add a sequence of results to the datastore.
+
+    The results, and the testcases and testbeds that they reference, are added
+    in bulk, using a fixed number of queries per request rather than per
+    result.
     """
     del response
     with self.Session(commit=True) as session:
-      for testcase in request.testcases:
-        self._AddOneTestcase(session, testcase)
+      deeplearning.deepsmith.result.Result.GetOrAddMany(
+          session, list(request.results))
+
+  def _BuildTestcaseRequestQuery(
+      self, session: db.session_t,
+      request: datastore_pb2.GetTestcasesRequest,
+      testbed_ids: typing.List[int]) -> typing.Optional[db.query_t]:
+    """Build the query for the testcases which match a request.
+
+    Testcases which have results, or unexpired pending results, for any of the
+    testbeds are excluded using correlated NOT EXISTS subqueries, which are
+    served by the (testbed_id, testcase_id) indexes of the results and
+    pending_results tables.
+
+    Args:
+      session: A database session.
+      request: The request.
+      testbed_ids: The IDs of the testbeds that testcases are requested for.
 
-  def _AddOneTestcase(self, session: db.session_t,
-                      proto: deepsmith_pb2.Testcase) -> None:
-    """Record a single Testcase in the database.
+    Returns:
+      A query, or None if the request cannot match any testcases.
     """
-    deeplearning.deepsmith.testcase.Testcase.GetOrAdd(session, proto)
-
-  def _BuildTestcaseRequestQuery(self, session, request) -> db.query_t:
-    def _FilterToolchainGeneratorHarness(q):
-      if request.HasField('toolchain'):
-        toolchain = labm8.sqlutil.GetOrAdd(session,
-                                           deeplearning.deepsmith.toolchain.Toolchain,
-                                           name=request.toolchain)
-        if not toolchain:
-          raise LookupError
-        q = q.filter(
-            deeplearning.deepsmith.testcase.Testcase.toolchain_id == toolchain.id)
-
-      # Filter by generator.
-      if request.HasField('generator'):
-        generator = session.query(
-            deeplearning.deepsmith.generator.Generator).filter(
-            deeplearning.deepsmith.generator.Generator.name ==
-            request.generator.name,
-            deeplearning.deepsmith.generator.Generator.version ==
-            request.generator.version).first()
-        if not generator:
-          raise LookupError
-        q = q.filter(
-            deeplearning.deepsmith.testcase.Testcase.generator_id == generator.id)
-
-      # Filter by generator.
-      if request.has_harness:
-        harness = session.query(deeplearning.deepsmith.harness.Harness).filter(
-            deeplearning.deepsmith.harness.Harness.name == request.harness.name,
-            deeplearning.deepsmith.harness.Harness.version ==
-            request.harness.version).first()
-        if not harness:
-          raise LookupError
-        q = q.filter(
-            deeplearning.deepsmith.testcase.Testcase.harnessid == harness.id)
-
-      return q
-
-    q = session.query(deeplearning.deepsmith.testcase.Testcase)
-    q = _FilterToolchainGeneratorHarness(q)
-
-    testbed_id = None
-    if request.HasField('testbed'):
-      toolchain = labm8.sqlutil.GetOrAdd(session,
-                                         deeplearning.deepsmith.toolchain.Toolchain,
-                                         name=request.testbed)
-      testbed = labm8.sqlutil.GetOrAdd(session,
-                                       deeplearning.deepsmith.testbed.Testbed,
-                                       toolchain=toolchain,
-                                       name=request.testbed.toolchain,
-                                       version=request.testbed.version)
-      testbed_id = testbed.id
-
-    if testbed_id and not request.include_testcases_with_results:
-      q2 = session.query(deeplearning.deepsmith.result.Result.testcase_id).join(
-          deeplearning.deepsmith.testcase.Testcase).filter(
-          deeplearning.deepsmith.result.Result.testbed_id == testbed_id)
-      q2 = _FilterToolchainGeneratorHarness(q2)
-      q = q.filter(~deeplearning.deepsmith.testcase.Testcase.id.in_(q2))
-
-    if testbed_id and not request.include_testcases_with_pending_results:
-      q2 = session.query(
-          deeplearning.deepsmith.result.PendingResult.testcase_id).join(
-          deeplearning.deepsmith.testcase.Testcase).filter(
-          deeplearning.deepsmith.result.PendingResult.testbed_id == testbed_id)
-      q2 = _FilterToolchainGeneratorHarness(q2)
-      q = q.filter(~deeplearning.deepsmith.testcase.Testcase.id.in_(q2))
+    Testcase = deeplearning.deepsmith.testcase.Testcase
+    q = session.query(Testcase)
+
+    # Filter by toolchain.
+    if request.HasField('toolchain'):
+      toolchain = session.query(
+          deeplearning.deepsmith.toolchain.Toolchain.id).filter(
+          deeplearning.deepsmith.toolchain.Toolchain.string ==
+          request.toolchain).first()
+      if not toolchain:
+        return None
+      q = q.filter(Testcase.toolchain_id == toolchain.id)
+
+    # Filter by generator.
+    if request.HasField('generator'):
+      Generator = deeplearning.deepsmith.generator.Generator
+      generator = session.query(Generator.id).filter(
+          Generator.name == request.generator.name,
+          Generator.optset_id == db.OptSetId(request.generator.opts)).first()
+      if not generator:
+        return None
+      q = q.filter(Testcase.generator_id == generator.id)
+
+    # Filter by harness.
+    if request.HasField('harness'):
+      Harness = deeplearning.deepsmith.harness.Harness
+      harness = session.query(Harness.id).filter(
+          Harness.name == request.harness.name,
+          Harness.optset_id == db.OptSetId(request.harness.opts)).first()
+      if not harness:
+        return None
+      q = q.filter(Testcase.harness_id == harness.id)
+
+    if testbed_ids and not request.include_testcases_with_results:
+      Result = deeplearning.deepsmith.result.Result
+      q = q.filter(~sql.exists().where(sql.and_(
+          Result.testbed_id.in_(testbed_ids),
+          Result.testcase_id == Testcase.id)))
+
+    if testbed_ids and not request.include_testcases_with_pending_results:
+      PendingResult = deeplearning.deepsmith.result.PendingResult
+      q = q.filter(~sql.exists().where(sql.and_(
+          PendingResult.testbed_id.in_(testbed_ids),
+          PendingResult.testcase_id == Testcase.id,
+          PendingResult.deadline > labdate.GetUtcMillisecondsNow())))
 
     return q
 
+  @staticmethod
+  def _MarkResultsPending(session: db.session_t,
+                          testbed_ids: typing.List[int],
+                          testcase_ids: typing.List[int]) -> None:
+    """Record that testcases have been issued to testbeds.
+
+    Any existing pending results for the same testcases and testbeds, such as
+    those which have passed their deadline, are replaced.
+
+    Args:
+      session: A database session.
+      testbed_ids: The IDs of the testbeds.
+      testcase_ids: The IDs of the testcases.
+    """
+    PendingResult = deeplearning.deepsmith.result.PendingResult
+    session.query(PendingResult).filter(
+        PendingResult.testbed_id.in_(testbed_ids),
+        PendingResult.testcase_id.in_(testcase_ids)).delete(
+        synchronize_session=False)
+    now = labdate.GetUtcMillisecondsNow()
+    deadline = now + datetime.timedelta(
+        seconds=FLAGS.deepsmith_pending_result_timeout_seconds)
+    db.InsertIgnore(session, PendingResult, [
+      {'date_added': now, 'deadline': deadline, 'testbed_id': testbed_id,
+       'testcase_id': testcase_id}
+      for testbed_id in testbed_ids for testcase_id in testcase_ids])
+
   def GetTestcases(self, request: datastore_pb2.GetTestcasesRequest,
                    response: datastore_pb2.GetTestcasesResponse) -> None:
-    """Request testcases."""
-    with self.Session(commit=False) as session:
-      # Validate request parameters.
-      if request.max_num_testcases < 1:
-        raise InvalidRequest(
-            f'max_num_testcases must be >= 1, not {request.max_num_testcases}')
+    """Request testcases.
 
-      q = self._BuildTestcaseRequestQuery(session, request)
-      q.limit(request.max_num_testcases)
+    Testcases are returned in order of their IDs, at most
+    max_num_testcases_to_return at a time. If the request sets
+    after_testcase_id, only testcases with greater IDs are returned, so that a
+    client may page through the matching testcases using the last_testcase_id
+    of the previous response. The testcases are marked as pending for the
+    requested testbeds in the same transaction that selects them.
 
-      if request.return_testcases:
-        response.testcases = [testcase.ToProto() for testcase in q]
+    Raises:
+      InvalidRequest: If the request parameters are invalid.
+    """
+    if request.max_num_testcases_to_return < 1:
+      raise InvalidRequest(
+          'max_num_testcases_to_return must be >= 1, not '
+          f'{request.max_num_testcases_to_return}')
+
+    Testcase = deeplearning.deepsmith.testcase.Testcase
+    with self.Session(commit=True) as session:
+      testbed_ids = deeplearning.deepsmith.testbed.Testbed.GetOrAddMany(
+          session, list(request.mark_results_pending))
+      q = self._BuildTestcaseRequestQuery(session, request, testbed_ids)
+      if q is None:
+        return
 
       if request.return_total_matching_count:
-        q2 = self._BuildTestcaseRequestQuery(session, request)
-        response.total_matching_count = q2.count()
+        response.total_matching_count = q.order_by(None).count()
+
+      if not request.return_testcases and not testbed_ids:
+        return
+
+      if request.HasField('after_testcase_id'):
+        q = q.filter(Testcase.id > request.after_testcase_id)
+      q = q.order_by(Testcase.id).limit(request.max_num_testcases_to_return)
+
+      if not request.return_testcases:
+        testcase_ids = [row.id for row in q.with_entities(Testcase.id)]
+      else:
+        testcase_ids = []
+        q = q.options(
+            orm.joinedload(Testcase.toolchain),
+            orm.joinedload(Testcase.generator),
+            orm.joinedload(Testcase.harness),
+            orm.selectinload(Testcase.inputset),
+            orm.selectinload(Testcase.invariant_optset),
+            orm.selectinload(Testcase.profiling_events))
+        for testcase in q:
+          testcase.SetProto(response.testcases.add())
+          testcase_ids.append(testcase.id)
+
+      if testcase_ids:
+        response.last_testcase_id = testcase_ids[-1]
+      if testbed_ids and testcase_ids:
+        self._MarkResultsPending(session, testbed_ids, testcase_ids)
@@ -0,0 +1,177 @@
+"""Tests for //deeplearning/deepsmith:datastore."""
+import datetime
+import sys
+
+import pytest
+from absl import app
+
+import deeplearning.deepsmith.generator
+import deeplearning.deepsmith.harness
+import deeplearning.deepsmith.result
+from deeplearning.deepsmith import datastore
+from deeplearning.deepsmith.proto import datastore_pb2
+from deeplearning.deepsmith.proto import deepsmith_pb2
+from labm8 import labdate
+
+
+def _Testbed(name: str = 'cpu') -> deepsmith_pb2.Testbed:
+  return deepsmith_pb2.Testbed(toolchain='opencl', name=name)
+
+
+def _AddTestcases(ds: datastore.DataStore, testcase_factory, n: int) -> None:
+  ds.SubmitTestcases(datastore_pb2.SubmitTestcasesRequest(
+      testcases=[testcase_factory.Testcase(i) for i in range(n)]),
+      datastore_pb2.SubmitTestcasesResponse())
+
+
+def _GetTestcases(ds: datastore.DataStore,
+                  **kwargs) -> datastore_pb2.GetTestcasesResponse:
+  request = datastore_pb2.GetTestcasesRequest(
+      toolchain='opencl', harness=deepsmith_pb2.Harness(name='cldrive'),
+      **kwargs)
+  response = datastore_pb2.GetTestcasesResponse()
+  ds.GetTestcases(request, response)
+  return response
+
+
+def test_DataStore_GetTestcases_max_num_testcases_to_return(
+    ds, testcase_factory):
+  """Test that no more than the requested number of testcases is returned."""
+  _AddTestcases(ds, testcase_factory, 10)
+  response = _GetTestcases(ds, max_num_testcases_to_return=3)
+  assert testcase_factory.Sources(response.testcases) == [
+    testcase_factory.Source(i) for i in range(3)]
+  assert response.testcases[0] == testcase_factory.Testcase(0)
+
+
+def test_DataStore_GetTestcases_invalid_max_num_testcases_to_return(ds):
+  """Test that a non-positive maximum number of testcases is rejected."""
+  with pytest.raises(datastore.InvalidRequest):
+    _GetTestcases(ds, max_num_testcases_to_return=0)
+
+
+def test_DataStore_GetTestcases_pagination(ds, testcase_factory):
+  """Test that pages of testcases cover every testcase once."""
+  _AddTestcases(ds, testcase_factory, 10)
+  sources = []
+  response = _GetTestcases(ds, max_num_testcases_to_return=4)
+  while response.testcases:
+    sources += testcase_factory.Sources(response.testcases)
+    response = _GetTestcases(ds, max_num_testcases_to_return=4,
+                             after_testcase_id=response.last_testcase_id)
+  assert sources == [testcase_factory.Source(i) for i in range(10)]
+
+
+def test_DataStore_GetTestcases_total_matching_count(ds, testcase_factory):
+  """Test that the count of matching testcases ignores the page limit."""
+  _AddTestcases(ds, testcase_factory, 10)
+  response = _GetTestcases(ds, max_num_testcases_to_return=3,
+                           return_total_matching_count=True)
+  assert len(response.testcases) == 3
+  assert response.total_matching_count == 10
+
+
+def test_DataStore_GetTestcases_unknown_toolchain(ds, testcase_factory):
+  """Test that no testcases match a toolchain which does not exist."""
+  _AddTestcases(ds, testcase_factory, 3)
+  request = datastore_pb2.GetTestcasesRequest(
+      toolchain='cuda', return_total_matching_count=True)
+  response = datastore_pb2.GetTestcasesResponse()
+  ds.GetTestcases(request, response)
+  assert not response.testcases
+  assert not response.total_matching_count
+
+
+def test_DataStore_GetTestcases_unknown_harness(ds, testcase_factory):
+  """Test that a request for an unknown harness does not add it."""
+  _AddTestcases(ds, testcase_factory, 3)
+  request = datastore_pb2.GetTestcasesRequest(
+      toolchain='opencl', harness=deepsmith_pb2.Harness(name='cl_launcher'),
+      generator=deepsmith_pb2.Generator(name='clgen', opts={'a': 'b'}),
+      return_total_matching_count=True)
+  response = datastore_pb2.GetTestcasesResponse()
+  ds.GetTestcases(request, response)
+  assert not response.testcases
+  assert not response.total_matching_count
+  with ds.Session() as session:
+    assert session.query(deeplearning.deepsmith.harness.Harness).count() == 1
+    assert session.query(
+        deeplearning.deepsmith.generator.Generator).count() == 1
+
+
+def test_DataStore_GetTestcases_generator_opts(ds, testcase_factory):
+  """Test that testcases are filtered by generator options."""
+  _AddTestcases(ds, testcase_factory, 3)
+  assert len(_GetTestcases(
+      ds, generator=deepsmith_pb2.Generator(name='clgen')).testcases) == 3
+  assert not _GetTestcases(ds, generator=deepsmith_pb2.Generator(
+      name='clgen', opts={'a': 'b'})).testcases
+
+
+def test_DataStore_GetTestcases_mark_results_pending(ds, testcase_factory):
+  """Test that testcases are not reissued to a testbed while pending."""
+  _AddTestcases(ds, testcase_factory, 5)
+  response = _GetTestcases(ds, max_num_testcases_to_return=3,
+                           mark_results_pending=[_Testbed()])
+  assert len(response.testcases) == 3
+  with ds.Session() as session:
+    assert session.query(
+        deeplearning.deepsmith.result.PendingResult).count() == 3
+
+  # The remaining testcases are issued to the same testbed.
+  response = _GetTestcases(ds, mark_results_pending=[_Testbed()])
+  assert testcase_factory.Sources(response.testcases) == [
+    testcase_factory.Source(i) for i in (3, 4)]
+  assert not _GetTestcases(ds, mark_results_pending=[_Testbed()]).testcases
+
+  # Every testcase is issued to a different testbed.
+  response = _GetTestcases(ds, mark_results_pending=[_Testbed('gpu')])
+  assert len(response.testcases) == 5
+
+
+def test_DataStore_GetTestcases_expired_pending_results(ds, testcase_factory):
+  """Test that testcases are reissued once a pending result has expired."""
+  _AddTestcases(ds, testcase_factory, 2)
+  _GetTestcases(ds, mark_results_pending=[_Testbed()])
+  with ds.Session(commit=True) as session:
+    session.query(deeplearning.deepsmith.result.PendingResult).update(
+        {'deadline': labdate.GetUtcMillisecondsNow() -
+                     datetime.timedelta(seconds=1)})
+
+  response = _GetTestcases(ds, mark_results_pending=[_Testbed()])
+  assert len(response.testcases) == 2
+  with ds.Session() as session:
+    pending_results = session.query(
+        deeplearning.deepsmith.result.PendingResult).all()
+    assert len(pending_results) == 2
+    assert all(p.deadline > labdate.GetUtcMillisecondsNow()
+               for p in pending_results)
+
+
+def test_DataStore_GetTestcases_include_testcases_with_results(
+    ds, testcase_factory):
+  """Test that testcases with results are excluded unless requested."""
+  _AddTestcases(ds, testcase_factory, 3)
+  ds.SubmitResults(datastore_pb2.SubmitResultsRequest(results=[
+    deepsmith_pb2.Result(testcase=testcase_factory.Testcase(1),
+                         testbed=_Testbed(),
+                         outcome=deepsmith_pb2.Result.PASS)]),
+      datastore_pb2.SubmitResultsResponse())
+
+  response = _GetTestcases(ds, mark_results_pending=[_Testbed()])
+  assert testcase_factory.Sources(response.testcases) == [
+    testcase_factory.Source(i) for i in (0, 2)]
+
+  response = _GetTestcases(ds, mark_results_pending=[_Testbed()],
+                           include_testcases_with_results=True,
+                           include_testcases_with_pending_results=True)
+  assert len(response.testcases) == 3
+
+
+def main(argv):  # pylint: disable=missing-docstring
+  del argv
+  sys.exit(pytest.main([__file__, '-v']))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -1,12 +1,17 @@
 """Database backend.
 """
+import collections
 import datetime
+import hashlib
 import pathlib
+import typing
 
 import sqlalchemy as sql
 from absl import flags
 from absl import logging
+from sqlalchemy import orm
 from sqlalchemy.dialects import mysql
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.declarative import declarative_base
 
 from deeplearning.deepsmith.proto import datastore_pb2
@@ -18,6 +23,10 @@ from labm8.sqlutil import GetOrAdd
 FLAGS = flags.FLAGS
 
 flags.DEFINE_bool('sql_echo', None, 'Print all executed SQL statements')
+flags.DEFINE_integer(
+    'deepsmith_identity_cache_size', 10000,
+    'The maximum number of objects cached per database session by the '
+    'GetOrAdd() methods of small tables, such as toolchains and testbeds.')
 
 # The database session type.
 session_t = sql.orm.session.Session
@@ -62,6 +71,91 @@ class StringTooLongError(ValueError):
                                                                      f'{self.max_len}, actual length: {n}. ')
 
 
+class IdentityCache(object):
+  """A bounded, session-scoped cache of database objects.
+
+  Tables such as toolchains, generators, and string tables have few distinct
+  rows, but are looked up by GetOrAdd() for every testcase and result. This
+  cache maps the natural key of such a row (e.g. a string, or a generator name
+  and options) to its instance, so that repeated lookups within a session do
+  not require a query.
+
+  The cache is attached to the session, and is cleared when the session is
+  rolled back, since any instances added in the rolled back transaction are
+  discarded. When full, the least recently used instances are evicted.
+  """
+
+  def __init__(self, max_size: int):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self._instances: typing.Dict[
+      typing.Hashable, Table] = collections.OrderedDict()
+
+  @classmethod
+  def FromSession(cls, session: session_t) -> 'IdentityCache':
+    """Get the identity cache of a session, creating it if required.
+
+    Args:
+      session: A database session.
+
+    Returns:
+      The session's IdentityCache.
+    """
+    if 'deepsmith_identity_cache' not in session.info:
+      session.info['deepsmith_identity_cache'] = cls(
+          FLAGS.deepsmith_identity_cache_size)
+    return session.info['deepsmith_identity_cache']
+
+  def Get(self, session: session_t, key: typing.Hashable
+          ) -> typing.Optional['Table']:
+    """Look up an instance.
+
+    Args:
+      session: The session which owns the cache.
+      key: The natural key of the instance, including the table class.
+
+    Returns:
+      The cached instance, or None if not cached.
+    """
+    instance = self._instances.get(key)
+    # An instance may have been expunged from the session since it was cached.
+    if instance is None or instance not in session:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._instances.move_to_end(key)
+    return instance
+
+  def Put(self, key: typing.Hashable, instance: 'Table') -> 'Table':
+    """Add an instance to the cache.
+
+    Args:
+      key: The natural key of the instance, including the table class.
+      instance: The instance.
+
+    Returns:
+      The instance.
+    """
+    self._instances[key] = instance
+    self._instances.move_to_end(key)
+    while len(self._instances) > self.max_size:
+      self._instances.popitem(last=False)
+    return instance
+
+  def Clear(self) -> None:
+    """Remove all instances from the cache."""
+    self._instances.clear()
+
+
+@sql.event.listens_for(orm.Session, 'after_soft_rollback')
+def _ClearIdentityCacheOnRollback(session: session_t, previous_transaction):
+  """Invalidate the identity cache of a session when it is rolled back."""
+  del previous_transaction
+  if 'deepsmith_identity_cache' in session.info:
+    session.info['deepsmith_identity_cache'].Clear()
+
+
 class Table(Base):
   """A database-backed object.
 
@@ -209,7 +303,33 @@ class StringTable(Table):
     if len(string) > cls.maxlen:
       raise StringTooLongError(cls, string, cls.maxlen)
 
-    return GetOrAdd(session, cls, string=string)
+    cache = IdentityCache.FromSession(session)
+    key = (cls, string)
+    return (cache.Get(session, key) or
+            cache.Put(key, GetOrAdd(session, cls, string=string)))
+
+  @classmethod
+  def GetOrAddMany(cls, session: session_t,
+                   strings: typing.Iterable[str]) -> typing.Dict[str, int]:
+    """Resolve the IDs of many strings, adding those which do not exist.
+
+    Args:
+      session: A database session.
+      strings: The strings.
+
+    Returns:
+      A map from string to StringTable ID.
+
+    Raises:
+      StringTooLongError: If a string is too long.
+    """
+    strings = set(strings)
+    for string in strings:
+      if len(string) > cls.maxlen:
+        raise StringTooLongError(cls, string, cls.maxlen)
+    ids = GetOrAddMany(session, cls, ['string'],
+                       [{'string': string} for string in strings])
+    return {string: id_ for (string,), id_ in ids.items()}
 
   def TruncatedString(self, n=80):
     """Return the truncated first 'n' characters of the string.
@@ -231,6 +351,183 @@ class StringTable(Table):
     return self.TruncatedString(n=52)
 
 
+# The maximum number of bound parameters in a single bulk statement. SQLite
+# builds prior to 3.32 are limited to 999 parameters per statement.
+_MAX_BULK_PARAMETERS = 999
+
+# The type of the key of a table row, as a tuple of column values.
+row_key_t = typing.Tuple[typing.Any, ...]
+
+
+def _Chunks(items: typing.List[typing.Any], num_columns: int):
+  """Split items into chunks which fit within the bound parameter limit."""
+  chunk_size = max(_MAX_BULK_PARAMETERS // max(num_columns, 1), 1)
+  for i in range(0, len(items), chunk_size):
+    yield items[i:i + chunk_size]
+
+
+def InsertIgnore(session: session_t, table: Table,
+                 rows: typing.List[typing.Dict[str, typing.Any]]) -> None:
+  """Insert many rows, ignoring those which violate a unique constraint.
+
+  Rows are inserted using multi-row INSERT statements, which skip conflicting
+  rows using the backend's INSERT OR IGNORE, INSERT IGNORE, or ON CONFLICT DO
+  NOTHING syntax. Note that rows are inserted using the session's connection,
+  bypassing the ORM, so they are not added to the session's identity map.
+
+  Args:
+    session: A database session.
+    table: The database table class.
+    rows: A list of column values for each row. Every row must have the same
+      columns.
+  """
+  if not rows:
+    return
+  dialect = session.get_bind().dialect.name
+  if dialect == 'postgresql':
+    statement = postgresql.insert(table.__table__).on_conflict_do_nothing()
+  elif dialect == 'mysql':
+    statement = table.__table__.insert().prefix_with('IGNORE')
+  else:
+    statement = table.__table__.insert().prefix_with('OR IGNORE')
+  # Columns with Python-side defaults (e.g. date_added) consume a parameter
+  # per row too.
+  num_columns = len(table.__table__.columns)
+  for chunk in _Chunks(rows, num_columns):
+    session.execute(statement.values(chunk))
+
+
+def GetIds(session: session_t, table: Table, key_columns: typing.List[str],
+           keys: typing.Iterable[row_key_t]) -> typing.Dict[row_key_t, int]:
+  """Look up the IDs of many rows by the values of their key columns.
+
+  Rather than issuing a query per row, a single query per chunk of keys selects
+  the rows whose key columns are in the sets of requested values. Rows which
+  match on every column individually but not as a tuple are discarded.
+
+  Args:
+    session: A database session.
+    table: The database table class.
+    key_columns: The names of the columns which identify a row.
+    keys: The tuples of key column values to look up.
+
+  Returns:
+    A map from key tuple to row ID, for the keys which exist.
+  """
+  keys = set(keys)
+  columns = [getattr(table, column) for column in key_columns]
+  ids = {}
+  for chunk in _Chunks(list(keys), len(key_columns)):
+    query = session.query(table.id, *columns)
+    for i, column in enumerate(columns):
+      query = query.filter(column.in_(set(key[i] for key in chunk)))
+    for row in query:
+      key = tuple(row[1:])
+      if key in keys:
+        ids[key] = row[0]
+  return ids
+
+
+def GetOrAddMany(
+    session: session_t, table: Table, key_columns: typing.List[str],
+    rows: typing.List[typing.Dict[str, typing.Any]]
+) -> typing.Dict[row_key_t, int]:
+  """Resolve the IDs of many rows, adding those which do not exist.
+
+  This is the bulk equivalent of labm8.sqlutil.GetOrAdd(), which requires one
+  lookup per table, and one insert per table if there are new rows.
+
+  Args:
+    session: A database session.
+    table: The database table class.
+    key_columns: The names of the columns which identify a row.
+    rows: A list of column values for each row, including the key columns.
+
+  Returns:
+    A map from key tuple to row ID.
+  """
+  unique_rows = {tuple(row[c] for c in key_columns): row for row in rows}
+  ids = GetIds(session, table, key_columns, unique_rows.keys())
+  new_rows = [row for key, row in unique_rows.items() if key not in ids]
+  if new_rows:
+    InsertIgnore(session, table, new_rows)
+    ids.update(GetIds(session, table, key_columns,
+                      [k for k in unique_rows if k not in ids]))
+  return ids
+
+
+def OptSetId(opts: typing.Mapping[str, str]) -> bytes:
+  """Return the ID of a set of <name, value> pairs.
+
+  Args:
+    opts: The set of <name, value> pairs.
+
+  Returns:
+    The md5sum of the set's sorted key value strings.
+  """
+  md5 = hashlib.md5()
+  for name in sorted(opts):
+    md5.update((name + opts[name]).encode('utf-8'))
+  return md5.digest()
+
+
+def GetOrAddOptSets(
+    session: session_t, optset_table: Table, opt_table: Table,
+    name_table: StringTable, value_table: Table, opt_id_column: str,
+    opt_maps: typing.List[typing.Mapping[str, str]],
+    optset_ids: typing.Optional[typing.List[bytes]] = None,
+    value_rows: typing.Optional[
+      typing.Dict[str, typing.Dict[str, typing.Any]]] = None
+) -> typing.List[bytes]:
+  """Resolve the IDs of many sets of <name, value> pairs.
+
+  The set ID is the md5sum of the set's sorted key value strings, so it is
+  computed without a database query. The names, values, and pairs are each
+  resolved using a single bulk lookup. The set IDs and the column values of
+  the values may be precomputed, e.g. by a pool of worker processes.
+
+  Args:
+    session: A database session.
+    optset_table: The table which groups pairs into sets.
+    opt_table: The table of <name, value> pairs.
+    name_table: The table of names.
+    value_table: The table of values. This must provide a GetOrAddMany()
+      method which maps strings to IDs.
+    opt_id_column: The name of the column of optset_table which references
+      opt_table.
+    opt_maps: The sets of <name, value> pairs.
+    optset_ids: The set IDs of opt_maps, as computed by OptSetId(). If not
+      provided, they are computed.
+    value_rows: A map from value to the column values of its row in
+      value_table. If provided, it is passed to value_table.GetOrAddMany(),
+      which must accept it as its third argument.
+
+  Returns:
+    The set IDs, in the same order as opt_maps.
+  """
+  if optset_ids is None:
+    optset_ids = [OptSetId(opts) for opts in opt_maps]
+  name_ids = name_table.GetOrAddMany(
+      session, (name for opts in opt_maps for name in opts))
+  values = (value for opts in opt_maps for value in opts.values())
+  if value_rows is None:
+    value_ids = value_table.GetOrAddMany(session, values)
+  else:
+    value_ids = value_table.GetOrAddMany(session, values, value_rows)
+  opt_ids = GetOrAddMany(session, opt_table, ['name_id', 'value_id'], [
+    {'name_id': name_ids[name], 'value_id': value_ids[value]}
+    for opts in opt_maps for name, value in opts.items()])
+
+  optset_rows = {}
+  for opts, optset_id in zip(opt_maps, optset_ids):
+    for name, value in opts.items():
+      opt_id = opt_ids[(name_ids[name], value_ids[value])]
+      optset_rows[(optset_id, opt_id)] = {'id': optset_id,
+                                          opt_id_column: opt_id}
+  InsertIgnore(session, optset_table, list(optset_rows.values()))
+  return optset_ids
+
+
 def MakeEngine(config: datastore_pb2.DataStore) -> sql.engine.Engine:
   """Instantiate a database engine.
 
@@ -92,6 +92,93 @@ def test_StringTable_TruncatedString_uninitialized():
   assert len(t.TruncatedString()) == 0
 
 
+def test_StringTable_GetOrAdd_identity_cache(ds):
+  """Test that repeated lookups in a session are served from the cache."""
+  with ds.Session() as session:
+    a = toolchain.Toolchain.GetOrAdd(session, 'a')
+    session.flush()
+    cache = db.IdentityCache.FromSession(session)
+    hits = cache.hits
+    assert toolchain.Toolchain.GetOrAdd(session, 'a') is a
+    assert cache.hits == hits + 1
+
+
+def test_StringTable_GetOrAdd_identity_cache_rollback(ds):
+  """Test that instances from a rolled back transaction are not reused."""
+  with ds.Session() as session:
+    a = toolchain.Toolchain.GetOrAdd(session, 'a')
+    session.rollback()
+    b = toolchain.Toolchain.GetOrAdd(session, 'a')
+    assert b is not a
+    session.flush()
+    assert session.query(toolchain.Toolchain).count() == 1
+
+
+def test_IdentityCache_eviction(ds):
+  """Test that the least recently used instances are evicted."""
+  with ds.Session() as session:
+    cache = db.IdentityCache(max_size=2)
+    a = toolchain.Toolchain(string='a')
+    session.add(a)
+    cache.Put('a', a)
+    cache.Put('b', toolchain.Toolchain(string='b'))
+    # Using 'a' makes 'b' the least recently used.
+    assert cache.Get(session, 'a') is a
+    cache.Put('c', toolchain.Toolchain(string='c'))
+    assert cache.Get(session, 'b') is None
+    assert cache.Get(session, 'a') is a
+
+
+def test_IdentityCache_Get_not_in_session(ds):
+  """Test that instances which are not in the session are not returned."""
+  with ds.Session() as session:
+    cache = db.IdentityCache(max_size=2)
+    a = toolchain.Toolchain(string='a')
+    session.add(a)
+    cache.Put('a', a)
+    session.expunge(a)
+    assert cache.Get(session, 'a') is None
+
+
+def test_StringTable_GetOrAddMany(ds):
+  """Test that bulk lookups return the same IDs as GetOrAdd()."""
+  with ds.Session(commit=True) as session:
+    a = toolchain.Toolchain.GetOrAdd(session, 'a')
+    session.flush()
+    ids = toolchain.Toolchain.GetOrAddMany(session, ['a', 'b', 'b', 'c'])
+    assert set(ids.keys()) == {'a', 'b', 'c'}
+    assert ids['a'] == a.id
+    assert len(set(ids.values())) == 3
+    assert session.query(toolchain.Toolchain).count() == 3
+
+
+def test_StringTable_GetOrAddMany_StringTooLongError(ds):
+  with ds.Session() as session:
+    with pytest.raises(db.StringTooLongError):
+      toolchain.Toolchain.GetOrAddMany(
+          session, ['a', 'a' * (toolchain.Toolchain.maxlen + 1)])
+
+
+def test_InsertIgnore_duplicates(ds):
+  """Test that rows which violate a unique constraint are ignored."""
+  with ds.Session(commit=True) as session:
+    db.InsertIgnore(session, toolchain.Toolchain,
+                    [{'string': 'a'}, {'string': 'b'}])
+    db.InsertIgnore(session, toolchain.Toolchain,
+                    [{'string': 'b'}, {'string': 'c'}])
+    assert session.query(toolchain.Toolchain).count() == 3
+
+
+def test_GetOrAddMany_many_rows(ds):
+  """Test that batches larger than the bound parameter limit are chunked."""
+  strings = [str(i) for i in range(5000)]
+  with ds.Session(commit=True) as session:
+    ids = toolchain.Toolchain.GetOrAddMany(session, strings)
+    assert len(set(ids.values())) == 5000
+    for t in session.query(toolchain.Toolchain):
+      assert ids[t.string] == t.id
+
+
 def test_MakeEngine_unknown_backend():
   with pytest.raises(NotImplementedError):
     db.MakeEngine(DataStoreProtoMock())
@@ -86,6 +86,11 @@ class Generator(db.Table):
   @classmethod
   def GetOrAdd(cls, session: db.session_t,
                proto: deepsmith_pb2.Generator) -> 'Generator':
+    cache = db.IdentityCache.FromSession(session)
+    key = (cls, proto.name, tuple(sorted(proto.opts.items())))
+    generator = cache.Get(session, key)
+    if generator:
+      return generator
 
     # Build the list of options, and md5sum the key value strings.
     opts = []
@@ -108,8 +113,30 @@ class Generator(db.Table):
       labm8.sqlutil.GetOrAdd(session, GeneratorOptSet, id=optset_id,
                              opt=opt)
 
-    return labm8.sqlutil.GetOrAdd(session, cls, name=proto.name,
-                                  optset_id=optset_id, )
+    return cache.Put(key, labm8.sqlutil.GetOrAdd(session, cls, name=proto.name,
+                                                 optset_id=optset_id, ))
+
+  @classmethod
+  def GetOrAddMany(cls, session: db.session_t,
+                   protos: typing.List[deepsmith_pb2.Generator]
+                   ) -> typing.List[int]:
+    """Resolve the IDs of many Generators, adding those which do not exist.
+
+    Args:
+      session: A database session.
+      protos: Generator messages.
+
+    Returns:
+      The Generator IDs, in the same order as protos.
+    """
+    optset_ids = db.GetOrAddOptSets(
+        session, GeneratorOptSet, GeneratorOpt, GeneratorOptName,
+        GeneratorOptValue, 'opt_id', [proto.opts for proto in protos])
+    keys = [(proto.name, optset_id)
+            for proto, optset_id in zip(protos, optset_ids)]
+    ids = db.GetOrAddMany(session, cls, ['name', 'optset_id'], [
+      {'name': name, 'optset_id': optset_id} for name, optset_id in keys])
+    return [ids[key] for key in keys]
 
 
 class GeneratorOptSet(db.Table):
@@ -4,8 +4,10 @@ By supporting only pre-trained models, this module does not depend on the CLgen
 corpus implementation, allowing for a much smaller dependency set, i.e. without
 pulling all of the LLVM libraries required by CLgen's corpus preprocessors.
 """
+import itertools
 import math
 import sys
+import threading
 import typing
 
 from absl import app
@@ -46,6 +48,12 @@ class ClgenGenerator(generator.GeneratorServiceBase,
       no_init: If True, do not initialize the instance and generator values.
     """
     super(ClgenGenerator, self).__init__(config)
+    # The stream of samples is created lazily, and persists across requests so
+    # that samples which are in progress at the end of one request are
+    # completed in the next.
+    self._sample_stream: typing.Optional[
+      typing.Iterator[model_pb2.Sample]] = None
+    self._sample_stream_lock = threading.Lock()
     if not no_init:
       self.instance = sample.Instance(self.config.instance)
       self.toolchain = 'opencl'
@@ -70,11 +78,14 @@ class ClgenGenerator(generator.GeneratorServiceBase,
     del context
     response = services.BuildDefaultResponse(
         generator_pb2.GenerateTestcasesResponse)
-    with self.instance.Session():
-      num_programs = math.ceil(
-          request.num_testcases / len(self.config.testcase_skeleton))
-      for i, sample_ in enumerate(self.instance.model.Sample(
-          self.instance.sampler, num_programs)):
+    num_programs = math.ceil(
+        request.num_testcases / len(self.config.testcase_skeleton))
+    with self._sample_stream_lock, self.instance.Session():
+      if self._sample_stream is None:
+        self._sample_stream = self.instance.model.SampleStream(
+            self.instance.sampler)
+      for i, sample_ in enumerate(
+          itertools.islice(self._sample_stream, num_programs)):
         logging.info('Generated sample %d.', i + 1)
         response.testcases.extend(self.SampleToTestcases(sample_))
 
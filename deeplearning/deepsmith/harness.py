@@ -87,6 +87,11 @@ class Harness(db.Table):
   @classmethod
   def GetOrAdd(cls, session: db.session_t,
                proto: deepsmith_pb2.Harness) -> 'Harness':
+    cache = db.IdentityCache.FromSession(session)
+    key = (cls, proto.name, tuple(sorted(proto.opts.items())))
+    harness = cache.Get(session, key)
+    if harness:
+      return harness
 
     # Build the list of options, and md5sum the key value strings.
     opts = []
@@ -108,8 +113,30 @@ class Harness(db.Table):
       labm8.sqlutil.GetOrAdd(session, HarnessOptSet, id=optset_id,
                              opt=opt)
 
-    return labm8.sqlutil.GetOrAdd(session, cls, name=proto.name,
-                                  optset_id=optset_id, )
+    return cache.Put(key, labm8.sqlutil.GetOrAdd(session, cls, name=proto.name,
+                                                 optset_id=optset_id, ))
+
+  @classmethod
+  def GetOrAddMany(cls, session: db.session_t,
+                   protos: typing.List[deepsmith_pb2.Harness]
+                   ) -> typing.List[int]:
+    """Resolve the IDs of many Harnesss, adding those which do not exist.
+
+    Args:
+      session: A database session.
+      protos: Harness messages.
+
+    Returns:
+      The Harness IDs, in the same order as protos.
+    """
+    optset_ids = db.GetOrAddOptSets(
+        session, HarnessOptSet, HarnessOpt, HarnessOptName, HarnessOptValue,
+        'opt_id', [proto.opts for proto in protos])
+    keys = [(proto.name, optset_id)
+            for proto, optset_id in zip(protos, optset_ids)]
+    ids = db.GetOrAddMany(session, cls, ['name', 'optset_id'], [
+      {'name': name, 'optset_id': optset_id} for name, optset_id in keys])
+    return [ids[key] for key in keys]
 
   def RunTestcaseOnTestbed(self, testcase: deepsmith_pb2.Testcase,
                            testbed: deepsmith_pb2.Testbed) -> \
@@ -1,12 +1,18 @@
+import collections
 import copy
+import hashlib
+import multiprocessing
+import os
 import pathlib
 import subprocess
 import tempfile
+import threading
 import time
 import typing
 from concurrent import futures
 
 import grpc
+import humanize
 from absl import app
 from absl import flags
 from absl import logging
@@ -45,6 +51,123 @@ class DriverCompilationError(OSError):
   pass
 
 
+class DriverCache(object):
+  """A size-bounded, content-addressed cache of compiled drivers.
+
+  Drivers are keyed by the checksum of their source and compiler flags. They
+  are compiled without a fixed OpenCL platform and device, which are selected
+  at runtime instead, so a driver which is compiled once may be run on every
+  testbed. When the total size of the cached drivers exceeds the bound, the
+  least recently used drivers which are not in use are evicted.
+
+  Instances may be shared between threads.
+  """
+
+  def __init__(self, path: pathlib.Path, max_size_bytes: int):
+    """Instantiate a driver cache.
+
+    Args:
+      path: The directory to cache drivers in. Drivers which are already in
+        the directory are reused.
+      max_size_bytes: The maximum total size of the cached drivers.
+    """
+    self.path = path
+    self.max_size_bytes = max_size_bytes
+    self.path.mkdir(parents=True, exist_ok=True)
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    # The sizes of the cached drivers, from least to most recently used.
+    self._sizes: typing.Dict[str, int] = collections.OrderedDict()
+    # The number of unreleased Acquire() calls of each driver.
+    self._in_use: typing.Dict[str, int] = collections.Counter()
+    for driver_path in sorted(self.path.iterdir(),
+                              key=lambda p: p.stat().st_mtime):
+      if driver_path.name.startswith('.'):
+        # A partially compiled driver left behind by an earlier harness.
+        fs.rm(driver_path)
+      else:
+        self._sizes[driver_path.name] = driver_path.stat().st_size
+    self.size = sum(self._sizes.values())
+    with self._lock:
+      self._Evict()
+
+  def Acquire(self, src: str,
+              cflags: typing.Optional[typing.List[str]] = None
+              ) -> pathlib.Path:
+    """Get the compiled driver for a source, compiling it if required.
+
+    The driver is not evicted until it is released with Release().
+
+    Args:
+      src: The C source code of the driver.
+      cflags: Additional flags to compile the driver with.
+
+    Returns:
+      The path of the compiled driver.
+
+    Raises:
+      DriverCompilationError: If the driver fails to compile.
+    """
+    key = hashlib.sha256('\0'.join(
+        [str(CLANG_PATH), src] + list(cflags or [])).encode('utf-8')).hexdigest()
+    path = self.path / key
+    with self._lock:
+      if key in self._sizes:
+        self.hits += 1
+        self._sizes.move_to_end(key)
+        self._in_use[key] += 1
+        # Record the use so that the order is preserved across restarts.
+        os.utime(path)
+        return path
+      self.misses += 1
+
+    # Compile outside of the lock so that drivers are compiled concurrently.
+    # The driver is compiled to a hidden file and moved into place once
+    # complete, so that a partially written driver is never run.
+    with tempfile.NamedTemporaryFile(
+        prefix='.', dir=self.path, delete=False) as f:
+      tmp_path = pathlib.Path(f.name)
+    try:
+      CompileDriver(src, tmp_path, None, None, cflags=cflags)
+    except DriverCompilationError:
+      fs.rm(tmp_path)
+      raise
+    size = tmp_path.stat().st_size
+    os.rename(tmp_path, path)
+
+    with self._lock:
+      # The same driver may have been compiled concurrently by another thread.
+      self.size += size - self._sizes.get(key, 0)
+      self._sizes[key] = size
+      self._sizes.move_to_end(key)
+      self._in_use[key] += 1
+      self._Evict()
+    return path
+
+  def Release(self, path: pathlib.Path) -> None:
+    """Release a driver returned by Acquire().
+
+    Args:
+      path: The path of the driver.
+    """
+    with self._lock:
+      self._in_use[path.name] -= 1
+      if not self._in_use[path.name]:
+        del self._in_use[path.name]
+      self._Evict()
+
+  def _Evict(self) -> None:
+    """Evict least recently used drivers until the cache fits its bound."""
+    for key in list(self._sizes.keys()):
+      if self.size <= self.max_size_bytes:
+        break
+      if self._in_use[key]:
+        continue
+      self.size -= self._sizes.pop(key)
+      fs.rm(self.path / key)
+
+
 class CldriveHarness(harness.HarnessBase,
                      harness_pb2_grpc.HarnessServiceServicer):
   """A harness for running OpenCL testcases using cldrive."""
@@ -68,6 +191,16 @@ class CldriveHarness(harness.HarnessBase,
           'not the same length:\n'
           f'    CldriveHarness.opencl_env = {config.opencl_env}\n'
           f'    CldriveHarness.opencl_opt = {config.opencl_opt}')
+    if (self.config.opencl_max_concurrent_runs and
+        len(self.config.opencl_max_concurrent_runs) !=
+        len(self.config.opencl_env)):
+      raise ValueError(
+          'CldriveHarness.opencl_env and '
+          'CldriveHarness.opencl_max_concurrent_runs lists are not the same '
+          'length:\n'
+          f'    CldriveHarness.opencl_env = {config.opencl_env}\n'
+          '    CldriveHarness.opencl_max_concurrent_runs = '
+          f'{config.opencl_max_concurrent_runs}')
 
     # Match and instantiate the OpenCL environments.
     all_envs = {env.name: env for env in env.GetOpenClEnvironments()}
@@ -102,6 +235,28 @@ class CldriveHarness(harness.HarnessBase,
     self.testbeds = [OpenClEnvironmentToTestbed(e) for e in envs]
     self.ids = [e.ids() for e in envs]
 
+    # Drivers are compiled on a shared pool, and run on a pool per testbed
+    # which bounds the number of testcases running concurrently on it. The
+    # pools are shared by concurrent requests.
+    if self.config.opencl_max_concurrent_runs:
+      max_concurrent_runs = list(self.config.opencl_max_concurrent_runs)
+    else:
+      max_concurrent_runs = [
+        1 if e.device_type == 'GPU' else multiprocessing.cpu_count()
+        for e in envs]
+    self.compile_pool = futures.ThreadPoolExecutor(multiprocessing.cpu_count())
+    self.run_pools = [futures.ThreadPoolExecutor(max(n, 1))
+                      for n in max_concurrent_runs]
+
+    if self.config.driver_cache_dir:
+      driver_cache_dir = pathlib.Path(self.config.driver_cache_dir)
+    else:
+      self._driver_cache_tempdir = tempfile.TemporaryDirectory(
+          prefix='deepsmith_drivers_')
+      driver_cache_dir = pathlib.Path(self._driver_cache_tempdir.name)
+    self.driver_cache = DriverCache(
+        driver_cache_dir, self.config.driver_cache_max_size_mb * 1024 * 1024)
+
     # Logging output.
     for testbed in self.testbeds:
       logging.info('OpenCL testbed:\n%s', testbed)
@@ -127,13 +282,25 @@ class CldriveHarness(harness.HarnessBase,
       return response
 
     testbed_idx = self.testbeds.index(request.testbed)
-    for i, testcase in enumerate(request.testcases):
-      result = RunTestcase(
-          self.envs[testbed_idx], self.testbeds[testbed_idx], testcase,
-          self.config.driver_cflag)
+    opencl_environment = self.envs[testbed_idx]
+    # Drivers for upcoming testcases are compiled while earlier testcases run.
+    builds = [self.compile_pool.submit(
+        BuildDriver, self.testbeds[testbed_idx], testcase,
+        self.config.driver_cflag, self.driver_cache)
+      for testcase in request.testcases]
+    runs = [self.run_pools[testbed_idx].submit(
+        lambda build: RunDriver(opencl_environment, *build.result(),
+                                driver_cache=self.driver_cache), build)
+      for build in builds]
+    # Results are returned in request order.
+    for i, run in enumerate(runs):
+      result = run.result()
       logging.info('Testcase %d: %s.', i + 1,
                    deepsmith_pb2.Result.Outcome.Name(result.outcome))
       response.results.extend([result])
+    logging.info('Driver cache: %d hits, %d misses, %s.',
+                 self.driver_cache.hits, self.driver_cache.misses,
+                 humanize.naturalsize(self.driver_cache.size))
 
     return response
 
@@ -166,25 +333,88 @@ def RunTestcase(opencl_environment: env.OpenCLEnvironment,
                 testcase: deepsmith_pb2.Testcase,
                 cflags: typing.List[str]) -> deepsmith_pb2.Result:
   """Run a testcase."""
+  return RunDriver(opencl_environment,
+                   *BuildDriver(testbed, testcase, cflags))
+
+
+def BuildDriver(testbed: deepsmith_pb2.Testbed,
+                testcase: deepsmith_pb2.Testcase,
+                cflags: typing.List[str],
+                driver_cache: typing.Optional[DriverCache] = None
+                ) -> typing.Tuple[deepsmith_pb2.Result,
+                                  typing.Optional[pathlib.Path]]:
+  """Generate and compile the driver for a testcase.
+
+  Args:
+    testbed: The testbed to run the testcase on.
+    testcase: The testcase. This is annotated with the driver type.
+    cflags: Additional flags to compile the driver with.
+    driver_cache: A cache to get the compiled driver from. If not provided,
+      the driver is compiled to a temporary file.
+
+  Returns:
+    A tuple of the partially complete result, and the path of the compiled
+    driver. If the driver fails to compile, the path is None and the result is
+    complete.
+
+  Raises:
+    ValueError: If the testcase is not supported by this harness.
+  """
   if testcase.toolchain != 'opencl':
     raise ValueError(f"Unsupported testcase toolchain: '{testcase.toolchain}'")
   if testcase.harness.name != 'cldrive':
     raise ValueError(f"Unsupported testcase harness: '{testcase.harness.name}'")
   result = deepsmith_pb2.Result()
   result.testbed.CopyFrom(testbed)
-  platform_id, device_id = opencl_environment.ids()
   driver = MakeDriver(
       testcase, True if testbed.opts['opencl_opt'] == 'enabled' else False)
   # MakeDriver() annotates the testcase, so we must only set the testcase field
   # of the output result after we have called it.
   result.testcase.CopyFrom(testcase)
-  # Get a temporary file to write and run the driver from.
-  with tempfile.NamedTemporaryFile(prefix='deepsmith_', delete=False) as f:
-    path = pathlib.Path(f.name)
+  # The OpenCL platform and device are selected when the driver is run.
   try:
-    CompileDriver(driver, path, platform_id, device_id, cflags=cflags)
-    timeout = testcase.harness.opts.get('timeout_seconds', '60')
-    cmd = ['timeout', '-s9', timeout, f.name]
+    if driver_cache:
+      return result, driver_cache.Acquire(driver, cflags)
+    # Get a temporary file to write and run the driver from.
+    with tempfile.NamedTemporaryFile(prefix='deepsmith_', delete=False) as f:
+      path = pathlib.Path(f.name)
+    try:
+      return result, CompileDriver(driver, path, None, None, cflags=cflags)
+    except DriverCompilationError:
+      fs.rm(path)
+      raise
+  except DriverCompilationError as e:
+    logging.warning('%s', e)
+    result.outcome = deepsmith_pb2.Result.UNKNOWN
+    return result, None
+
+
+def RunDriver(opencl_environment: env.OpenCLEnvironment,
+              result: deepsmith_pb2.Result,
+              path: typing.Optional[pathlib.Path],
+              driver_cache: typing.Optional[DriverCache] = None
+              ) -> deepsmith_pb2.Result:
+  """Run a compiled driver and record its outcome.
+
+  Args:
+    opencl_environment: The OpenCL environment to run the driver in.
+    result: The partially complete result returned by BuildDriver().
+    path: The path of the compiled driver returned by BuildDriver(). If None,
+      the result is returned unmodified.
+    driver_cache: The cache which was passed to BuildDriver(), if any. The
+      driver is released to the cache once run. If not provided, the driver is
+      deleted once run.
+
+  Returns:
+    The result.
+  """
+  if path is None:
+    return result
+  try:
+    timeout = result.testcase.harness.opts.get('timeout_seconds', '60')
+    platform_id, device_id = opencl_environment.ids()
+    cmd = ['timeout', '-s9', timeout, str(path),
+           '-p', str(platform_id), '-d', str(device_id)]
     start_time = labdate.GetUtcMillisecondsNow()
     proc = opencl_environment.Exec(cmd)
     end_time = labdate.GetUtcMillisecondsNow()
@@ -199,11 +429,11 @@ def RunTestcase(opencl_environment: env.OpenCLEnvironment,
         (end_time - start_time).total_seconds() * 1000))
     runtime.event_start_epoch_ms = labdate.MillisecondsTimestamp(start_time)
     result.outcome = GetResultOutcome(result)
-  except DriverCompilationError as e:
-    logging.warning('%s', e)
-    result.outcome = deepsmith_pb2.Result.UNKNOWN
   finally:
-    fs.rm(path)
+    if driver_cache:
+      driver_cache.Release(path)
+    else:
+      fs.rm(path)
   return result
 
 
@@ -262,7 +492,8 @@ def MakeDriver(testcase: deepsmith_pb2.Testcase,
 
 
 def CompileDriver(src: str, output_path: pathlib.Path,
-                  platform_id: int, device_id: int,
+                  platform_id: typing.Optional[int],
+                  device_id: typing.Optional[int],
                   timeout_seconds: int = 60,
                   cflags: typing.List[str] = None) -> pathlib.Path:
   """Compile driver binary from source.
@@ -270,8 +501,10 @@ def CompileDriver(src: str, output_path: pathlib.Path,
   Args:
     src: The C source code to compile.
     output_path: The path to the binary to generate.
-    platform_id: The OpenCL platform ID.
-    device_id: The OpenCL device ID.
+    platform_id: The default OpenCL platform ID. If None, the platform must be
+      selected at runtime using the '-p' argument, else platform 0 is used.
+    device_id: The default OpenCL device ID. If None, the device must be
+      selected at runtime using the '-d' argument, else device 0 is used.
     timeout_seconds: The number of seconds to allow for compilation.
 
   Returns:
@@ -283,7 +516,6 @@ def CompileDriver(src: str, output_path: pathlib.Path,
   cmd = [
     'timeout', '-s9', str(timeout_seconds),
     str(CLANG_PATH), '-xc', '-', '-o', str(output_path),
-    f'-DPLATFORM_ID={platform_id}', f'-DDEVICE_ID={device_id}',
     '-ferror-limit=1', '-std=c99', '-Wno-deprecated-declarations',
     # Add OpenCL headers.
     '-isystem', str(OPENCL_HEADERS_DIR),
@@ -300,6 +532,10 @@ def CompileDriver(src: str, output_path: pathlib.Path,
     ]
   elif system.is_mac():
     cmd += ['-framework', 'OpenCL']
+  if platform_id is not None:
+    cmd.append(f'-DPLATFORM_ID={platform_id}')
+  if device_id is not None:
+    cmd.append(f'-DDEVICE_ID={device_id}')
   # Add any additional cflags.
   if cflags:
     cmd += cflags
@@ -136,6 +136,71 @@ def test_CompileDriver_valid_cflags():
     assert (pathlib.Path(d) / 'exe').is_file()
 
 
+# DriverCache tests.
+
+def test_DriverCache_Acquire_hit():
+  """Test that a driver is compiled once."""
+  with tempfile.TemporaryDirectory() as d:
+    cache = cldrive.DriverCache(pathlib.Path(d), 1024 * 1024 * 1024)
+    p1 = cache.Acquire('int main() {return 0;}')
+    cache.Release(p1)
+    p2 = cache.Acquire('int main() {return 0;}')
+    cache.Release(p2)
+    assert p1 == p2
+    assert p2.is_file()
+    assert cache.misses == 1
+    assert cache.hits == 1
+
+
+def test_DriverCache_Acquire_cflags():
+  """Test that drivers compiled with different flags are cached separately."""
+  with tempfile.TemporaryDirectory() as d:
+    cache = cldrive.DriverCache(pathlib.Path(d), 1024 * 1024 * 1024)
+    p1 = cache.Acquire('int main() {return 0;}')
+    p2 = cache.Acquire('int main() {return 0;}', ['-O3'])
+    assert p1 != p2
+    assert cache.misses == 2
+
+
+def test_DriverCache_Acquire_DriverCompilationError():
+  """Test that failed compilations are not cached."""
+  with tempfile.TemporaryDirectory() as d:
+    cache = cldrive.DriverCache(pathlib.Path(d), 1024 * 1024 * 1024)
+    with pytest.raises(cldrive.DriverCompilationError):
+      cache.Acquire('ina39lid s#yntax!')
+    assert not list(pathlib.Path(d).iterdir())
+    assert not cache.size
+
+
+def test_DriverCache_evicts_least_recently_used():
+  """Test that released drivers are evicted when the cache is full."""
+  with tempfile.TemporaryDirectory() as d:
+    cache = cldrive.DriverCache(pathlib.Path(d), 1)
+    p1 = cache.Acquire('int main() {return 0;}')
+    p2 = cache.Acquire('int main() {return 1;}')
+    # Drivers which are in use are not evicted.
+    assert p1.is_file()
+    assert p2.is_file()
+    cache.Release(p1)
+    assert not p1.is_file()
+    assert p2.is_file()
+    cache.Release(p2)
+    assert not p2.is_file()
+    assert not cache.size
+
+
+def test_DriverCache_reuses_existing_drivers():
+  """Test that drivers compiled by a previous cache are reused."""
+  with tempfile.TemporaryDirectory() as d:
+    cache = cldrive.DriverCache(pathlib.Path(d), 1024 * 1024 * 1024)
+    cache.Release(cache.Acquire('int main() {return 0;}'))
+    cache = cldrive.DriverCache(pathlib.Path(d), 1024 * 1024 * 1024)
+    assert cache.size
+    cache.Release(cache.Acquire('int main() {return 0;}'))
+    assert cache.hits == 1
+    assert not cache.misses
+
+
 # MakeDriver() tests.
 
 
@@ -274,6 +339,16 @@ def test_CldriveHarness_oclgrind_testbed():
   assert harness.testbeds[1].opts['opencl_opt'] == 'disabled'
 
 
+def test_CldriveHarness_opencl_max_concurrent_runs_length_mismatch():
+  """Test that ValueError raised if concurrency list has wrong length."""
+  config = harness_pb2.CldriveHarness()
+  config.opencl_env.extend([gpu.cldrive.env.OclgrindOpenCLEnvironment().name])
+  config.opencl_opt.extend([True])
+  config.opencl_max_concurrent_runs.extend([1, 2])
+  with pytest.raises(ValueError):
+    cldrive.CldriveHarness(config)
+
+
 def test_CldriveHarness_RunTestcases_no_testbed():
   """Test that invalid request params returned if no testbed requested."""
   config = harness_pb2.CldriveHarness()
@@ -334,6 +409,42 @@ def test_CldriveHarness_RunTestcases_oclgrind_abc_testcase(
     '240 241 242 243 244 245 246 247 248 249 250 251 252 253 254 255\n')
 
 
+def test_CldriveHarness_RunTestcases_concurrent_results_order(
+    abc_harness_config, abc_testcase):
+  """Test that concurrently run testcases are returned in request order."""
+  abc_harness_config.opencl_max_concurrent_runs.extend([4])
+  harness = cldrive.CldriveHarness(abc_harness_config)
+  testcases = []
+  for i in range(8):
+    testcase = deepsmith_pb2.Testcase()
+    testcase.CopyFrom(abc_testcase)
+    testcase.inputs['src'] = (
+      f'kernel void A(global int* a) {{a[get_global_id(0)] = {i};}}')
+    testcases.append(testcase)
+  # One of the kernels fails to build.
+  testcases[3].inputs['src'] = 'kernel void A(global int* a) {'
+  req = harness_pb2.RunTestcasesRequest(
+      testbed=harness.testbeds[0], testcases=testcases)
+  res = harness.RunTestcases(req, None)
+  assert res.status.returncode == service_pb2.ServiceStatus.SUCCESS
+  assert len(res.results) == 8
+  for i, result in enumerate(res.results):
+    assert result.testcase.inputs['src'] == testcases[i].inputs['src']
+    if i != 3:
+      assert result.outcome == deepsmith_pb2.Result.PASS
+      assert result.outputs['stdout'].startswith(f'global int * a: {i} 1 2')
+
+
+def test_CldriveHarness_RunTestcases_driver_cache(
+    abc_harness, abc_run_testcases_request):
+  """Test that a driver is compiled once and reused by later requests."""
+  for _ in range(2):
+    res = abc_harness.RunTestcases(abc_run_testcases_request, None)
+    assert res.results[0].outcome == deepsmith_pb2.Result.PASS
+  assert abc_harness.driver_cache.misses == 1
+  assert abc_harness.driver_cache.hits == 1
+
+
 def test_CldriveHarness_RunTestcases_driver_cflags(
     abc_harness_config, abc_run_testcases_request):
   """Test that valid driver cflags do not break the build."""
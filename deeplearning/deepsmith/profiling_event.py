@@ -1,5 +1,6 @@
 """This file implements profiling events."""
 import datetime
+import typing
 
 import sqlalchemy as sql
 from sqlalchemy import orm
@@ -17,6 +18,32 @@ class ProfilingEventType(db.StringTable):
   __tablename__ = 'proviling_event_types'
 
 
+def _AddMany(session: db.session_t, table: db.Table, owner_id_column: str,
+             events: typing.List[typing.Tuple[
+               int, deepsmith_pb2.ProfilingEvent]]) -> None:
+  """Add many profiling events, resolving clients and types in bulk.
+
+  Args:
+    session: A database session.
+    table: The profiling event table.
+    owner_id_column: The name of the column which references the owner of
+      the event.
+    events: A list of <owner_id, event> tuples.
+  """
+  client_ids = deeplearning.deepsmith.client.Client.GetOrAddMany(
+      session, (event.client for _, event in events))
+  type_ids = ProfilingEventType.GetOrAddMany(
+      session, (event.type for _, event in events))
+  db.InsertIgnore(session, table, [{
+    owner_id_column: owner_id,
+    'client_id': client_ids[event.client],
+    'type_id': type_ids[event.type],
+    'duration_ms': event.duration_ms,
+    'event_start': labdate.DatetimeFromMillisecondsTimestamp(
+        event.event_start_epoch_ms),
+  } for owner_id, event in events])
+
+
 class TestcaseProfilingEvent(db.Table):
   id_t = sql.Integer
   __tablename__ = 'testcase_profiling_events'
@@ -92,6 +119,20 @@ class TestcaseProfilingEvent(db.Table):
         event_start=labdate.DatetimeFromMillisecondsTimestamp(
             proto.event_start_epoch_ms))
 
+  @classmethod
+  def AddMany(cls, session: db.session_t,
+              events: typing.List[typing.Tuple[
+                int, deepsmith_pb2.ProfilingEvent]]) -> None:
+    """Add many profiling events.
+
+    Events which duplicate an existing <testcase, client, type> are ignored.
+
+    Args:
+      session: A database session.
+      events: A list of <testcase_id, event> tuples.
+    """
+    _AddMany(session, cls, 'testcase_id', events)
+
 
 class ResultProfilingEvent(db.Table):
   id_t = sql.Integer
@@ -167,3 +208,17 @@ class ResultProfilingEvent(db.Table):
         duration_ms=proto.duration_ms,
         event_start=labdate.DatetimeFromMillisecondsTimestamp(
             proto.event_start_epoch_ms))
+
+  @classmethod
+  def AddMany(cls, session: db.session_t,
+              events: typing.List[typing.Tuple[
+                int, deepsmith_pb2.ProfilingEvent]]) -> None:
+    """Add many profiling events.
+
+    Events which duplicate an existing <result, client, type> are ignored.
+
+    Args:
+      session: A database session.
+      events: A list of <result_id, event> tuples.
+    """
+    _AddMany(session, cls, 'result_id', events)
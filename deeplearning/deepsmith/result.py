@@ -58,7 +58,9 @@ class Result(db.Table):
 
   # Constraints.
   __table_args__ = (
-    sql.UniqueConstraint('testcase_id', 'testbed_id', name='unique_result'),)
+    sql.UniqueConstraint('testcase_id', 'testbed_id', name='unique_result'),
+    # Used to find the testcases which have no result for a testbed.
+    sql.Index('ix_results_testbed_testcase', 'testbed_id', 'testcase_id'),)
 
   @property
   def outcome(self) -> deepsmith_pb2.Result.Outcome:
@@ -170,6 +172,91 @@ class Result(db.Table):
 
     return result
 
+  @classmethod
+  def Digest(cls, proto: deepsmith_pb2.Result) -> typing.Dict[str, typing.Any]:
+    """Compute the digests of a result, without a database session.
+
+    This is the CPU-bound part of GetOrAddMany(), so it can be done in a worker
+    process.
+
+    Args:
+      proto: A Result message.
+
+    Returns:
+      The digest of the testcase, the output set ID, and the column values of
+      the output values.
+    """
+    return {
+      'testcase': deeplearning.deepsmith.testcase.Testcase.Digest(
+          proto.testcase),
+      'outputset_id': db.OptSetId(proto.outputs),
+      'output_values': {value: ResultOutputValue._ColumnValues(value)
+                        for value in proto.outputs.values()},
+    }
+
+  @classmethod
+  def GetOrAddMany(cls, session: db.session_t,
+                   protos: typing.List[deepsmith_pb2.Result],
+                   digests: typing.Optional[
+                     typing.List[typing.Dict[str, typing.Any]]] = None
+                   ) -> typing.List[int]:
+    """Resolve the IDs of many Results, adding those which do not exist.
+
+    This is the bulk equivalent of GetOrAdd(). As with GetOrAdd(), a result is
+    only added if its <testcase, testbed> tuple is unique, and profiling events
+    are recorded only for new results.
+
+    Args:
+      session: A database session.
+      protos: Result messages.
+      digests: The Digest() of each of protos. If not provided, they are
+        computed.
+
+    Returns:
+      The Result IDs, in the same order as protos.
+    """
+    if digests is None:
+      digests = [cls.Digest(proto) for proto in protos]
+    testcase_ids = deeplearning.deepsmith.testcase.Testcase.GetOrAddMany(
+        session, [proto.testcase for proto in protos],
+        [digest['testcase'] for digest in digests])
+    testbed_ids = deeplearning.deepsmith.testbed.Testbed.GetOrAddMany(
+        session, [proto.testbed for proto in protos])
+    keys = list(zip(testcase_ids, testbed_ids))
+    key_columns = ['testcase_id', 'testbed_id']
+    ids = db.GetIds(session, cls, key_columns, keys)
+
+    # The first result for each new <testcase, testbed> tuple.
+    new_results = {}
+    new_digests = {}
+    for proto, digest, key in zip(protos, digests, keys):
+      if key not in ids and key not in new_results:
+        new_results[key] = proto
+        new_digests[key] = digest
+    new_protos = list(new_results.values())
+    outputset_ids = db.GetOrAddOptSets(
+        session, ResultOutputSet, ResultOutput, ResultOutputName,
+        ResultOutputValue, 'output_id', [proto.outputs for proto in new_protos],
+        [digest['outputset_id'] for digest in new_digests.values()],
+        {value: row for digest in new_digests.values()
+         for value, row in digest['output_values'].items()})
+    db.InsertIgnore(session, cls, [{
+      'testcase_id': testcase_id,
+      'testbed_id': testbed_id,
+      'returncode': proto.returncode,
+      'outputset_id': outputset_id,
+      'outcome_num': proto.outcome,
+    } for ((testcase_id, testbed_id), proto), outputset_id in zip(
+        new_results.items(), outputset_ids)])
+    new_ids = db.GetIds(session, cls, key_columns, new_results.keys())
+    ids.update(new_ids)
+
+    profiling_event.ResultProfilingEvent.AddMany(session, [
+      (new_ids[key], event) for key, proto in new_results.items()
+      for event in proto.profiling_events])
+
+    return [ids[key] for key in keys]
+
   @classmethod
   def ProtoFromFile(cls, path: pathlib.Path) -> deepsmith_pb2.Result:
     """Instantiate a protocol buffer result from file.
@@ -309,6 +396,35 @@ class ResultOutputValue(db.Table):
     Returns:
       A ResultOutputValue instance.
     """
+    return labm8.sqlutil.GetOrAdd(session, cls, **cls._ColumnValues(string))
+
+  @classmethod
+  def GetOrAddMany(cls, session: db.session_t,
+                   strings: typing.Iterable[str],
+                   rows: typing.Optional[
+                     typing.Dict[str, typing.Dict[str, typing.Any]]] = None
+                   ) -> typing.Dict[str, int]:
+    """Resolve the IDs of many ResultOutputValues.
+
+    Args:
+      session: A database session.
+      strings: The strings.
+      rows: A map from string to its precomputed column values. The column
+        values of strings which are not in the map are computed.
+
+    Returns:
+      A map from string to ResultOutputValue ID.
+    """
+    rows = rows or {}
+    rows = {string: rows.get(string) or cls._ColumnValues(string)
+            for string in set(strings)}
+    ids = db.GetOrAddMany(session, cls, ['original_md5'], list(rows.values()))
+    return {string: ids[(row['original_md5'],)]
+            for string, row in rows.items()}
+
+  @classmethod
+  def _ColumnValues(cls, string: str) -> typing.Dict[str, typing.Any]:
+    """Compute the column values of a string."""
     original_charcount = len(string)
     original_linecount = string.count('\n')
     md5_ = hashlib.md5()
@@ -328,16 +444,16 @@ class ResultOutputValue(db.Table):
       truncated_md5 = original_md5
       truncated_linecount = original_linecount
       truncated_charcount = original_charcount
-    return labm8.sqlutil.GetOrAdd(
-        session, cls,
-        original_md5=original_md5,
-        original_linecount=original_linecount,
-        original_charcount=original_charcount,
-        truncated=True if original_charcount > cls.max_len else False,
-        truncated_value=truncated,
-        truncated_md5=truncated_md5,
-        truncated_linecount=truncated_linecount,
-        truncated_charcount=truncated_charcount, )
+    return {
+      'original_md5': original_md5,
+      'original_linecount': original_linecount,
+      'original_charcount': original_charcount,
+      'truncated': True if original_charcount > cls.max_len else False,
+      'truncated_value': truncated,
+      'truncated_md5': truncated_md5,
+      'truncated_linecount': truncated_linecount,
+      'truncated_charcount': truncated_charcount,
+    }
 
   def __repr__(self):
     return self.truncated_value[:50] or ''
@@ -385,4 +501,8 @@ class PendingResult(db.Table):
 
   # Constraints:
   __table_args__ = (sql.UniqueConstraint('testcase_id', 'testbed_id',
-                                         name='unique_pending_result'),)
+                                         name='unique_pending_result'),
+                    # Used to find the testcases which have no pending result
+                    # for a testbed.
+                    sql.Index('ix_pending_results_testbed_testcase',
+                              'testbed_id', 'testcase_id'),)
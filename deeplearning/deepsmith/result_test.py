@@ -380,6 +380,43 @@ def test_duplicate_results_ignored(session):
   assert r3.profiling_events[1].duration_ms == 100
 
 
+def test_Result_GetOrAddMany(ds):
+  """Test that results are only added if <testcase, testbed> is unique."""
+  protos = [deepsmith_pb2.Result(
+      testcase=deepsmith_pb2.Testcase(
+          toolchain='cpp',
+          generator=deepsmith_pb2.Generator(name='generator'),
+          harness=deepsmith_pb2.Harness(name='harness'),
+          inputs={'src': f'void main() {{ {i % 3}; }}'},
+      ),
+      testbed=deepsmith_pb2.Testbed(
+          toolchain='cpp',
+          name='clang',
+          opts={'arch': 'x86_64'},
+      ),
+      returncode=i,
+      outputs={'stdout': 'Hello, world!' * i},
+      profiling_events=[
+        deepsmith_pb2.ProfilingEvent(
+            client='localhost',
+            type='exec',
+            duration_ms=i,
+            event_start_epoch_ms=1123123123,
+        ),
+      ],
+      outcome=deepsmith_pb2.Result.PASS,
+  ) for i in range(6)]
+  with ds.Session(commit=True) as session:
+    ids = deeplearning.deepsmith.result.Result.GetOrAddMany(session, protos)
+    assert ids[:3] == ids[3:]
+    assert len(set(ids)) == 3
+    # Only the first result for each testcase is added.
+    for proto, id_ in zip(protos[:3], ids):
+      result = session.query(deeplearning.deepsmith.result.Result).filter(
+          deeplearning.deepsmith.result.Result.id == id_).one()
+      assert result.ToProto() == proto
+
+
 def main(argv):  # pylint: disable=missing-docstring
   del argv
   sys.exit(pytest.main([__file__, '-v']))
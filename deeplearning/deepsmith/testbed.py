@@ -113,6 +113,12 @@ class Testbed(db.Table):
     Returns:
       A Testbed.
     """
+    cache = db.IdentityCache.FromSession(session)
+    key = (cls, proto.toolchain, proto.name, tuple(sorted(proto.opts.items())))
+    testbed = cache.Get(session, key)
+    if testbed:
+      return testbed
+
     toolchain = deeplearning.deepsmith.toolchain.Toolchain.GetOrAdd(session,
                                                                     proto.toolchain)
 
@@ -135,9 +141,36 @@ class Testbed(db.Table):
     for opt in opts:
       db.GetOrAdd(session, TestbedOptSet, id=optset_id, opt=opt)
 
-    return labm8.sqlutil.GetOrAdd(session, cls, toolchain=toolchain,
-                                  name=proto.name,
-                                  optset_id=optset_id, )
+    return cache.Put(key, labm8.sqlutil.GetOrAdd(session, cls,
+                                                 toolchain=toolchain,
+                                                 name=proto.name,
+                                                 optset_id=optset_id, ))
+
+  @classmethod
+  def GetOrAddMany(cls, session: db.session_t,
+                   protos: typing.List[deepsmith_pb2.Testbed]
+                   ) -> typing.List[int]:
+    """Resolve the IDs of many Testbeds, adding those which do not exist.
+
+    Args:
+      session: A database session.
+      protos: Testbed messages.
+
+    Returns:
+      The Testbed IDs, in the same order as protos.
+    """
+    toolchain_ids = deeplearning.deepsmith.toolchain.Toolchain.GetOrAddMany(
+        session, [proto.toolchain for proto in protos])
+    optset_ids = db.GetOrAddOptSets(
+        session, TestbedOptSet, TestbedOpt, TestbedOptName, TestbedOptValue,
+        'opt_id', [proto.opts for proto in protos])
+    keys = [(toolchain_ids[proto.toolchain], proto.name, optset_id)
+            for proto, optset_id in zip(protos, optset_ids)]
+    ids = db.GetOrAddMany(
+        session, cls, ['toolchain_id', 'name', 'optset_id'],
+        [{'toolchain_id': toolchain_id, 'name': name, 'optset_id': optset_id}
+         for toolchain_id, name, optset_id in keys])
+    return [ids[key] for key in keys]
 
 
 class TestbedOptSet(db.Table):
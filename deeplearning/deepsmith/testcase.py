@@ -211,6 +211,95 @@ class Testcase(db.Table):
 
     return testcase
 
+  @classmethod
+  def Digest(cls, proto: deepsmith_pb2.Testcase
+             ) -> typing.Dict[str, typing.Any]:
+    """Compute the digests of a testcase, without a database session.
+
+    This is the CPU-bound part of GetOrAddMany(), so it can be done in a worker
+    process.
+
+    Args:
+      proto: A Testcase message.
+
+    Returns:
+      The input set ID, the invariant opt set ID, and the column values of
+      the input values.
+    """
+    return {
+      'inputset_id': db.OptSetId(proto.inputs),
+      'invariant_optset_id': db.OptSetId(proto.invariant_opts),
+      'input_values': {value: TestcaseInputValue._ColumnValues(value)
+                       for value in proto.inputs.values()},
+    }
+
+  @classmethod
+  def GetOrAddMany(cls, session: db.session_t,
+                   protos: typing.List[deepsmith_pb2.Testcase],
+                   digests: typing.Optional[
+                     typing.List[typing.Dict[str, typing.Any]]] = None
+                   ) -> typing.List[int]:
+    """Resolve the IDs of many Testcases, adding those which do not exist.
+
+    This is the bulk equivalent of GetOrAdd(). Rather than a chain of queries
+    per testcase, each table is resolved using a single lookup for the entire
+    batch, and missing rows are added using multi-row inserts. As with
+    GetOrAdd(), profiling events are recorded only for new testcases.
+
+    Args:
+      session: A database session.
+      protos: Testcase messages.
+      digests: The Digest() of each of protos. If not provided, they are
+        computed.
+
+    Returns:
+      The Testcase IDs, in the same order as protos.
+    """
+    if digests is None:
+      digests = [cls.Digest(proto) for proto in protos]
+    toolchain_ids = deeplearning.deepsmith.toolchain.Toolchain.GetOrAddMany(
+        session, [proto.toolchain for proto in protos])
+    generator_ids = deeplearning.deepsmith.generator.Generator.GetOrAddMany(
+        session, [proto.generator for proto in protos])
+    harness_ids = deeplearning.deepsmith.harness.Harness.GetOrAddMany(
+        session, [proto.harness for proto in protos])
+    inputset_ids = db.GetOrAddOptSets(
+        session, TestcaseInputSet, TestcaseInput, TestcaseInputName,
+        TestcaseInputValue, 'input_id', [proto.inputs for proto in protos],
+        [digest['inputset_id'] for digest in digests],
+        {value: row for digest in digests
+         for value, row in digest['input_values'].items()})
+    invariant_optset_ids = db.GetOrAddOptSets(
+        session, TestcaseInvariantOptSet, TestcaseInvariantOpt,
+        TestcaseInvariantOptName, TestcaseInvariantOptValue,
+        'invariant_opt_id', [proto.invariant_opts for proto in protos],
+        [digest['invariant_optset_id'] for digest in digests])
+
+    key_columns = ['toolchain_id', 'generator_id', 'harness_id', 'inputset_id',
+                   'invariant_optset_id']
+    keys = [(toolchain_ids[proto.toolchain],) + key for proto, key in zip(
+        protos, zip(generator_ids, harness_ids, inputset_ids,
+                    invariant_optset_ids))]
+    # There is no unique constraint on testcases, so we must determine which
+    # testcases are new before inserting them.
+    ids = db.GetIds(session, cls, key_columns, keys)
+    new_keys = list(dict.fromkeys(key for key in keys if key not in ids))
+    db.InsertIgnore(session, cls,
+                    [dict(zip(key_columns, key)) for key in new_keys])
+    new_ids = db.GetIds(session, cls, key_columns, new_keys)
+    ids.update(new_ids)
+
+    # Add profiling events of the first occurrence of each new testcase.
+    events = []
+    for proto, key in zip(protos, keys):
+      if key in new_ids:
+        events += [(new_ids.pop(key), event)
+                   for event in proto.profiling_events]
+    deeplearning.deepsmith.profiling_event.TestcaseProfilingEvent.AddMany(
+        session, events)
+
+    return [ids[key] for key in keys]
+
   @classmethod
   def ProtoFromFile(cls, path: pathlib.Path) -> deepsmith_pb2.Testcase:
     """Instantiate a protocol buffer testcase from file.
@@ -367,13 +456,42 @@ class TestcaseInputValue(db.Table):
     Returns:
       A TestcaseInputValue instance.
     """
+    return labm8.sqlutil.GetOrAdd(session, cls, **cls._ColumnValues(string))
+
+  @classmethod
+  def GetOrAddMany(cls, session: db.session_t,
+                   strings: typing.Iterable[str],
+                   rows: typing.Optional[
+                     typing.Dict[str, typing.Dict[str, typing.Any]]] = None
+                   ) -> typing.Dict[str, int]:
+    """Resolve the IDs of many TestcaseInputValues.
+
+    Args:
+      session: A database session.
+      strings: The strings.
+      rows: A map from string to its precomputed column values. The column
+        values of strings which are not in the map are computed.
+
+    Returns:
+      A map from string to TestcaseInputValue ID.
+    """
+    rows = rows or {}
+    rows = {string: rows.get(string) or cls._ColumnValues(string)
+            for string in set(strings)}
+    ids = db.GetOrAddMany(session, cls, ['md5'], list(rows.values()))
+    return {string: ids[(row['md5'],)] for string, row in rows.items()}
+
+  @staticmethod
+  def _ColumnValues(string: str) -> typing.Dict[str, typing.Any]:
+    """Compute the column values of a string."""
     md5 = hashlib.md5()
     md5.update(string.encode('utf-8'))
-
-    return labm8.sqlutil.GetOrAdd(session, cls, md5=md5.digest(),
-                                  charcount=len(string),
-                                  linecount=string.count('\n'),
-                                  string=string, )
+    return {
+      'md5': md5.digest(),
+      'charcount': len(string),
+      'linecount': string.count('\n'),
+      'string': string,
+    }
 
   def __repr__(self):
     return self.string[:50] or ''
@@ -454,11 +572,14 @@ class TestcaseInvariantOpt(db.Table):
     Returns:
       A TestcaseInvariantOpt instance.
     """
-    return labm8.sqlutil.GetOrAdd(session, cls,
-                                  name=TestcaseInvariantOptName.GetOrAdd(
-                                      session, string=name, ),
-                                  value=TestcaseInvariantOptValue.GetOrAdd(
-                                      session, string=value, ), )
+    cache = db.IdentityCache.FromSession(session)
+    key = (cls, name, value)
+    return cache.Get(session, key) or cache.Put(
+        key, labm8.sqlutil.GetOrAdd(session, cls,
+                                    name=TestcaseInvariantOptName.GetOrAdd(
+                                        session, string=name, ),
+                                    value=TestcaseInvariantOptValue.GetOrAdd(
+                                        session, string=value, ), ))
 
 
 class TestcaseInvariantOptName(db.StringTable):
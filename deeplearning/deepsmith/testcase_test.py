@@ -218,6 +218,66 @@ def test_duplicate_testcases_ignored(session):
   assert t3.profiling_events[1].duration_ms == 100
 
 
+def test_Testcase_GetOrAddMany_GetOrAdd_equivalence(ds):
+  """Test that bulk and per-testcase ingestion produce the same testcases."""
+  protos = [deepsmith_pb2.Testcase(
+      toolchain='cpp',
+      generator=deepsmith_pb2.Generator(name='generator', opts={'i': str(i)}),
+      harness=deepsmith_pb2.Harness(name='harness'),
+      inputs={'src': f'void main() {{ {i}; }}', 'data': '[1,2]'},
+      invariant_opts={'config': 'opt'},
+      profiling_events=[
+        deepsmith_pb2.ProfilingEvent(
+            client='localhost',
+            type='generate',
+            duration_ms=i,
+            event_start_epoch_ms=1021312312,
+        ),
+      ]
+  ) for i in range(10)]
+  with ds.Session(commit=True) as session:
+    ids = deeplearning.deepsmith.testcase.Testcase.GetOrAddMany(
+        session, protos)
+    assert len(set(ids)) == 10
+    for proto, id_ in zip(protos, ids):
+      testcase = deeplearning.deepsmith.testcase.Testcase.GetOrAdd(
+          session, proto)
+      assert testcase.id == id_
+      assert testcase.ToProto() == proto
+    assert session.query(deeplearning.deepsmith.testcase.Testcase).count() == 10
+
+
+def test_Testcase_GetOrAddMany_duplicates_ignored(ds):
+  """Test that duplicate testcases in a batch are added only once."""
+  proto = deepsmith_pb2.Testcase(
+      toolchain='cpp',
+      generator=deepsmith_pb2.Generator(name='generator'),
+      harness=deepsmith_pb2.Harness(name='harness'),
+      inputs={'src': 'void main() {}'},
+      profiling_events=[
+        deepsmith_pb2.ProfilingEvent(
+            client='localhost',
+            type='generate',
+            duration_ms=100,
+            event_start_epoch_ms=1021312312,
+        ),
+      ]
+  )
+  duplicate = deepsmith_pb2.Testcase()
+  duplicate.CopyFrom(proto)
+  duplicate.profiling_events[0].duration_ms = -1
+  with ds.Session(commit=True) as session:
+    ids = deeplearning.deepsmith.testcase.Testcase.GetOrAddMany(
+        session, [proto, duplicate])
+    assert ids[0] == ids[1]
+    # A second batch resolves to the existing testcase.
+    assert deeplearning.deepsmith.testcase.Testcase.GetOrAddMany(
+        session, [duplicate]) == ids[:1]
+    testcase = session.query(deeplearning.deepsmith.testcase.Testcase).one()
+    assert len(testcase.profiling_events) == 1
+    assert testcase.profiling_events[0].duration_ms == 100
+
+
 # Benchmarks.
 
 
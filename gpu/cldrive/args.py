@@ -1,5 +1,8 @@
 """OpenCL argument and type handling."""
+import collections
+import hashlib
 import re
+import threading
 import typing
 
 import numpy as np
@@ -52,8 +55,18 @@ FORMAT_SPECIFIERS = {
   np.dtype("uint8"): "%hd",
 }
 
-# Private OpenCL parser instance.
+# Private OpenCL parser instance. The parser keeps state during a parse, so it
+# must only be used while holding _OPENCL_PARSER_LOCK.
 _OPENCL_PARSER = OpenCLCParser()
+_OPENCL_PARSER_LOCK = threading.Lock()
+
+# Matches any use of the kernel qualifier.
+_KERNEL_QUALIFIER_RE = re.compile(r'\b(?:__)?kernel\b')
+# Matches the signature of a kernel definition, capturing the kernel name and
+# its parameter list.
+_KERNEL_SIGNATURE_RE = re.compile(
+    r'\b(?:(?:__)?kernel\s+void|void\s+(?:__)?kernel)\s+(\w+)\s*'
+    r'\(([^()]*)\)\s*\{')
 
 
 class OpenCLPreprocessError(ValueError):
@@ -236,6 +249,79 @@ class ArgumentExtractor(NodeVisitor):
     return self._args
 
 
+class _ParseCache(object):
+  """A bounded, thread safe cache of the results of parsing kernels.
+
+  Results are keyed by the checksum of the kernel source. Exceptions are
+  cached too, since the same invalid kernels are parsed repeatedly. Only the
+  type and arguments of an exception are cached, and a new instance is raised
+  for every caller, since raising the same instance from several threads
+  would share its traceback and context. The cached functions are called
+  without holding the cache lock, so they must be thread safe themselves.
+  """
+
+  def __init__(self, max_size: int):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self._results = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def Get(self, name: str, src: str, fn: typing.Callable[[str], typing.Any]):
+    """Return fn(src), reusing the result of a previous call if possible.
+
+    Args:
+      name: The name of the cached function.
+      src: The OpenCL kernel source.
+      fn: The function to call with the source.
+
+    Returns:
+      The return value of fn(src).
+
+    Raises:
+      Exception: If fn(src) raises an exception.
+    """
+    key = (name, hashlib.sha1(src.encode('utf-8')).digest())
+    with self._lock:
+      result = self._results.get(key)
+      if result:
+        self.hits += 1
+        self._results.move_to_end(key)
+      else:
+        self.misses += 1
+    if result:
+      value, error = result
+      if error:
+        error_type, error_args = error
+        raise error_type(*error_args)
+      return value
+
+    try:
+      value = fn(src)
+    except Exception as e:
+      self._Put(key, (None, (type(e), e.args)))
+      raise
+    self._Put(key, (value, None))
+    return value
+
+  def Clear(self) -> None:
+    """Empty the cache."""
+    with self._lock:
+      self._results.clear()
+
+  def _Put(self, key: typing.Tuple[str, bytes],
+           result: typing.Tuple[typing.Any, typing.Any]) -> None:
+    with self._lock:
+      self._results[key] = result
+      while len(self._results) > self.max_size:
+        self._results.popitem(last=False)
+
+
+# The cache of kernel parse results. pycparser is slow, and the same kernel is
+# typically parsed by each of MakeData(), emit_c(), and DriveKernel().
+_PARSE_CACHE = _ParseCache(1024)
+
+
 def ParseSource(src: str) -> FileAST:
   """Parse OpenCL source code.
 
@@ -250,7 +336,8 @@ def ParseSource(src: str) -> FileAST:
       syntax error, or invalid types.
   """
   try:
-    ast = _OPENCL_PARSER.parse(src)
+    with _OPENCL_PARSER_LOCK:
+      ast = _OPENCL_PARSER.parse(src)
     # Strip pre-procesor line objects and rebuild the AST.
     # See: https://github.com/inducer/pycparserext/issues/27
     children = [x[1] for x in ast.children() if not isinstance(x[1], list)]
@@ -260,16 +347,45 @@ def ParseSource(src: str) -> FileAST:
     raise OpenCLValueError(f"Syntax error: '{e}'") from e
 
 
-def GetKernelArguments(src: str) -> typing.List[KernelArg]:
+def _ExtractKernelArguments(src: str) -> typing.List[KernelArg]:
+  visitor = ArgumentExtractor()
+  visitor.visit(ParseSource(src))
+  return visitor.args
+
+
+def _ExtractKernelArgumentsFromSignature(src: str) -> typing.List[KernelArg]:
+  """Extract kernel arguments by parsing only the kernel signature.
+
+  This is much faster than parsing the entire source, but only supports
+  sources with a single, plainly declared kernel. Other sources, and kernels
+  whose signature cannot be parsed in isolation (e.g. because they use types
+  which are defined elsewhere in the source), fall back to a full parse.
+  """
+  if len(_KERNEL_QUALIFIER_RE.findall(src)) == 1:
+    match = _KERNEL_SIGNATURE_RE.search(src)
+    if match:
+      try:
+        return _ExtractKernelArguments(
+            f'kernel void {match.group(1)}({match.group(2)}) {{}}')
+      except (OpenCLValueError, LookupError):
+        pass
+  return _ExtractKernelArguments(src)
+
+
+def GetKernelArguments(src: str, strict: bool = True) -> typing.List[KernelArg]:
   """Extract arguments for an OpenCL kernel.
 
   Accepts the source code for an OpenCL kernel and returns a list of its
-  arguments.
+  arguments. Results are cached, so repeated calls for the same source are
+  cheap.
 
   TODO(cec): Pre-process the source code.
 
   Args:
     src: The OpenCL kernel source.
+    strict: If False, only the kernel signature is parsed where possible,
+      so errors in the kernel body are not detected. Use this when the
+      kernel will be compiled anyway.
 
   Returns:
     A list of the kernel's arguments, in order.
@@ -302,16 +418,33 @@ def GetKernelArguments(src: str) -> typing.List[KernelArg]:
     Traceback (most recent call last):
     ...
     NoKernelError
+
+    >>> GetKernelArguments("kernel void A(global int* a) {@}", strict=False)
+    [global int * a]
   """
-  visitor = ArgumentExtractor()
+  if strict:
+    args = _PARSE_CACHE.Get('args', src, _ExtractKernelArguments)
+  else:
+    args = _PARSE_CACHE.Get(
+        'signature_args', src, _ExtractKernelArgumentsFromSignature)
+  # Return a copy so that callers cannot modify the cached list.
+  return list(args)
+
+
+def _ExtractKernelName(src: str) -> str:
+  visitor = ArgumentExtractor(extract_args=False)
   visitor.visit(ParseSource(src))
-  return visitor.args
+  if visitor.name:
+    return visitor.name
+  else:
+    raise NoKernelError('Source contains no kernel definitions')
 
 
 def GetKernelName(src: str) -> str:
   """Extract the name of an OpenCL kernel.
 
-  Accepts the source code for an OpenCL kernel and returns its name.
+  Accepts the source code for an OpenCL kernel and returns its name. Results
+  are cached, so repeated calls for the same source are cheap.
 
   Args:
     src: The OpenCL kernel source.
@@ -330,9 +463,4 @@ def GetKernelName(src: str) -> str:
     >>> GetKernelName("void kernel A(global float *a, const int b) {}")
     'A'
   """
-  visitor = ArgumentExtractor(extract_args=False)
-  visitor.visit(ParseSource(src))
-  if visitor.name:
-    return visitor.name
-  else:
-    raise NoKernelError('Source contains no kernel definitions')
+  return _PARSE_CACHE.Get('name', src, _ExtractKernelName)
@@ -1,5 +1,6 @@
 """Unit tests for //gpu/cldrive/args.py."""
 import sys
+from concurrent import futures
 
 import pytest
 from absl import app
@@ -136,6 +137,67 @@ kernel void A(const global int* a, global const float* b,
   assert not args_[2].is_const
 
 
+def test_GetKernelArguments_cached():
+  """Test that the source is parsed once."""
+  src = "kernel void A(global int* a, const int b) { a[0] = b; }"
+  hits = args._PARSE_CACHE.hits
+  args_ = args.GetKernelArguments(src)
+  assert args.GetKernelArguments(src) == args_
+  assert args._PARSE_CACHE.hits == hits + 1
+
+
+def test_GetKernelArguments_cached_copy():
+  """Test that modifying the returned list does not modify the cache."""
+  src = "kernel void A(global int* a, const int b) { a[1] = b; }"
+  args.GetKernelArguments(src).pop()
+  assert len(args.GetKernelArguments(src)) == 2
+
+
+def test_GetKernelArguments_cached_error():
+  """Test that errors are raised for every call, not just the first."""
+  errors = []
+  for _ in range(3):
+    with pytest.raises(args.OpenCLValueError) as e_info:
+      args.GetKernelArguments("kernel void A(@!")
+    errors.append(e_info.value)
+  # Every call raises a new exception with the same message.
+  assert len(set(id(e) for e in errors)) == 3
+  assert len(set(str(e) for e in errors)) == 1
+
+
+def test_GetKernelArguments_strict_body_syntax_error():
+  """Test that a syntax error in the body is an error in strict mode."""
+  with pytest.raises(args.OpenCLValueError):
+    args.GetKernelArguments("kernel void A(global int* a) { @ }")
+
+
+def test_GetKernelArguments_not_strict_body_syntax_error():
+  """Test that only the signature is parsed when not in strict mode."""
+  args_ = args.GetKernelArguments(
+      "kernel void A(global int* a) { @ }", strict=False)
+  assert len(args_) == 1
+  assert args_[0].address_space == 'global'
+
+
+def test_GetKernelArguments_not_strict_attributes():
+  """Test that unusual signatures fall back to a full parse."""
+  args_ = args.GetKernelArguments("""
+kernel __attribute__((reqd_work_group_size(1, 1, 1)))
+void A(global int* a) {}
+""", strict=False)
+  assert len(args_) == 1
+  assert args_[0].is_pointer
+
+
+def test_GetKernelArguments_not_strict_multiple_kernels():
+  """Test that multiple kernels are an error when not in strict mode."""
+  with pytest.raises(args.MultipleKernelsError):
+    args.GetKernelArguments("""
+kernel void A() {}
+kernel void B() {}
+""", strict=False)
+
+
 # ParseSource() tests.
 
 
@@ -157,6 +219,17 @@ def test_ParseSource_syntax_error():
     args.ParseSource(src)
 
 
+def test_ParseSource_concurrent():
+  """Test that kernels can be parsed from multiple threads at once."""
+  srcs = [f'kernel void A{i}(global int* a, const int b{i}) {{ a[0] = {i}; }}'
+          for i in range(50)]
+  with futures.ThreadPoolExecutor(8) as pool:
+    asts = list(pool.map(args.ParseSource, srcs))
+  for i, ast in enumerate(asts):
+    assert ast.ext[0].decl.name == f'A{i}'
+    assert ast.ext[0].decl.type.args.params[1].name == f'b{i}'
+
+
 # GetKernelName() tests.
 
 def test_GetKernelName_hello_world():
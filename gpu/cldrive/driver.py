@@ -1,22 +1,58 @@
+"""Drive OpenCL kernels over numpy arrays.
+
+Kernels are run by porcelain worker processes, so that a kernel which crashes
+the OpenCL implementation cannot take down the caller. Workers are long-lived:
+each keeps an OpenCL context for its device and receives jobs over its stdin,
+so that the cost of starting an interpreter and creating a context is paid
+once per worker, not once per kernel. Jobs and responses are exchanged as
+length-prefixed pickles:
+
+  <uint32 length><pickle>
+
+Kernel arguments are not pickled. They are written to a memory-mapped file in
+shared memory, which the worker maps and uses directly as the host memory of
+its OpenCL buffers, and in which it leaves the outputs.
+
+A worker which does not respond within the job timeout is killed, and a new
+worker is started for the next job.
+"""
+import atexit
 import collections
+import os
+import pathlib
 import pickle
+import queue
 import re
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import typing
 from contextlib import suppress
 from signal import Signals
-from subprocess import PIPE, Popen
-from tempfile import NamedTemporaryFile
 
 import numpy as np
 
 from gpu.cldrive import args as _args
 from gpu.cldrive import env as _env
 from labm8 import err
+from labm8 import framedproc
 
 
 ArgTuple = collections.namedtuple('ArgTuple', ['hostdata', 'devdata'])
 
+# The directory to create shared argument files in. On Linux, /dev/shm is
+# backed by memory, so arguments are never written to disk.
+_SHARED_MEMORY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# The alignment of arrays in shared argument files. Some OpenCL
+# implementations only avoid copying CL_MEM_USE_HOST_PTR buffers which are
+# page aligned.
+_SHARED_ARRAY_ALIGNMENT = 4096
+
+# The offset, dtype, and shape of an array in a shared argument file.
+SharedArrayLayout = typing.Tuple[int, str, typing.Tuple[int, ...]]
+
 
 class TimeoutError(RuntimeError):
   """Thrown if kernel executions fails to complete within time budget."""
@@ -116,7 +152,7 @@ def DriveKernel(env: _env.OpenCLEnvironment, src: str, inputs: np.array,
   """Drive an OpenCL kernel.
 
   Executes an OpenCL kernel on the given environment, over the given inputs.
-  Execution is performed in a subprocess.
+  Execution is performed in a porcelain worker process.
 
   Args:
     env: The OpenCL environment to run the kernel in.
@@ -175,7 +211,7 @@ def DriveKernel(env: _env.OpenCLEnvironment, src: str, inputs: np.array,
 
   # Parse args in this process since we want to preserve the sueful exception
   # type.
-  args = _args.GetKernelArguments(src)
+  args = _args.GetKernelArguments(src, strict=False)
 
   # Check that the number of inputs is correct.
   args_with_inputs = [i for i, arg in enumerate(args)
@@ -189,75 +225,352 @@ def DriveKernel(env: _env.OpenCLEnvironment, src: str, inputs: np.array,
     err.assert_or_raise(len(x), ValueError, f"Input {i} has size zero")
 
   # Copy inputs into the expected data types.
-  data = np.array([np.array(d).astype(a.numpy_type)
-                   for d, a in zip(inputs, args)])
-
-  job = {
-    "env": env,
-    "src": src,
-    "args": args,
-    "data": data,
-    "gsize": gsize,
-    "lsize": lsize,
-    "optimizations": optimizations,
-    "profiling": profiling
-  }
-
-  with NamedTemporaryFile('rb+', prefix='cldrive-', suffix='.job') as tmp_file:
-    porcelain_job_file = tmp_file.name
-
-    # Write job file.
-    pickle.dump(job, tmp_file)
-    tmp_file.flush()
-
-    # Enforce timeout using sigkill.
-    if timeout > 0:
-      cli = ["timeout", "--signal=9", str(int(timeout))]
-    else:
-      cli = []
-    cli += [sys.executable, __file__, porcelain_job_file]
+  data = [np.array(d).astype(args[i].numpy_type)
+          for d, i in zip(inputs, args_with_inputs)]
+
+  with tempfile.NamedTemporaryFile(prefix='cldrive-', suffix='.data',
+                                   dir=_SHARED_MEMORY_DIR) as f:
+    data_path = pathlib.Path(f.name)
+    job = {
+      "src": src,
+      "args": args,
+      "data_path": data_path,
+      "data_layout": WriteSharedArrays(data, data_path),
+      "gsize": gsize,
+      "lsize": lsize,
+      "optimizations": optimizations,
+      "profiling": profiling
+    }
+
+    Log("Porcelain worker:", env.name)
+    return_value = GetWorkerPool(env).Run(job, timeout)
+    # Copy the outputs out of shared memory before it is released.
+    outputs = np.array([np.array(x) for x in
+                        MapSharedArrays(data_path, job["data_layout"])])
+
+  if debug:
+    print(return_value["log"], file=sys.stderr)
+  elif profiling:
+    # Print profiling output when not in debug mode.
+    for line in return_value["log"].split('\n'):
+      if re.match(r'\[cldrive\] .+ time: [0-9]+\.[0-9]+ ms', line):
+        print(line, file=sys.stderr)
+
+  error = return_value["err"]
+  if error:  # Porcelain raised an exception, re-raise it.
+    raise error
+  else:
+    return outputs
+
+
+def WriteSharedArrays(arrays: typing.List[np.ndarray],
+                      path: pathlib.Path) -> typing.List[SharedArrayLayout]:
+  """Write arrays to a file which can be mapped by MapSharedArrays().
 
-    cli_str = " ".join(cli)
-    Log("Porcelain invocation:", cli_str)
+  Args:
+    arrays: The arrays to write.
+    path: The path of the file to write. Any existing file is overwritten.
 
-    # Fork and run.
-    process = Popen(cli, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
-    status = process.returncode
+  Returns:
+    The layout of the arrays in the file.
+  """
+  layout = []
+  size = 0
+  for array in arrays:
+    layout.append((size, array.dtype.str, array.shape))
+    # Round up to the alignment of the next array.
+    size += -(-array.nbytes // _SHARED_ARRAY_ALIGNMENT) * _SHARED_ARRAY_ALIGNMENT
+  # A file cannot be mapped if it is empty.
+  buf = np.memmap(str(path), dtype=np.uint8, mode='w+', shape=(max(size, 1),))
+  for array, (offset, _, _) in zip(arrays, layout):
+    buf[offset:offset + array.nbytes] = np.ascontiguousarray(
+        array).reshape(-1).view(np.uint8)
+  buf.flush()
+  return layout
+
+
+def MapSharedArrays(path: pathlib.Path, layout: typing.List[SharedArrayLayout]
+                    ) -> typing.List[np.ndarray]:
+  """Map the arrays in a file written by WriteSharedArrays().
 
-    if debug:
-      print(stdout.decode('utf-8').strip(), file=sys.stderr)
-      print(stderr.decode('utf-8').strip(), file=sys.stderr)
-    elif profiling:
-      # Print profiling output when not in debug mode.
-      for line in stderr.decode('utf-8').split('\n'):
-        if re.match(r'\[cldrive\] .+ time: [0-9]+\.[0-9]+ ms', line):
-          print(line, file=sys.stderr)
-    Log(f"Porcelain return code: {status}")
-
-    # Test for non-zero exit codes. The porcelain subprocess catches exceptions
-    # and completes gracefully, so a non-zero return code is indicative of a
-    # more serious problem.
-    #
-    # FIXME: I'm seeing a number of SIGABRT return codes which I can't explain.
-    # However, ignoring them seems to not cause a problem ...
-    if status != 0 and status != -Signals['SIGABRT'].value:
-      # A negative return code means a signal. Try and convert the value into a
-      # signal name.
+  Args:
+    path: The path of the file.
+    layout: The layout of the arrays in the file.
+
+  Returns:
+    A list of arrays. Writes to the arrays are visible to every process which
+    has mapped the file.
+  """
+  if not layout:
+    return []
+  buf = np.memmap(str(path), dtype=np.uint8, mode='r+')
+  arrays = []
+  for offset, dtype, shape in layout:
+    nbytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+    arrays.append(buf[offset:offset + nbytes].view(dtype).reshape(shape))
+  return arrays
+
+
+class PorcelainWorker(object):
+  """A long-lived porcelain process which runs jobs on one OpenCL device.
+
+  The process is started lazily on the first call to Run(), and restarted if
+  it is killed or crashes. Instances are not thread safe.
+  """
+
+  def __init__(self, env: _env.OpenCLEnvironment):
+    """Instantiate a porcelain worker.
+
+    Args:
+      env: The OpenCL environment to run jobs in.
+    """
+    self.env = env
+    platform_id, device_id = env.ids()
+    # The worker's stderr is not read, so it must not be a pipe or the worker
+    # would block once the pipe buffer fills.
+    self._process = framedproc.FramedProcess(
+        [sys.executable, __file__, str(platform_id), str(device_id)],
+        popen=env.Popen, stderr=subprocess.DEVNULL)
+
+  @property
+  def pid(self) -> typing.Optional[int]:
+    """The pid of the worker, or None if it is not running."""
+    return self._process.pid
+
+  def Run(self, job: typing.Dict[str, typing.Any],
+          timeout: int = -1) -> typing.Dict[str, typing.Any]:
+    """Run a job and wait for the response.
+
+    Args:
+      job: The job to run.
+      timeout: The number of seconds to wait for the response. A value <= 0
+        means wait forever.
+
+    Returns:
+      The response, a dictionary with "err" and "log" keys.
+
+    Raises:
+      TimeoutError: If the worker does not respond in time. The worker is
+        killed, and will be restarted by the next call.
+      PorcelainError: If the worker exits before responding.
+    """
+    if not self._process.running:
+      self._process.Start()
+    deadline = time.time() + timeout if timeout > 0 else None
+    try:
+      return pickle.loads(self._process.Call(pickle.dumps(job), deadline))
+    except framedproc.FrameTimeout:
+      self.Stop()
+      raise TimeoutError(timeout)
+    except (OSError, EOFError):
+      # The worker died. A negative return code means a signal. Try and convert
+      # the value into a signal name.
+      status = self._process.Stop()
       with suppress(ValueError):
         status = Signals(-status).name
+      raise PorcelainError(status)
+
+  def Stop(self) -> None:
+    """Terminate the worker, if it is running."""
+    self._process.Stop()
+
+
+class PorcelainWorkerPool(object):
+  """A pool of porcelain workers for one OpenCL environment.
+
+  Workers are started on demand, up to the maximum size of the pool. Instances
+  may be shared between threads.
+  """
+
+  def __init__(self, env: _env.OpenCLEnvironment, max_workers: int = 1):
+    """Instantiate a worker pool.
+
+    Args:
+      env: The OpenCL environment to run jobs in.
+      max_workers: The maximum number of jobs to run concurrently.
+    """
+    self.env = env
+    self.max_workers = max_workers
+    self._semaphore = threading.BoundedSemaphore(max_workers)
+    # Idle workers. The most recently used worker is reused first, so that
+    # workers which are rarely needed are not kept warm.
+    self._idle = queue.LifoQueue()
+    self._workers: typing.List[PorcelainWorker] = []
+    self._lock = threading.Lock()
+
+  def Run(self, job: typing.Dict[str, typing.Any],
+          timeout: int = -1) -> typing.Dict[str, typing.Any]:
+    """Run a job on an idle worker.
+
+    See PorcelainWorker.Run().
+    """
+    with self._semaphore:
+      try:
+        worker = self._idle.get_nowait()
+      except queue.Empty:
+        worker = PorcelainWorker(self.env)
+        with self._lock:
+          self._workers.append(worker)
+      try:
+        return worker.Run(job, timeout)
+      finally:
+        self._idle.put(worker)
+
+  def Stop(self) -> None:
+    """Terminate all of the workers in the pool."""
+    with self._lock:
+      for worker in self._workers:
+        worker.Stop()
+
+
+# The worker pools of the current process, keyed by OpenCL environment name.
+# Workers are not inherited across fork(), so that each child process starts
+# its own.
+_pools: typing.Dict[str, PorcelainWorkerPool] = {}
+_pools_pid = os.getpid()
+_pools_lock = threading.Lock()
+
+
+def GetWorkerPool(env: _env.OpenCLEnvironment,
+                  max_workers: int = 1) -> PorcelainWorkerPool:
+  """Get the worker pool for an OpenCL environment, creating it if required.
+
+  Args:
+    env: The OpenCL environment.
+    max_workers: The maximum number of workers, if the pool is created.
 
-      if status == "SIGKILL":
-        raise TimeoutError(timeout)
-      else:
-        raise PorcelainError(status)
-
-    # Read result.
-    tmp_file.seek(0)
-    return_value = pickle.load(tmp_file)
-    outputs = return_value["outputs"]
-    error = return_value["err"]
-    if error:  # Porcelain raised an exception, re-raise it.
-      raise error
+  Returns:
+    A PorcelainWorkerPool owned by the calling process.
+  """
+  global _pools
+  global _pools_pid
+  with _pools_lock:
+    if _pools_pid != os.getpid():
+      _pools = {}
+      _pools_pid = os.getpid()
+    if env.name not in _pools:
+      _pools[env.name] = PorcelainWorkerPool(env, max_workers)
+    return _pools[env.name]
+
+
+@atexit.register
+def StopWorkers() -> None:
+  """Terminate all of the porcelain workers started by the current process."""
+  if _pools_pid == os.getpid():
+    for pool in _pools.values():
+      pool.Stop()
+
+
+def _CreateContext(platform_id: int, device_id: int):
+  """Create an OpenCL context and command queue for a device."""
+  import pyopencl as cl
+
+  platform = cl.get_platforms()[platform_id]
+  device = platform.get_devices()[device_id]
+  ctx = cl.Context([device])
+  # Profiling is always enabled, since the queue is shared by jobs.
+  queue_ = cl.CommandQueue(
+      ctx, properties=cl.command_queue_properties.PROFILING_ENABLE)
+  return ctx, queue_
+
+
+def _RunPorcelainJob(context, job: typing.Dict[str, typing.Any],
+                     log: typing.List[str]) -> None:
+  """Run a job in a porcelain worker.
+
+  The kernel outputs are written to the job's shared argument file.
+
+  Args:
+    context: The <context, queue> tuple returned by _CreateContext().
+    job: The job to run.
+    log: A list to append log messages to.
+  """
+  import pyopencl as cl
+
+  def Log(message: str) -> None:
+    log.append(f'[cldrive] {message}')
+
+  def ProfilingTime(event) -> float:
+    return (event.profile.end - event.profile.start) / 1e6
+
+  ctx, queue_ = context
+  build_flags = [] if job["optimizations"] else ['-cl-opt-disable']
+  program = cl.Program(ctx, job["src"]).build(build_flags)
+  kernel = program.all_kernels()[0]
+
+  inputs = iter(MapSharedArrays(job["data_path"], job["data_layout"]))
+  buffers = []
+  kernel_args = []
+  for arg in job["args"]:
+    if arg.address_space == 'local':
+      kernel_args.append(cl.LocalMemory(
+          job["lsize"].product * arg.vector_width *
+          np.dtype(arg.numpy_type).itemsize))
+      continue
+    hostdata = next(inputs)
+    if arg.is_pointer:
+      flags = cl.mem_flags.READ_ONLY if arg.is_const else cl.mem_flags.READ_WRITE
+      # The shared memory is used as the host memory of the buffer, so the
+      # implementation may use it without a copy.
+      devdata = cl.Buffer(ctx, flags | cl.mem_flags.USE_HOST_PTR,
+                          hostbuf=hostdata)
+      buffers.append(ArgTuple(hostdata=hostdata, devdata=devdata))
+      kernel_args.append(devdata)
     else:
-      return outputs
+      kernel_args.append(hostdata)
+
+  kernel.set_args(*kernel_args)
+  event = cl.enqueue_nd_range_kernel(
+      queue_, kernel, tuple(job["gsize"]), tuple(job["lsize"]))
+  event.wait()
+  if job["profiling"]:
+    Log(f'Kernel execution time: {ProfilingTime(event):.6f} ms')
+
+  # Synchronize the host memory of the buffers with the device. Reading a
+  # buffer into its own host memory is a no-op for implementations which use
+  # the host memory directly.
+  for arg in buffers:
+    event = cl.enqueue_copy(queue_, arg.hostdata, arg.devdata,
+                            is_blocking=True)
+    if job["profiling"]:
+      Log(f'Device -> Host transfer time: {ProfilingTime(event):.6f} ms')
+  queue_.finish()
+
+
+def _PorcelainWorkerMain(platform_id: int, device_id: int) -> None:
+  """The main loop of a porcelain worker process.
+
+  Jobs are read from stdin and responses written to stdout until stdin is
+  closed. Exceptions raised by a job are returned in the response.
+  """
+  stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+  # Anything printed by a job must not corrupt the response stream.
+  sys.stdout = sys.stderr
+  context = None
+  while True:
+    header = stdin.read(framedproc.FRAME_HEADER.size)
+    if len(header) < framedproc.FRAME_HEADER.size:
+      return
+    length, = framedproc.FRAME_HEADER.unpack(header)
+    job = pickle.loads(stdin.read(length))
+    log = []
+    try:
+      if context is None:
+        context = _CreateContext(platform_id, device_id)
+      _RunPorcelainJob(context, job, log)
+      response = {"err": None}
+    except Exception as e:
+      response = {"err": e}
+    response["log"] = '\n'.join(log)
+    try:
+      payload = pickle.dumps(response)
+    except Exception:
+      # Not every exception can be pickled.
+      response["err"] = RuntimeError(str(response["err"]))
+      payload = pickle.dumps(response)
+    stdout.write(framedproc.FRAME_HEADER.pack(len(payload)) + payload)
+    stdout.flush()
+
+
+if __name__ == '__main__':
+  _PorcelainWorkerMain(int(sys.argv[1]), int(sys.argv[2]))
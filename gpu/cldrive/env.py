@@ -12,6 +12,10 @@ from labm8 import pbutil
 
 CLINFO = bazelutil.DataPath('phd/gpu/clinfo/clinfo')
 
+# The oclgrind flags of commands run in an OclgrindOpenCLEnvironment.
+OCLGRIND_FLAGS = ['--max-errors', '1', '--uninitialized', '--data-races',
+                  '--uniform-writes', '--uniform-writes']
+
 
 class OpenCLEnvironment(object):
 
@@ -62,6 +66,21 @@ class OpenCLEnvironment(object):
     process.stdout, process.stderr = stdout, stderr
     return process
 
+  def Popen(self, argv: typing.List[str], **popen_kwargs) -> subprocess.Popen:
+    """Start a command in an environment for the OpenCL device.
+
+    Unlike Exec(), this does not wait for the command to complete, so it can
+    be used to start long-running processes which use the device.
+
+    Args:
+      argv: A list of arguments to execute.
+      popen_kwargs: Additional arguments to pass to subprocess.Popen.
+
+    Returns:
+      A Popen instance.
+    """
+    return subprocess.Popen(argv, **popen_kwargs)
+
 
 class OclgrindOpenCLEnvironment(OpenCLEnvironment):
   """A mock OpenCLEnvironment for oclgrind."""
@@ -73,9 +92,12 @@ class OclgrindOpenCLEnvironment(OpenCLEnvironment):
   def Exec(self, argv: typing.List[str],
            env: typing.Dict[str, str] = None) -> subprocess.Popen:
     """Execute a command in the device environment."""
-    return oclgrind.Exec(
-        ['--max-errors', '1', '--uninitialized', '--data-races',
-         '--uniform-writes', '--uniform-writes'] + argv, env=env)
+    return oclgrind.Exec(OCLGRIND_FLAGS + argv, env=env)
+
+  def Popen(self, argv: typing.List[str], **popen_kwargs) -> subprocess.Popen:
+    """Start a command in the device environment."""
+    return subprocess.Popen(
+        [str(oclgrind.OCLGRIND_PATH)] + OCLGRIND_FLAGS + argv, **popen_kwargs)
 
 
 def host_os() -> str:
@@ -2,15 +2,21 @@
 """
 import atexit
 import json
+import os
 import pathlib
 import re
+import time
 import typing
+import uuid
 
 import six
+import sqlalchemy as sql
+from sqlalchemy.ext import declarative
 
 from labm8 import crypto
 from labm8 import fs
 from labm8 import io
+from labm8 import sqlutil
 
 
 # TODO(cec): Remove type hints on base Cache, place them on FSCache.
@@ -212,6 +218,156 @@ def escape_path(key):
   return re.sub(r'[ \\/]+', '_', key)
 
 
+# The prefix of the names of the files which an FSCache uses internally. These
+# files are hidden from listings of the cache contents.
+_FSCACHE_INTERNAL_PREFIX = '.fscache'
+
+FSCacheIndexBase = declarative.declarative_base()
+
+
+class FSCacheEntry(FSCacheIndexBase):
+  """An entry in the index of a size-bounded FSCache."""
+  __tablename__ = 'entries'
+
+  # The file name of the entry, relative to the cache root.
+  name: str = sql.Column(sql.String(4096), primary_key=True)
+  # The size of the entry, in bytes.
+  size: int = sql.Column(sql.Integer, nullable=False)
+  # The time that the entry was last set or read, in seconds since the epoch.
+  last_used: float = sql.Column(sql.Float, nullable=False, index=True)
+
+
+class FSCacheTotals(FSCacheIndexBase):
+  """The number and total size of the entries in an FSCache index.
+
+  This table has a single row, which is kept up to date by triggers on the
+  entries table, so that the totals can be read without scanning the entries,
+  and remain consistent when the index is shared by concurrent processes.
+  """
+  __tablename__ = 'totals'
+
+  id: int = sql.Column(sql.Integer, primary_key=True)
+  count: int = sql.Column(sql.Integer, nullable=False)
+  size: int = sql.Column(sql.Integer, nullable=False)
+
+
+for _statement in [
+  'INSERT OR IGNORE INTO totals (id, count, size) VALUES (0, 0, 0)',
+  'CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries '
+  'BEGIN UPDATE totals SET count = count + 1, size = size + NEW.size; END',
+  'CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries '
+  'BEGIN UPDATE totals SET count = count - 1, size = size - OLD.size; END',
+  'CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries '
+  'BEGIN UPDATE totals SET size = size + NEW.size - OLD.size; END',
+]:
+  sql.event.listen(FSCacheIndexBase.metadata, 'after_create',
+                   sql.DDL(_statement))
+
+
+def _GetSize(path: str) -> int:
+  """Return the size of a file, or the total size of the files in a directory.
+  """
+  if not os.path.isdir(path):
+    return os.path.getsize(path)
+  return sum(os.path.getsize(os.path.join(root, file))
+             for root, _, files in os.walk(path) for file in files)
+
+
+class FSCacheIndex(sqlutil.Database):
+  """The index of the entries of a size-bounded FSCache.
+
+  The index records the size and last use time of every entry, so that the
+  least recently used entries can be found without listing the cache
+  directory. Every operation is a single transaction on an SQLite database,
+  which may be shared by concurrent processes.
+  """
+
+  def __init__(self, path: pathlib.Path):
+    super(FSCacheIndex, self).__init__(f'sqlite:///{path.absolute()}',
+                                       FSCacheIndexBase)
+    # Let readers proceed concurrently with a writer.
+    self.engine.execute('PRAGMA journal_mode=WAL')
+    # In WAL mode, skipping the sync on every commit risks losing the most
+    # recent transactions on power loss, but not corrupting the index. Since
+    # every lookup is a write, this is the bulk of the cost of a lookup.
+    sql.event.listen(
+        self.engine, 'connect',
+        lambda connection, _: connection.execute('PRAGMA synchronous=NORMAL'))
+
+  def Touch(self, name: str) -> None:
+    """Mark an entry as used."""
+    self.engine.execute(
+        FSCacheEntry.__table__.update().where(
+            FSCacheEntry.name == name).values(last_used=time.time()))
+
+  def Put(self, name: str, size: int) -> None:
+    """Add or replace an entry."""
+    with self.Session(commit=True) as session:
+      session.query(FSCacheEntry).filter(FSCacheEntry.name == name).delete(
+          synchronize_session=False)
+      session.add(FSCacheEntry(name=name, size=size, last_used=time.time()))
+
+  def Remove(self, name: str) -> None:
+    """Remove an entry, if it exists."""
+    with self.Session(commit=True) as session:
+      session.query(FSCacheEntry).filter(FSCacheEntry.name == name).delete(
+          synchronize_session=False)
+
+  def AddFiles(self, root: pathlib.Path) -> None:
+    """Add the entries for the files in a cache directory.
+
+    Each file is added with its modification time as its last use time.
+
+    Args:
+      root: The cache directory.
+    """
+    with self.Session(commit=True) as session:
+      for name in os.listdir(root):
+        if name.startswith(_FSCACHE_INTERNAL_PREFIX):
+          continue
+        path = os.path.join(root, name)
+        session.merge(FSCacheEntry(name=name, size=_GetSize(path),
+                                   last_used=os.path.getmtime(path)))
+
+  @property
+  def totals(self) -> typing.Tuple[int, int]:
+    """Return the number of entries and their total size, in bytes."""
+    with self.Session() as session:
+      totals = session.query(FSCacheTotals).one()
+      return totals.count, totals.size
+
+  def Evict(self, max_entries: typing.Optional[int],
+            max_size_bytes: typing.Optional[int]) -> typing.List[str]:
+    """Remove the least recently used entries until the index fits its bounds.
+
+    Args:
+      max_entries: The maximum number of entries, or None if unbounded.
+      max_size_bytes: The maximum total size of the entries, or None if
+        unbounded.
+
+    Returns:
+      The names of the entries which were removed. The caller is responsible
+      for deleting their files.
+    """
+    evicted = []
+    with self.Session(commit=True) as session:
+      totals = session.query(FSCacheTotals).one()
+      count, size = totals.count, totals.size
+      while ((max_entries is not None and count > max_entries) or
+             (max_size_bytes is not None and size > max_size_bytes)):
+        entry = session.query(FSCacheEntry.name, FSCacheEntry.size).order_by(
+            FSCacheEntry.last_used).first()
+        if not entry:
+          break
+        name, entry_size = entry
+        session.query(FSCacheEntry).filter(FSCacheEntry.name == name).delete(
+            synchronize_session=False)
+        evicted.append(name)
+        count -= 1
+        size -= entry_size
+    return evicted
+
+
 class FSCache(Cache):
   """
   Persistent filesystem cache.
@@ -219,32 +375,87 @@ class FSCache(Cache):
   Each key uniquely identifies a file.
   Each value is a file path.
 
-  Adding a file to the cache moves it into the cahce directory.
+  Adding a file to the cache moves it into the cahce directory. The file is
+  first moved to a temporary name inside the cache directory and then renamed
+  into place, so that concurrent readers never see a partially written entry.
+
+  If max_size_bytes or max_entries is set, the cache is bounded, and the least
+  recently used entries are evicted when a new entry would exceed the bounds.
+  A bounded cache keeps an index of the sizes and last use times of entries in
+  an SQLite database in the cache directory, so that lookups and evictions do
+  not need to list the directory. Files which are added to the cache directory
+  other than through a bounded FSCache are not indexed, and so are not evicted,
+  until the index is recreated.
 
   Members:
       path (str): Root cache.
       escape_key (fn): Function to convert keys to file names.
+      max_size_bytes (int): The maximum total size of entries, or None.
+      max_entries (int): The maximum number of entries, or None.
+      hits (int): The number of lookups which found an entry.
+      misses (int): The number of lookups which did not find an entry.
+      evictions (int): The number of entries which have been evicted.
   """
 
-  def __init__(self, root, escape_key=hash_key):
+  def __init__(self, root, escape_key=hash_key,
+               max_size_bytes: typing.Optional[int] = None,
+               max_entries: typing.Optional[int] = None):
     """
     Create filesystem cache.
 
     Arguments:
         root (str): String.
         escape_key (fn, optional): Function to convert keys to file names.
+        max_size_bytes (int, optional): The maximum total size of entries.
+        max_entries (int, optional): The maximum number of entries.
     """
     self.path = pathlib.Path(root)
     self.escape_key = escape_key
+    self.max_size_bytes = max_size_bytes
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._index: typing.Optional[FSCacheIndex] = None
+    self._index_pid = None
 
     fs.mkdir(self.path)
 
+  @property
+  def bounded(self) -> bool:
+    """Return whether the cache has a size or entry limit."""
+    return self.max_size_bytes is not None or self.max_entries is not None
+
+  def _GetIndex(self) -> typing.Optional[FSCacheIndex]:
+    """Get the index of a bounded cache, opening or creating it if required.
+
+    Database connections must not be shared across fork(), so a process which
+    inherits a cache opens its own connection to the index.
+
+    Returns:
+      The index, or None if the cache is unbounded.
+    """
+    if not self.bounded:
+      return None
+    if self._index is None or self._index_pid != os.getpid():
+      fs.mkdir(self.path)
+      path = self.path / f'{_FSCACHE_INTERNAL_PREFIX}.index.db'
+      is_new = not path.is_file()
+      self._index = FSCacheIndex(path)
+      self._index_pid = os.getpid()
+      if is_new:
+        self._index.AddFiles(self.path)
+    return self._index
+
   def clear(self):
     """
     Empty the filesystem cache.
 
     This deletes the entire cache directory.
     """
+    if self._index is not None:
+      self._index.engine.dispose()
+      self._index = None
     fs.rm(self.path)
 
   def keypath(self, key):
@@ -273,15 +484,22 @@ class FSCache(Cache):
         KeyErorr: If key not in cache.
     """
     path = self.keypath(key)
-    if fs.exists(path):
-      return path
-    else:
+    if not fs.exists(path):
+      self.misses += 1
       raise KeyError(key)
+    self.hits += 1
+    index = self._GetIndex()
+    if index:
+      index.Touch(self.escape_key(key))
+    return path
 
   def __setitem__(self, key, value):
     """
     Emplace file in cache.
 
+    If the cache is bounded, this may evict other entries, or the new entry
+    itself if it is larger than the maximum size of the cache.
+
     Arguments:
         key: Key.
         value (str): Path of file to insert in cache.
@@ -292,9 +510,26 @@ class FSCache(Cache):
     if not fs.exists(value):
       raise ValueError(value)
 
-    path = self.keypath(key)
+    name = self.escape_key(key)
+    path = fs.path(self.path, name)
     fs.mkdir(self.path)
-    fs.mv(value, path)
+    tmp_path = fs.path(self.path,
+                       f'{_FSCACHE_INTERNAL_PREFIX}.tmp.{uuid.uuid4().hex}')
+    fs.mv(value, tmp_path)
+    # rename() atomically replaces a file, but not a directory.
+    if fs.isdir(tmp_path) or fs.isdir(path):
+      fs.rm(path, glob=False)
+    os.rename(tmp_path, path)
+
+    index = self._GetIndex()
+    if index:
+      index.Put(name, _GetSize(path))
+      self._Evict(index)
+
+  def _Evict(self, index: FSCacheIndex) -> None:
+    for name in index.Evict(self.max_entries, self.max_size_bytes):
+      fs.rm(fs.path(self.path, name), glob=False)
+      self.evictions += 1
 
   def __contains__(self, key):
     """
@@ -322,6 +557,9 @@ class FSCache(Cache):
     path = self.keypath(key)
     if fs.exists(path):
       fs.rm(path)
+      index = self._GetIndex()
+      if index:
+        index.Remove(self.escape_key(key))
     else:
       raise KeyError(key)
 
@@ -332,7 +570,7 @@ class FSCache(Cache):
     Returns:
         iterable: Paths in cache.
     """
-    for path in fs.ls(self.path, abspaths=True):
+    for path in self.ls(abspaths=True):
       yield path
 
   def __len__(self):
@@ -342,7 +580,7 @@ class FSCache(Cache):
     Returns:
         int: Number of entries in the cache.
     """
-    return len(list(fs.ls(self.path)))
+    return len(self.ls())
 
   def get(self, key, default=None):
     """
@@ -355,9 +593,9 @@ class FSCache(Cache):
     Returns:
         str: Path to cached file.
     """
-    if key in self:
+    try:
       return self[key]
-    else:
+    except KeyError:
       return default
 
   def ls(self, **kwargs):
@@ -370,4 +608,10 @@ class FSCache(Cache):
     Returns:
         iterable: List of files.
     """
-    return fs.ls(self.path, **kwargs)
+    def _IsInternal(path: str) -> bool:
+      if os.path.isabs(path):
+        path = os.path.relpath(path, self.path)
+      return path.startswith(_FSCACHE_INTERNAL_PREFIX)
+
+    return [path for path in fs.ls(self.path, **kwargs)
+            if not _IsInternal(path)]
@@ -1,6 +1,8 @@
 """Unit tests for //labm8:cache."""
+import pathlib
 import sys
 import tempfile
+import time
 
 import pytest
 from absl import app
@@ -197,6 +199,124 @@ def test_FSCache_iter_len():
   c.clear()
 
 
+def _WriteFile(path: pathlib.Path, size: int) -> str:
+  with open(path, 'wb') as f:
+    f.write(b'x' * size)
+  return str(path)
+
+
+def test_FSCache_max_entries_evicts_least_recently_used():
+  """Test that the least recently used entry is evicted."""
+  with tempfile.TemporaryDirectory() as d:
+    d = pathlib.Path(d)
+    c = cache.FSCache(d / 'cache', max_entries=2)
+    c['a'] = _WriteFile(d / 'a', 1)
+    c['b'] = _WriteFile(d / 'b', 1)
+    # Reading 'a' makes 'b' the least recently used entry.
+    assert c['a']
+    c['c'] = _WriteFile(d / 'c', 1)
+    assert 'a' in c
+    assert 'b' not in c
+    assert 'c' in c
+    assert c.evictions == 1
+
+
+def test_FSCache_max_size_bytes():
+  """Test that entries are evicted until the cache fits in its size limit."""
+  with tempfile.TemporaryDirectory() as d:
+    d = pathlib.Path(d)
+    c = cache.FSCache(d / 'cache', max_size_bytes=100)
+    c['a'] = _WriteFile(d / 'a', 40)
+    c['b'] = _WriteFile(d / 'b', 40)
+    c['c'] = _WriteFile(d / 'c', 80)
+    assert 'a' not in c
+    assert 'b' not in c
+    assert 'c' in c
+    assert c.evictions == 2
+    assert c._GetIndex().totals == (1, 80)
+
+
+def test_FSCache_replace_entry_size():
+  """Test that replacing an entry replaces its size."""
+  with tempfile.TemporaryDirectory() as d:
+    d = pathlib.Path(d)
+    c = cache.FSCache(d / 'cache', max_size_bytes=100)
+    c['a'] = _WriteFile(d / 'a', 60)
+    c['a'] = _WriteFile(d / 'a', 70)
+    assert c._GetIndex().totals == (1, 70)
+    del c['a']
+    assert c._GetIndex().totals == (0, 0)
+    assert not c.evictions
+
+
+def test_FSCache_directory_entry_size():
+  """Test that the size of a directory entry is the size of its files."""
+  with tempfile.TemporaryDirectory() as d:
+    d = pathlib.Path(d)
+    (d / 'dir').mkdir()
+    _WriteFile(d / 'dir' / 'a', 10)
+    _WriteFile(d / 'dir' / 'b', 20)
+    c = cache.FSCache(d / 'cache', max_size_bytes=100)
+    c['dir'] = str(d / 'dir')
+    assert fs.isfile(pathlib.Path(c['dir']) / 'b')
+    assert c._GetIndex().totals == (1, 30)
+
+
+def test_FSCache_hits_misses():
+  """Test that lookups are counted."""
+  with tempfile.TemporaryDirectory() as d:
+    d = pathlib.Path(d)
+    c = cache.FSCache(d / 'cache')
+    c['a'] = _WriteFile(d / 'a', 1)
+    assert c.get('a')
+    assert not c.get('b')
+    with pytest.raises(KeyError):
+      c['b']
+    assert c.hits == 1
+    assert c.misses == 2
+
+
+def test_FSCache_index_existing_files():
+  """Test that a bounded cache indexes the files of an unbounded cache."""
+  with tempfile.TemporaryDirectory() as d:
+    d = pathlib.Path(d)
+    c = cache.FSCache(d / 'cache')
+    c['a'] = _WriteFile(d / 'a', 10)
+    c['b'] = _WriteFile(d / 'b', 10)
+    c = cache.FSCache(d / 'cache', max_entries=2)
+    c['c'] = _WriteFile(d / 'c', 10)
+    assert len(c) == 2
+    assert c.evictions == 1
+
+
+def test_FSCache_ls_hides_index():
+  """Test that the index is not listed as a cache entry."""
+  with tempfile.TemporaryDirectory() as d:
+    d = pathlib.Path(d)
+    c = cache.FSCache(d / 'cache', escape_key=cache.escape_path,
+                      max_entries=10)
+    c['a'] = _WriteFile(d / 'a', 1)
+    assert c.ls() == ['a']
+    assert list(c) == [c.keypath('a')]
+    assert len(c) == 1
+
+
+@pytest.mark.parametrize('num_entries', [1000, 100000])
+def test_benchmark_FSCache_get(benchmark, num_entries: int):
+  """Benchmark lookups in a bounded cache of increasing size."""
+  with tempfile.TemporaryDirectory() as d:
+    d = pathlib.Path(d)
+    c = cache.FSCache(d / 'cache', max_entries=num_entries + 1)
+    c['a'] = _WriteFile(d / 'a', 1)
+    # Populate the index directly, rather than creating a file per entry.
+    with c._GetIndex().Session(commit=True) as session:
+      now = time.time()
+      session.bulk_insert_mappings(cache.FSCacheEntry, [
+        {'name': str(i), 'size': 1, 'last_used': now}
+        for i in range(num_entries)])
+    benchmark(c.get, 'a')
+
+
 def main(argv):  # pylint: disable=missing-docstring
   del argv
   sys.exit(pytest.main([__file__, '-v']))
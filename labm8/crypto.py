@@ -1,10 +1,19 @@
 """Hashing and cryptography utils.
 """
+import concurrent.futures
+import functools
 import hashlib
 import pathlib
 import typing
 
 
+# The number of bytes read at a time when checksumming a file.
+FILE_BUFFER_SIZE = 1024 * 1024
+
+# The default digest size of blake2b checksums, in bytes.
+BLAKE2B_DIGEST_SIZE = 16
+
+
 def _checksum(hash_fn, data):
   return hash_fn(data).hexdigest()
 
@@ -18,10 +27,32 @@ def _checksum_list(hash_fn, *elems):
   return _checksum_str(hash_fn, string)
 
 
-def _checksum_file(hash_fn, path: typing.Union[str, pathlib.Path]):
-  with open(path, 'rb') as infile:
-    ret = _checksum(hash_fn, infile.read())
-  return ret
+def _checksum_file(hash_fn, path: typing.Union[str, pathlib.Path],
+                   buffer_size: int = FILE_BUFFER_SIZE):
+  # Read the file into a single reused buffer, so that memory usage is
+  # constant regardless of the size of the file.
+  checksum = hash_fn()
+  buffer = bytearray(buffer_size)
+  view = memoryview(buffer)
+  with open(path, 'rb', buffering=0) as infile:
+    while True:
+      size = infile.readinto(buffer)
+      if not size:
+        break
+      checksum.update(view[:size])
+  return checksum.hexdigest()
+
+
+def _checksum_files(hash_fn,
+                    paths: typing.Iterable[typing.Union[str, pathlib.Path]],
+                    max_workers: typing.Optional[int] = None,
+                    buffer_size: int = FILE_BUFFER_SIZE):
+  # hashlib releases the GIL while hashing, so files are hashed concurrently
+  # by threads.
+  checksum_file = functools.partial(_checksum_file, hash_fn,
+                                    buffer_size=buffer_size)
+  with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+    return list(pool.map(checksum_file, paths))
 
 
 def sha1(data):
@@ -63,17 +94,21 @@ def sha1_list(*elems):
   return _checksum_list(hashlib.sha1, *elems)
 
 
-def sha1_file(path: typing.Union[str, pathlib.Path]):
+def sha1_file(path: typing.Union[str, pathlib.Path],
+              buffer_size: int = FILE_BUFFER_SIZE):
   """
   Return the sha1 of file at "path".
 
+  The file is read in chunks, so memory usage is constant.
+
   Arguments:
       path (str): Path to file
+      buffer_size (int, optional): The number of bytes to read at a time.
 
   Returns:
       str: Hex encoded.
   """
-  return _checksum_file(hashlib.sha1, path)
+  return _checksum_file(hashlib.sha1, path, buffer_size)
 
 
 def md5(data):
@@ -115,17 +150,21 @@ def md5_list(*elems):
   return _checksum_list(hashlib.md5, *elems)
 
 
-def md5_file(path: typing.Union[str, pathlib.Path]):
+def md5_file(path: typing.Union[str, pathlib.Path],
+             buffer_size: int = FILE_BUFFER_SIZE):
   """
   Return the md5 of file at "path".
 
+  The file is read in chunks, so memory usage is constant.
+
   Arguments:
       path (str): Path to file
+      buffer_size (int, optional): The number of bytes to read at a time.
 
   Returns:
       str: Hex encoded.
   """
-  return _checksum_file(hashlib.md5, path)
+  return _checksum_file(hashlib.md5, path, buffer_size)
 
 
 def sha256(data):
@@ -167,14 +206,94 @@ def sha256_list(*elems):
   return _checksum_list(hashlib.sha256, *elems)
 
 
-def sha256_file(path: typing.Union[str, pathlib.Path]):
+def sha256_file(path: typing.Union[str, pathlib.Path],
+                buffer_size: int = FILE_BUFFER_SIZE):
   """
   Return the sha256 of file at "path".
 
+  The file is read in chunks, so memory usage is constant.
+
+  Arguments:
+      path (str): Path to file
+      buffer_size (int, optional): The number of bytes to read at a time.
+
+  Returns:
+      str: Hex encoded.
+  """
+  return _checksum_file(hashlib.sha256, path, buffer_size)
+
+
+def sha256_files(paths: typing.Iterable[typing.Union[str, pathlib.Path]],
+                 max_workers: typing.Optional[int] = None,
+                 buffer_size: int = FILE_BUFFER_SIZE):
+  """
+  Return the sha256 of many files, hashing them concurrently.
+
+  Arguments:
+      paths (str[]): Paths to files.
+      max_workers (int, optional): The maximum number of files to hash at a
+        time. If not set, the default number of threads of a
+        ThreadPoolExecutor is used.
+      buffer_size (int, optional): The number of bytes to read at a time.
+
+  Returns:
+      str[]: Hex encoded checksums, in the same order as the paths.
+  """
+  return _checksum_files(hashlib.sha256, paths, max_workers, buffer_size)
+
+
+def blake2b(data, digest_size: int = BLAKE2B_DIGEST_SIZE):
+  """
+  Return the blake2b of "data".
+
+  blake2b is faster than md5, sha1 and sha256 on 64-bit platforms. With a small
+  digest size, it is suitable for cache keys, but not for security.
+
+  Arguments:
+      data (bytes): Data.
+      digest_size (int, optional): The size of the digest, in bytes.
+
+  Returns:
+      str: Hex encoded.
+  """
+  return _checksum(functools.partial(hashlib.blake2b, digest_size=digest_size),
+                   data)
+
+
+def blake2b_str(string, encoding='utf-8',
+                digest_size: int = BLAKE2B_DIGEST_SIZE):
+  """
+  Return the blake2b of "string".
+
+  Arguments:
+      string (str): String.
+      encoding (str, optional): Encoding.
+      digest_size (int, optional): The size of the digest, in bytes.
+
+  Returns:
+      str: Hex encoded.
+  """
+  return _checksum_str(
+      functools.partial(hashlib.blake2b, digest_size=digest_size), string,
+      encoding=encoding)
+
+
+def blake2b_file(path: typing.Union[str, pathlib.Path],
+                 buffer_size: int = FILE_BUFFER_SIZE,
+                 digest_size: int = BLAKE2B_DIGEST_SIZE):
+  """
+  Return the blake2b of file at "path".
+
+  The file is read in chunks, so memory usage is constant.
+
   Arguments:
       path (str): Path to file
+      buffer_size (int, optional): The number of bytes to read at a time.
+      digest_size (int, optional): The size of the digest, in bytes.
 
   Returns:
       str: Hex encoded.
   """
-  return _checksum_file(hashlib.sha256, path)
+  return _checksum_file(
+      functools.partial(hashlib.blake2b, digest_size=digest_size), path,
+      buffer_size)
@@ -1,5 +1,7 @@
 """Unit tests for //labm8:crypto."""
+import pathlib
 import sys
+import tempfile
 
 import pytest
 from absl import app
@@ -112,6 +114,51 @@ def test_sha256_file_hello_world():
           crypto.sha256_file("labm8/data/test/hello_world"))
 
 
+def test_sha256_file_buffer_size():
+  """Test that the checksum does not depend on the buffer size."""
+  with tempfile.TemporaryDirectory() as d:
+    path = pathlib.Path(d) / 'file'
+    path.write_bytes(bytes(range(256)) * 100)
+    expected = crypto.sha256(bytes(range(256)) * 100)
+    assert expected == crypto.sha256_file(path)
+    assert expected == crypto.sha256_file(path, buffer_size=1000)
+    assert expected == crypto.sha256_file(path, buffer_size=1)
+
+
+# sha256_files()
+def test_sha256_files():
+  assert ["e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855",
+          "d9014c4624844aa5bac314773d6b689ad467fa4e1d1a50a1b8a99d5a95f72ff5",
+          "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"] == \
+         crypto.sha256_files(["labm8/data/test/empty_file",
+                              "labm8/data/test/hello_world",
+                              "labm8/data/test/empty_file"], max_workers=2)
+
+
+def test_sha256_files_empty():
+  assert [] == crypto.sha256_files([])
+
+
+# blake2b()
+def test_blake2b_empty_str():
+  assert "cae66941d9efbd404e4d88758ea67670" == crypto.blake2b_str("")
+
+
+def test_blake2b_hello_world():
+  assert ("3895c59e4aeb0903396b5be3fbec69fe" ==
+          crypto.blake2b_str("Hello, World!"))
+
+
+def test_blake2b_digest_size():
+  assert 64 == len(crypto.blake2b(b"", digest_size=32))
+
+
+# blake2b_file()
+def test_blake2b_file_hello_world():
+  assert (crypto.blake2b_str("Hello, world!\n") ==
+          crypto.blake2b_file("labm8/data/test/hello_world"))
+
+
 def main(argv):  # pylint: disable=missing-docstring
   del argv
   sys.exit(pytest.main([__file__, '-v']))
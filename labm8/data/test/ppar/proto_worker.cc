@@ -1,7 +1,11 @@
 // A binary that reads an AddXandY message from stdin, and writes an AddXandY
 // message to stdout.
 //
-// If the input AddXandY.x == 10, the program crashes.
+// If the input AddXandY.x == 10, the program crashes. If the input
+// AddXandY.x == 20, the program hangs.
+
+#include <chrono>
+#include <thread>
 
 #include "labm8/data/test/ppar/protos.pb.h"
 #include "phd/macros.h"
@@ -13,6 +17,9 @@ void ProcessProtobuf(const AddXandY& input_proto,
   int y = input_proto.y();
 
   CHECK(x != 10);
+  if (x == 20) {
+    std::this_thread::sleep_for(std::chrono::hours(1));
+  }
 
   INFO("Adding %d and %d and storing the result in a new message", x, y);
   output_proto->set_result(x + y);
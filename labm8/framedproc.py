@@ -0,0 +1,184 @@
+"""A long-lived subprocess which exchanges length-prefixed frames.
+
+A FramedProcess keeps a single instance of a command alive, and communicates
+with it over its stdin and stdout. Requests are written as frames of a
+serialized payload preceded by its length:
+
+  <uint32 length><payload>
+
+The length is a big-endian unsigned 32-bit integer. Responses are read with a
+deadline, so that a process which stops responding can be killed.
+"""
+import os
+import select
+import struct
+import subprocess
+import time
+import typing
+
+from absl import flags
+from absl import logging
+
+
+FLAGS = flags.FLAGS
+
+# The header of a frame, containing the length of the payload.
+FRAME_HEADER = struct.Struct('>I')
+
+
+class FrameTimeout(Exception):
+  """Raised if a response is not read before the deadline."""
+  pass
+
+
+def _ClosePipe(pipe: typing.IO) -> None:
+  try:
+    pipe.close()
+  except OSError:
+    # Flushing buffered input to a process which has exited fails.
+    pass
+
+
+class FramedProcess(object):
+  """A long-lived process which exchanges length-prefixed frames.
+
+  The process is not started until Start() is called. Instances are not
+  thread safe.
+  """
+
+  def __init__(self, cmd: typing.List[str],
+               popen: typing.Callable[..., subprocess.Popen] = subprocess.Popen,
+               **popen_kwargs):
+    """Instantiate a framed process.
+
+    Args:
+      cmd: The command to execute, as a list of arguments to popen.
+      popen: The function used to start the command. It is called with the
+        command and keyword arguments, as for subprocess.Popen().
+      popen_kwargs: Additional arguments to pass to popen. The stdin and
+        stdout of the process are always pipes.
+    """
+    self.cmd = cmd
+    self._popen = popen
+    self._popen_kwargs = popen_kwargs
+    self._process: typing.Optional[subprocess.Popen] = None
+
+  @property
+  def pid(self) -> typing.Optional[int]:
+    """The pid of the process, or None if it has not been started."""
+    return self._process.pid if self._process else None
+
+  @property
+  def running(self) -> bool:
+    """Whether the process has been started, and has not exited."""
+    return self._process is not None and self._process.poll() is None
+
+  def Start(self) -> None:
+    """Start the process, killing the previous process if it is running."""
+    self.Stop()
+    logging.debug('$ %s', ' '.join(self.cmd))
+    self._process = self._popen(self.cmd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, **self._popen_kwargs)
+
+  def Stop(self, kill: bool = True) -> typing.Optional[int]:
+    """Stop the process, if it has been started.
+
+    Args:
+      kill: If True, the process is killed. Else its stdin is closed, and the
+        process is left to exit by itself.
+
+    Returns:
+      The return code of the process, or None if it had not been started.
+    """
+    if self._process is None:
+      return None
+    process, self._process = self._process, None
+    if not kill:
+      # The process exits once it reads the end of its input.
+      _ClosePipe(process.stdin)
+    elif process.poll() is None:
+      process.kill()
+    returncode = process.wait()
+    _ClosePipe(process.stdin)
+    _ClosePipe(process.stdout)
+    return returncode
+
+  def WriteFrame(self, data: bytes) -> None:
+    """Write a frame to the process's stdin.
+
+    Args:
+      data: The payload of the frame.
+
+    Raises:
+      OSError: If the process has closed its stdin.
+    """
+    self._process.stdin.write(FRAME_HEADER.pack(len(data)) + data)
+    self._process.stdin.flush()
+
+  def ReadFrame(self, deadline: typing.Optional[float] = None) -> bytes:
+    """Read a frame from the process's stdout.
+
+    Args:
+      deadline: The time.time() by which the frame must be read, or None to
+        wait forever.
+
+    Returns:
+      The payload of the frame.
+
+    Raises:
+      FrameTimeout: If the frame is not read before the deadline.
+      EOFError: If the process closes its stdout first.
+    """
+    length, = FRAME_HEADER.unpack(self.Read(FRAME_HEADER.size, deadline))
+    return self.Read(length, deadline)
+
+  def Call(self, data: bytes,
+           deadline: typing.Optional[float] = None) -> bytes:
+    """Write a request frame, and read the response frame.
+
+    The process must be running.
+
+    Args:
+      data: The payload of the request.
+      deadline: The time.time() by which the response must be read, or None to
+        wait forever.
+
+    Returns:
+      The payload of the response.
+
+    Raises:
+      FrameTimeout: If the response is not read before the deadline.
+      EOFError: If the process closes its stdout first.
+      OSError: If the process has closed its stdin.
+    """
+    self.WriteFrame(data)
+    return self.ReadFrame(deadline)
+
+  def Read(self, n: int, deadline: typing.Optional[float] = None) -> bytes:
+    """Read exactly n bytes from the process's stdout before the deadline.
+
+    Args:
+      n: The number of bytes to read.
+      deadline: The time.time() by which the bytes must be read, or None to
+        wait forever.
+
+    Returns:
+      The bytes read.
+
+    Raises:
+      FrameTimeout: If the bytes are not read before the deadline.
+      EOFError: If the process closes its stdout first.
+    """
+    fd = self._process.stdout.fileno()
+    chunks = []
+    while n:
+      if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+          raise FrameTimeout()
+      chunk = os.read(fd, n)
+      if not chunk:
+        raise EOFError()
+      chunks.append(chunk)
+      n -= len(chunk)
+    return b''.join(chunks)
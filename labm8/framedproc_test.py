@@ -0,0 +1,101 @@
+"""Unit tests for //labm8:framedproc."""
+import sys
+import time
+
+import pytest
+from absl import app
+from absl import flags
+
+from labm8 import framedproc
+
+
+FLAGS = flags.FLAGS
+
+# A process which echoes its requests, reversed, and misbehaves on demand.
+ECHO_SCRIPT = """
+import os
+import struct
+import sys
+import time
+
+while True:
+  header = sys.stdin.buffer.read(4)
+  if not header:
+    sys.exit(3)
+  data = sys.stdin.buffer.read(struct.unpack('>I', header)[0])
+  if data == b'crash':
+    os._exit(1)
+  elif data == b'sleep':
+    time.sleep(10)
+  sys.stdout.buffer.write(struct.pack('>I', len(data)) + data[::-1])
+  sys.stdout.buffer.flush()
+"""
+
+
+@pytest.fixture(scope='function')
+def process() -> framedproc.FramedProcess:
+  """A test fixture which returns a started framed process."""
+  process = framedproc.FramedProcess([sys.executable, '-c', ECHO_SCRIPT])
+  process.Start()
+  yield process
+  process.Stop()
+
+
+def test_FramedProcess_not_started():
+  """Test that a process is not started until Start() is called."""
+  process = framedproc.FramedProcess([sys.executable, '-c', ECHO_SCRIPT])
+  assert process.pid is None
+  assert not process.running
+  assert process.Stop() is None
+
+
+def test_FramedProcess_Call(process: framedproc.FramedProcess):
+  """Test that responses are read from the same process."""
+  pid = process.pid
+  assert process.Call(b'abc') == b'cba'
+  assert process.Call(b'') == b''
+  assert process.Call(b'x' * 100000) == b'x' * 100000
+  assert process.pid == pid
+  assert process.running
+
+
+def test_FramedProcess_Call_timeout(process: framedproc.FramedProcess):
+  """Test that FrameTimeout is raised if the deadline passes."""
+  with pytest.raises(framedproc.FrameTimeout):
+    process.Call(b'sleep', time.time() + 1)
+
+
+def test_FramedProcess_Call_crash(process: framedproc.FramedProcess):
+  """Test that EOFError is raised if the process exits without responding."""
+  with pytest.raises(EOFError):
+    process.Call(b'crash', time.time() + 10)
+  assert process.Stop() == 1
+  assert process.pid is None
+
+
+def test_FramedProcess_Stop_kill(process: framedproc.FramedProcess):
+  """Test that a process which is killed returns the signal number."""
+  assert process.Stop() == -9
+  assert not process.running
+
+
+def test_FramedProcess_Stop_no_kill(process: framedproc.FramedProcess):
+  """Test that a process which is not killed exits at the end of its input."""
+  assert process.Stop(kill=False) == 3
+
+
+def test_FramedProcess_Start_restarts(process: framedproc.FramedProcess):
+  """Test that starting a process replaces the running process."""
+  pid = process.pid
+  process.Start()
+  assert process.pid != pid
+  assert process.Call(b'abc') == b'cba'
+
+
+def main(argv):  # pylint: disable=missing-docstring
+  del argv
+  sys.exit(pytest.main([__file__, '-v']))
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -1,18 +1,22 @@
 """A hash cache for the filesystem.
 
-Checksums files and directories and cache results. If a file or directory has
-not been modified, subsequent hashes are cache hits. Hashes are recomputed
-lazily, when a directory (or any of its subdirectories) have been modified.
+Checksums files and directories and cache results. The cache records the hash
+of every file, along with its modification time and size. If a file has not
+been modified, subsequent hashes are cache hits. The hash of a directory is
+recombined from the hashes of the files that it contains, so that when a
+directory is modified, only the files within it which are new or modified are
+read.
 """
 
 import collections
+import concurrent.futures
+import functools
+import hashlib
 import os
 import pathlib
-import subprocess
 import time
 import typing
 
-import checksumdir
 import humanize
 import sqlalchemy as sql
 from absl import flags
@@ -20,7 +24,6 @@ from absl import logging
 from sqlalchemy.ext import declarative
 
 from labm8 import crypto
-from labm8 import fs
 from labm8 import sqlutil
 
 
@@ -28,58 +31,104 @@ FLAGS = flags.FLAGS
 
 Base = declarative.declarative_base()
 
+# The file hash functions supported by HashCache, keyed by name.
+HASH_FUNCTIONS = {
+  'md5': crypto.md5_file,
+  'sha1': crypto.sha1_file,
+  'sha256': crypto.sha256_file,
+}
+
 # An in-memory cache which is optionally shared amongst all HashCache instances.
 # The in-memory cache omits timestamps from records.
 InMemoryCacheKey = collections.namedtuple(
     'InMemoryCacheKey', ['hash_fn', 'path'])
 IN_MEMORY_CACHE: typing.Dict[InMemoryCacheKey, str] = {}
 
+# The number of files hashed by each task of the thread pool.
+_HASH_BATCH_SIZE = 64
+
+# The path, modification time in nanoseconds, and size in bytes of a file.
+FileStat = collections.namedtuple(
+    'FileStat', ['path', 'last_modified_ns', 'size'])
+
 
 class HashCacheRecord(Base):
-  """A hashed file or directory."""
-  __tablename__ = 'entries'
+  """A hashed file."""
+  __tablename__ = 'files'
 
-  # The absolute path to a file or directory.
+  # The absolute path to a file.
   absolute_path: str = sql.Column(sql.String(4096), primary_key=True)
-  # The number of seconds since the epoch that the file or directory was last
-  # modified.
-  last_modified: int = sql.Column(sql.Integer, nullable=False)
+  # The number of nanoseconds since the epoch that the file was last modified.
+  last_modified_ns: int = sql.Column(sql.BigInteger, nullable=False)
+  # The size of the file, in bytes.
+  size: int = sql.Column(sql.BigInteger, nullable=False)
   # The cached hash in hexadecimal encoding. We use the length of the longest
   # supported hash function: sha256.
   hash: str = sql.Column(sql.String(64), nullable=False)
 
 
-def GetDirectoryMTime(path: pathlib.Path) -> int:
-  """Get the timestamp of the most recently modified file/dir in directory.
+def ScanDirectory(path: str) -> typing.Iterator[FileStat]:
+  """Recursively list the files in a directory.
+
+  Symbolic links to directories are not followed.
+
+  Args:
+    path: The path of the directory.
+
+  Returns:
+    An iterator over the files in the directory and its subdirectories.
+  """
+  with os.scandir(path) as entries:
+    for entry in entries:
+      if entry.is_dir():
+        if not entry.is_symlink():
+          yield from ScanDirectory(entry.path)
+      else:
+        stat = entry.stat()
+        yield FileStat(entry.path, stat.st_mtime_ns, stat.st_size)
+
+
+def HashFile(path: str, hash_fn: str) -> str:
+  """Hash the contents of a file.
+
+  Args:
+    path: The path of the file.
+    hash_fn: The name of the hash function.
+
+  Returns:
+    Hexadecimal string hash.
+  """
+  return HASH_FUNCTIONS[hash_fn](path)
+
+
+def _HashFiles(paths: typing.List[str], hash_fn: str) -> typing.List[str]:
+  return [HashFile(path, hash_fn) for path in paths]
+
 
-  Recursively checks subdirectory contents. This requires that the directory
-  exists and is not empty.
+def CombineHashes(hashes: typing.Iterable[str], hash_fn: str) -> str:
+  """Combine the hashes of the files in a directory into a directory hash.
 
-  Params:
-    abspath: The absolute path to the directory.
+  The directory hash depends only on the contents of the files, not on their
+  names or order. It is the same as the hash computed by checksumdir.dirhash().
+
+  Args:
+    hashes: The hexadecimal hashes of the files.
+    hash_fn: The name of the hash function.
 
   Returns:
-    The seconds since epoch of the last modification.
+    Hexadecimal string hash.
   """
-  # Pure python implementation.
-  # return int(max(
-  #     max(os.path.getmtime(os.path.join(root, file)) for file in files) for
-  #     root, _, files in os.walk(path)))
-  # Faster implementation using UNIX tools. Requires GNU xargs, which supports
-  # the '-d' argument, which is needed to support file names with spaces. On
-  # macOS, this means having the homebrew findutils package installed, and
-  # the following directory in your PATH:
-  #    /usr/local/opt/findutils/libexec/gnubin
-  output = subprocess.check_output(
-      f"find '{path}' -type f | xargs -d'\n' stat -c '%Y:%n' | sort -t: -n | "
-      "tail -1 | cut -d: -f1", universal_newlines=True, shell=True)
-  return int(output)
+  hasher = hashlib.new(hash_fn)
+  for hash_ in sorted(hashes):
+    hasher.update(hash_.encode('utf-8'))
+  return hasher.hexdigest()
 
 
 class HashCache(sqlutil.Database):
 
   def __init__(self, path: pathlib.Path, hash_fn: str,
-               keep_in_memory: bool = False):
+               keep_in_memory: bool = False,
+               max_workers: typing.Optional[int] = None):
     """Instantiate a hash cache.
 
     Args:
@@ -89,33 +138,26 @@ class HashCache(sqlutil.Database):
         of the process, or until Clear() is called on any HashCache instance.
         Use this with caution, as the in-memory cache does not invalidate
         entries, so cache entries can become stale.
+      max_workers: The number of threads used to hash files. If not set, the
+        default number of threads of a ThreadPoolExecutor is used.
 
     Raises:
       ValueError: If hash_fn not recognized.
     """
     super(HashCache, self).__init__(f'sqlite:///{path.absolute()}', Base)
-    self.hash_fn_name = hash_fn
-    if hash_fn == 'md5':
-      self.hash_fn_file = crypto.md5_file
-    elif hash_fn == 'sha1':
-      self.hash_fn_file = crypto.sha1_file
-    elif hash_fn == 'sha256':
-      self.hash_fn_file = crypto.sha256_file
-    else:
+    if hash_fn not in HASH_FUNCTIONS:
       raise ValueError(f"Hash function not recognized: '{hash_fn}'")
+    self.hash_fn_name = hash_fn
     self.keep_in_memory = keep_in_memory
+    self.max_workers = max_workers
 
   def GetHash(self, path: pathlib.Path) -> str:
     """Get the hash of a file or directory.
 
-    This method is O(n) with respect to the number of files in the directory.
-    The first time this is called for a directory, this method must read every
-    file in the directory. For subsequent calls, this method must check the
-    mtime of every file.
-
-    Note that the a file's mtime is used to determine cache hits. This uses
-    second granularity, so if a file has been modified within a second, this
-    method will erroneously return the cached checksum of the previous version.
+    This method is O(n) with respect to the number of files in the directory,
+    since it must check the modification time and size of every file. Only the
+    files which are new or have been modified since they were last hashed are
+    read.
 
     Args:
       path: Path to the file or directory.
@@ -127,9 +169,9 @@ class HashCache(sqlutil.Database):
       FileNotFoundError: If the requested path does not exist.
     """
     if path.is_file():
-      return self._HashFile(path)
+      return self._InMemoryWrapper(path, self._HashFile)
     elif path.is_dir():
-      return self._HashDirectory(path)
+      return self._InMemoryWrapper(path, self._HashDirectory)
     else:
       raise FileNotFoundError(f"File not found: '{path}'")
 
@@ -146,21 +188,16 @@ class HashCache(sqlutil.Database):
     logging.debug('Emptied cache')
 
   def _HashDirectory(self, absolute_path: pathlib.Path) -> str:
-    if fs.directory_is_empty(absolute_path):
-      last_modified_fn = lambda path: int(time.time())
-    else:
-      last_modified_fn = lambda path: GetDirectoryMTime(path)
-    return self._InMemoryWrapper(
-        absolute_path, last_modified_fn,
-        lambda x: checksumdir.dirhash(x, self.hash_fn_name))
+    files = list(ScanDirectory(str(absolute_path)))
+    return CombineHashes(self._HashFiles(files, absolute_path),
+                         self.hash_fn_name)
 
   def _HashFile(self, absolute_path: pathlib.Path) -> str:
-    return self._InMemoryWrapper(
-        absolute_path, lambda path: int(os.path.getmtime(path)),
-        self.hash_fn_file)
+    stat = absolute_path.stat()
+    return self._HashFiles(
+        [FileStat(str(absolute_path), stat.st_mtime_ns, stat.st_size)])[0]
 
   def _InMemoryWrapper(self, absolute_path: pathlib.Path,
-                       last_modified_fn: typing.Callable[[pathlib.Path], int],
                        hash_fn: typing.Callable[[pathlib.Path], str]) -> str:
     """A wrapper around the persistent hashing to support in-memory cache."""
     if self.keep_in_memory:
@@ -168,32 +205,97 @@ class HashCache(sqlutil.Database):
       if in_memory_key in IN_MEMORY_CACHE:
         logging.debug("In-memory cache hit: '%s'", absolute_path)
         return IN_MEMORY_CACHE[in_memory_key]
-    hash_ = self._DoHash(
-        absolute_path, last_modified_fn(absolute_path), hash_fn)
+    hash_ = hash_fn(absolute_path)
     if self.keep_in_memory:
       IN_MEMORY_CACHE[in_memory_key] = hash_
     return hash_
 
-  def _DoHash(self, absolute_path: pathlib.Path,
-              last_modified: int,
-              hash_fn: typing.Callable[[pathlib.Path], str]) -> str:
+  def _HashFiles(self, files: typing.List[FileStat],
+                 directory: typing.Optional[pathlib.Path] = None
+                 ) -> typing.List[str]:
+    """Hash files, reusing the cached hashes of unmodified files.
+
+    The cached records are read using a single query. The files which are new
+    or modified are hashed in parallel, and their records are replaced in a
+    single transaction.
+
+    Args:
+      files: The files to hash.
+      directory: If set, the files are the complete contents of this
+        directory, and the records of any other files within it are removed.
+
+    Returns:
+      The hashes of the files, in the same order.
+    """
+    paths = [file.path for file in files]
     with self.Session() as session:
-      cached_entry = session.query(HashCacheRecord).filter(
-          HashCacheRecord.absolute_path == str(absolute_path)).first()
-      if cached_entry and cached_entry.last_modified == last_modified:
-        logging.debug("Cache hit: '%s'", absolute_path)
-        return cached_entry.hash
-      elif cached_entry:
-        logging.debug("Cache miss: '%s'", absolute_path)
-        session.delete(cached_entry)
+      query = session.query(HashCacheRecord.absolute_path,
+                            HashCacheRecord.last_modified_ns,
+                            HashCacheRecord.size, HashCacheRecord.hash)
+      if directory:
+        # Select every path which begins with the directory prefix. The upper
+        # bound is the prefix with its trailing separator incremented.
+        prefix = os.path.join(str(directory), '')
+        query = query.filter(
+            HashCacheRecord.absolute_path >= prefix,
+            HashCacheRecord.absolute_path < prefix[:-1] + chr(ord(os.sep) + 1))
+      else:
+        query = query.filter(HashCacheRecord.absolute_path.in_(paths))
+      cached = {row.absolute_path: row for row in query}
+
+    hashes = {}
+    modified = []
+    for file in files:
+      row = cached.get(file.path)
+      if (row and row.last_modified_ns == file.last_modified_ns and
+          row.size == file.size):
+        hashes[file.path] = row.hash
+      else:
+        modified.append(file)
+
+    if modified:
       start_time = time.time()
-      checksum = hash_fn(absolute_path)
-      logging.debug("New cache entry '%s' in %s ms.", absolute_path,
+      modified_paths = [file.path for file in modified]
+      # Files are hashed in batches, since most files are small enough that
+      # the overhead of scheduling a task would dominate the cost of hashing.
+      batches = [modified_paths[i:i + _HASH_BATCH_SIZE]
+                 for i in range(0, len(modified_paths), _HASH_BATCH_SIZE)]
+      hash_files = functools.partial(_HashFiles, hash_fn=self.hash_fn_name)
+      if len(batches) == 1:
+        new_hashes = hash_files(batches[0])
+      else:
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+          new_hashes = [hash_ for batch_hashes in pool.map(hash_files, batches)
+                        for hash_ in batch_hashes]
+      hashes.update(zip(modified_paths, new_hashes))
+      logging.debug('Hashed %s of %s files in %s ms',
+                    humanize.intcomma(len(modified)),
+                    humanize.intcomma(len(files)),
                     humanize.intcomma(int((time.time() - start_time) * 1000)))
-      new_entry = HashCacheRecord(
-          absolute_path=str(absolute_path),
-          last_modified=last_modified,
-          hash=checksum)
-      session.add(new_entry)
-      session.commit()
-      return new_entry.hash
+
+    stale_paths = [path for path in cached if path not in hashes] + [
+      file.path for file in modified if file.path in cached]
+    self._UpdateRecords(stale_paths, [
+      {'absolute_path': file.path, 'last_modified_ns': file.last_modified_ns,
+       'size': file.size, 'hash': hashes[file.path]} for file in modified])
+    return [hashes[path] for path in paths]
+
+  def _UpdateRecords(self, stale_paths: typing.List[str],
+                     new_records: typing.List[typing.Dict[str, typing.Any]]
+                     ) -> None:
+    """Delete and add records in a single transaction."""
+    if not stale_paths and not new_records:
+      return
+    try:
+      with self.Session(commit=True) as session:
+        # Delete in chunks to stay within SQLite's limit on the number of
+        # parameters of a statement.
+        for i in range(0, len(stale_paths), 500):
+          session.query(HashCacheRecord).filter(
+              HashCacheRecord.absolute_path.in_(stale_paths[i:i + 500])).delete(
+              synchronize_session=False)
+        session.bulk_insert_mappings(HashCacheRecord, new_records)
+    except sql.exc.IntegrityError as e:
+      # Another process has added records for the same files. The hashes that
+      # we computed are still correct, so this is not an error.
+      logging.debug('Failed to update hash cache: %s', e)
@@ -4,10 +4,12 @@ import sys
 import tempfile
 import time
 
+import checksumdir
 import pytest
 from absl import app
 from absl import flags
 
+from labm8 import crypto
 from labm8 import hashcache
 
 
@@ -143,6 +145,59 @@ def test_HashCache_GetHash_modified_file(database_path, hash_fn):
     assert hash_1 != hash_2
 
 
+@pytest.mark.parametrize('hash_fn', HASH_FUNCTIONS)
+def test_HashCache_GetHash_checksumdir_equivalence(database_path, hash_fn):
+  """Test that directory hashes are the same as checksumdir.dirhash()."""
+  c = hashcache.HashCache(database_path, hash_fn)
+  with tempfile.TemporaryDirectory() as d:
+    d = pathlib.Path(d)
+    (d / 'a').write_text('Hello')
+    (d / 'b').mkdir()
+    (d / 'b' / 'c').write_text('world')
+    (d / 'b' / 'd').touch()
+    (d / 'e').symlink_to(d / 'b')
+    assert checksumdir.dirhash(str(d), hash_fn) == c.GetHash(d)
+
+
+def test_HashCache_GetHash_modified_file_in_directory(database_path,
+                                                      monkeypatch):
+  """Test that only a modified file is re-hashed."""
+  c = hashcache.HashCache(database_path, 'sha1')
+  hashed_paths = []
+
+  def _HashFile(path, hash_fn):
+    hashed_paths.append(path)
+    return crypto.sha1_file(path)
+
+  monkeypatch.setattr(hashcache, 'HashFile', _HashFile)
+  with tempfile.TemporaryDirectory() as d:
+    d = pathlib.Path(d)
+    for i in range(10):
+      (d / str(i)).write_text(str(i))
+    hash_1 = c.GetHash(d)
+    assert len(hashed_paths) == 10
+    (d / '5').write_text('Hello')
+    hash_2 = c.GetHash(d)
+    assert hashed_paths[10:] == [str(d / '5')]
+    assert hash_1 != hash_2
+
+
+def test_HashCache_GetHash_deleted_file_in_directory(database_path):
+  """Test that the records of deleted files are removed."""
+  c = hashcache.HashCache(database_path, 'sha1')
+  with tempfile.TemporaryDirectory() as d:
+    d = pathlib.Path(d)
+    (d / 'a').write_text('a')
+    (d / 'b').write_text('b')
+    hash_1 = c.GetHash(d)
+    (d / 'b').unlink()
+    hash_2 = c.GetHash(d)
+    assert hash_1 != hash_2
+    with c.Session() as session:
+      assert [r.absolute_path for r in session.query(
+          hashcache.HashCacheRecord)] == [str(d / 'a')]
+
+
 def main(argv):
   """Main entry point."""
   del argv
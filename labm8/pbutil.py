@@ -1,10 +1,15 @@
 """Utility code for working with Protocol Buffers."""
+import bisect
 import collections
 import gzip
+import io
 import json
+import multiprocessing
 import pathlib
+import struct
 import subprocess
 import typing
+import zlib
 
 import google.protobuf.json_format
 import google.protobuf.message
@@ -221,6 +226,451 @@ def ToJson(message: ProtocolBuffer) -> jsonutil.JSON:
       message, preserving_proto_field_name=True)
 
 
+# Record files.
+#
+# A record file stores a sequence of serialized messages. It is an alternative
+# to storing every message in a file of its own, which for large datasets is
+# bound by the cost of filesystem metadata operations rather than by the cost
+# of decoding. The layout of a record file is:
+#
+#     <magic> <block>* <index> <trailer>
+#
+# A block is a header, followed by the block payload, which is optionally
+# compressed. The uncompressed payload is a sequence of records, each of which
+# is a header containing the length and CRC32 checksum of a serialized
+# message, followed by the message. The block header contains the compression
+# type, the number of records in the block, and the length and CRC32 checksum
+# of the stored (possibly compressed) payload. The index contains the offset of
+# every block in the file and the number of the first record in the block,
+# enabling random access. The trailer contains the offset of the index and the
+# total number of records. All integers are little-endian.
+
+# The magic bytes at the start and end of a record file.
+_RECORD_FILE_MAGIC = b'PBRECRD1'
+_RECORD_HEADER = struct.Struct('<II')
+_BLOCK_HEADER = struct.Struct('<BIII')
+_INDEX_ENTRY = struct.Struct('<QQ')
+_TRAILER = struct.Struct('<QQ8s')
+
+# The block compression types supported by RecordWriter, and their values in
+# the block header.
+RECORD_COMPRESSION_TYPES = {
+  'none': 0,
+  'gzip': 1,
+}
+
+
+def _CompressRecordBlock(payload: bytes, compression: int) -> bytes:
+  if compression == RECORD_COMPRESSION_TYPES['gzip']:
+    # A wbits value of 31 selects the gzip container format.
+    compressor = zlib.compressobj(wbits=31)
+    return compressor.compress(payload) + compressor.flush()
+  return payload
+
+
+def _DecompressRecordBlock(data: bytes, compression: int) -> bytes:
+  if compression == RECORD_COMPRESSION_TYPES['none']:
+    return data
+  elif compression == RECORD_COMPRESSION_TYPES['gzip']:
+    return zlib.decompress(data, 31)
+  raise DecodeError(f'Unknown record block compression type: {compression}')
+
+
+def _ReadRecordBlock(f: typing.BinaryIO, offset: int) -> typing.List[bytes]:
+  """Read the records of the block at the given offset of a record file.
+
+  Args:
+    f: The record file.
+    offset: The offset of the block in the file.
+
+  Returns:
+    A list of serialized messages.
+
+  Raises:
+    DecodeError: If the block is corrupt.
+  """
+  f.seek(offset)
+  header = f.read(_BLOCK_HEADER.size)
+  if len(header) != _BLOCK_HEADER.size:
+    raise DecodeError(f'Truncated record block at offset {offset}')
+  compression, num_records, length, crc = _BLOCK_HEADER.unpack(header)
+  data = f.read(length)
+  if len(data) != length or zlib.crc32(data) != crc:
+    raise DecodeError(f'Corrupt record block at offset {offset}')
+  try:
+    payload = _DecompressRecordBlock(data, compression)
+  except zlib.error as e:
+    raise DecodeError(e)
+
+  records = []
+  position = 0
+  for _ in range(num_records):
+    try:
+      length, crc = _RECORD_HEADER.unpack_from(payload, position)
+    except struct.error:
+      raise DecodeError(f'Truncated record in block at offset {offset}')
+    position += _RECORD_HEADER.size
+    record = payload[position:position + length]
+    position += length
+    if zlib.crc32(record) != crc:
+      raise DecodeError(f'Corrupt record in block at offset {offset}')
+    records.append(record)
+  return records
+
+
+def _ParseRecords(records: typing.List[bytes], message_class: typing.Type,
+                  uninitialized_okay: bool) -> typing.List[ProtocolBuffer]:
+  """Parse serialized messages."""
+  messages = []
+  for record in records:
+    message = message_class()
+    try:
+      message.ParseFromString(record)
+    except google.protobuf.message.DecodeError as e:
+      raise DecodeError(e)
+    if not uninitialized_okay and not message.IsInitialized():
+      raise DecodeError(f"Required fields not set: '{message_class.__name__}'")
+    messages.append(message)
+  return messages
+
+
+def _DecodeRecordBlock(job: typing.Tuple[
+  str, int, typing.Type, bool, typing.Optional[typing.Callable]]
+                       ) -> typing.List[typing.Any]:
+  """Decode a block of a record file.
+
+  This is the worker function of RecordReader.ParallelDecode().
+
+  Args:
+    job: A tuple of the record file path, the offset of the block, the message
+      class, whether uninitialized messages are okay, and the function to
+      apply to every decoded message.
+
+  Returns:
+    A list of messages, or of the values returned by the function.
+  """
+  path, offset, message_class, uninitialized_okay, fn = job
+  with open(path, 'rb') as f:
+    messages = _ParseRecords(_ReadRecordBlock(f, offset), message_class,
+                             uninitialized_okay)
+  return [fn(message) for message in messages] if fn else messages
+
+
+class RecordWriter(object):
+  """A writer for record files.
+
+  Messages are buffered into blocks, which are compressed and written once they
+  exceed the block size. Close() must be called to write the final block and
+  the index, else the file cannot be read. Use the writer as a context manager
+  to ensure this. If an exception is raised in the context, the index is not
+  written, so the partially written file cannot be read:
+
+      with pbutil.RecordWriter(path) as writer:
+        for message in messages:
+          writer.Write(message)
+  """
+
+  def __init__(self, path: pathlib.Path, compression: str = 'none',
+               block_size_bytes: int = 1024 * 1024):
+    """Create a record file.
+
+    Args:
+      path: The path of the record file. If it exists, it is overwritten.
+      compression: The block compression type. One of: none, gzip.
+      block_size_bytes: The uncompressed size of a block, in bytes. Larger
+        blocks compress better, but make random access more expensive.
+
+    Raises:
+      ValueError: If the compression type is not recognized.
+    """
+    if compression not in RECORD_COMPRESSION_TYPES:
+      raise ValueError(f"Compression type not recognized: '{compression}'")
+    self._compression = RECORD_COMPRESSION_TYPES[compression]
+    self._block_size_bytes = block_size_bytes
+    self._file = open(path, 'wb')
+    self._file.write(_RECORD_FILE_MAGIC)
+    self._index: typing.List[typing.Tuple[int, int]] = []
+    self._block: typing.List[bytes] = []
+    self._block_size = 0
+    self._block_num_records = 0
+    self._num_records = 0
+
+  def Write(self, message: ProtocolBuffer) -> None:
+    """Append a message to the record file.
+
+    Args:
+      message: The message to write.
+
+    Raises:
+      EncodeError: If the message is not initialized, i.e. it is missing
+        required fields.
+    """
+    if not message.IsInitialized():
+      class_name = type(message).__name__
+      raise EncodeError(f"Required fields not set: '{class_name}'")
+    self.WriteRecord(message.SerializeToString())
+
+  def WriteRecord(self, record: bytes) -> None:
+    """Append a serialized message to the record file.
+
+    Args:
+      record: The serialized message.
+    """
+    self._block.append(_RECORD_HEADER.pack(len(record), zlib.crc32(record)))
+    self._block.append(record)
+    self._block_size += _RECORD_HEADER.size + len(record)
+    self._block_num_records += 1
+    self._num_records += 1
+    if self._block_size >= self._block_size_bytes:
+      self._WriteBlock()
+
+  def Close(self) -> None:
+    """Write the final block and the index, and close the file."""
+    if self._file.closed:
+      return
+    self._WriteBlock()
+    index_offset = self._file.tell()
+    for offset, first_record in self._index:
+      self._file.write(_INDEX_ENTRY.pack(offset, first_record))
+    self._file.write(
+        _TRAILER.pack(index_offset, self._num_records, _RECORD_FILE_MAGIC))
+    self._file.close()
+
+  @property
+  def num_records(self) -> int:
+    """Return the number of records written."""
+    return self._num_records
+
+  def _WriteBlock(self) -> None:
+    if not self._block_num_records:
+      return
+    data = _CompressRecordBlock(b''.join(self._block), self._compression)
+    self._index.append(
+        (self._file.tell(), self._num_records - self._block_num_records))
+    self._file.write(_BLOCK_HEADER.pack(
+        self._compression, self._block_num_records, len(data),
+        zlib.crc32(data)))
+    self._file.write(data)
+    self._block = []
+    self._block_size = 0
+    self._block_num_records = 0
+
+  def __enter__(self) -> 'RecordWriter':
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback) -> None:
+    if exc_type is None:
+      self.Close()
+    else:
+      # Do not write the index of a partially written file, so that readers
+      # report it as not closed rather than reading a truncated file.
+      self._file.close()
+
+
+class RecordReader(object):
+  """A reader for record files.
+
+  A reader supports iterating over the messages of a record file in order,
+  and random access to messages by index:
+
+      with pbutil.RecordReader(path, MyMessage) as reader:
+        for message in reader:
+          ...
+        last_message = reader[len(reader) - 1]
+
+  Random access decodes the entire block containing a message. The most
+  recently decoded block is cached, so accessing nearby messages is cheap.
+  """
+
+  def __init__(self, path: pathlib.Path, message_class: typing.Type,
+               uninitialized_okay: bool = False):
+    """Open a record file.
+
+    Args:
+      path: The path of the record file.
+      message_class: The class of the messages in the file.
+      uninitialized_okay: If True, do not require that decoded messages be
+        initialized. If False, DecodeError is raised.
+
+    Raises:
+      FileNotFoundError: If the path does not exist.
+      IsADirectoryError: If the path is a directory.
+      DecodeError: If the path is not a record file, or it was not closed.
+    """
+    if not path.is_file():
+      if path.is_dir():
+        raise IsADirectoryError(f"Path is a directory: '{path}'")
+      else:
+        raise FileNotFoundError(f"File not found: '{path}'")
+    self._path = path
+    self._message_class = message_class
+    self._uninitialized_okay = uninitialized_okay
+    self._file = open(path, 'rb')
+    try:
+      self._ReadIndex()
+    except Exception:
+      self._file.close()
+      raise
+    # The cached block: its number and its records.
+    self._cached_block: typing.Tuple[int, typing.List[bytes]] = (-1, [])
+
+  def __len__(self) -> int:
+    return self._num_records
+
+  def __getitem__(self, i: int) -> ProtocolBuffer:
+    """Read the message at the given index.
+
+    Args:
+      i: The index of the message. Negative indices count from the end.
+
+    Returns:
+      The message.
+
+    Raises:
+      IndexError: If the index is out of range.
+      DecodeError: If the message cannot be decoded.
+    """
+    if i < 0:
+      i += self._num_records
+    if not 0 <= i < self._num_records:
+      raise IndexError(f'Record index out of range: {i}')
+    block_num = bisect.bisect_right(self._first_records, i) - 1
+    if self._cached_block[0] != block_num:
+      self._cached_block = (
+        block_num, _ReadRecordBlock(self._file, self._offsets[block_num]))
+    record = self._cached_block[1][i - self._first_records[block_num]]
+    return _ParseRecords([record], self._message_class,
+                         self._uninitialized_okay)[0]
+
+  def __iter__(self) -> typing.Iterator[ProtocolBuffer]:
+    for records in self._IterBlocks():
+      yield from _ParseRecords(records, self._message_class,
+                               self._uninitialized_okay)
+
+  def IterRecords(self) -> typing.Iterator[bytes]:
+    """Iterate over the serialized messages of the file, without decoding.
+
+    Returns:
+      An iterator of serialized messages.
+    """
+    for records in self._IterBlocks():
+      yield from records
+
+  def ParallelDecode(
+      self, pool: multiprocessing.Pool,
+      fn: typing.Optional[typing.Callable[[ProtocolBuffer], typing.Any]] = None
+  ) -> typing.Iterator[typing.Any]:
+    """Decode the messages of the file in parallel.
+
+    Every block of the file is read and decoded by a worker of the pool. The
+    messages must then be transferred back to the calling process, so where
+    possible, pass a function which reduces each message to the value which is
+    required.
+
+    Args:
+      pool: The multiprocessing pool to decode blocks in.
+      fn: A function to apply to every message in the worker process. Must be
+        a picklable, module-level function. If not provided, the messages are
+        returned.
+
+    Returns:
+      An iterator of messages, or of fn(message) for every message, in order.
+    """
+    jobs = ((str(self._path), offset, self._message_class,
+             self._uninitialized_okay, fn) for offset in self._offsets)
+    for values in pool.imap(_DecodeRecordBlock, jobs):
+      yield from values
+
+  def Close(self) -> None:
+    """Close the file."""
+    self._file.close()
+
+  def _ReadIndex(self) -> None:
+    if self._file.read(len(_RECORD_FILE_MAGIC)) != _RECORD_FILE_MAGIC:
+      raise DecodeError(f"Not a record file: '{self._path}'")
+    file_size = self._file.seek(0, io.SEEK_END)
+    if file_size < len(_RECORD_FILE_MAGIC) + _TRAILER.size:
+      raise DecodeError(f"Record file was not closed: '{self._path}'")
+    self._file.seek(file_size - _TRAILER.size)
+    index_offset, self._num_records, magic = _TRAILER.unpack(
+        self._file.read(_TRAILER.size))
+    index_size = file_size - _TRAILER.size - index_offset
+    if (magic != _RECORD_FILE_MAGIC or index_size < 0 or
+        index_size % _INDEX_ENTRY.size):
+      raise DecodeError(f"Record file was not closed: '{self._path}'")
+    self._file.seek(index_offset)
+    index = self._file.read(index_size)
+    self._offsets: typing.List[int] = []
+    self._first_records: typing.List[int] = []
+    for offset, first_record in _INDEX_ENTRY.iter_unpack(index):
+      self._offsets.append(offset)
+      self._first_records.append(first_record)
+
+  def _IterBlocks(self) -> typing.Iterator[typing.List[bytes]]:
+    # Blocks are read using a separate file, so that random access during
+    # iteration does not change the position of the iterator.
+    with open(self._path, 'rb') as f:
+      for offset in self._offsets:
+        yield _ReadRecordBlock(f, offset)
+
+  def __enter__(self) -> 'RecordReader':
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.Close()
+
+
+def PbtxtDirectoryToRecordFile(directory: pathlib.Path, path: pathlib.Path,
+                               message_class: typing.Type,
+                               compression: str = 'none') -> int:
+  """Write the protos of a directory to a record file.
+
+  The files are read in order of their names, using FromFile(), so every
+  format supported by FromFile() may be used.
+
+  Args:
+    directory: The directory of proto files.
+    path: The path of the record file to write.
+    message_class: The class of the messages.
+    compression: The block compression type of the record file.
+
+  Returns:
+    The number of messages written.
+
+  Raises:
+    DecodeError: If a file cannot be decoded.
+  """
+  with RecordWriter(path, compression=compression) as writer:
+    for proto_path in sorted(directory.iterdir()):
+      if proto_path.is_file():
+        writer.Write(FromFile(proto_path, message_class()))
+  return writer.num_records
+
+
+def RecordFileToPbtxtDirectory(path: pathlib.Path, directory: pathlib.Path,
+                               message_class: typing.Type) -> int:
+  """Write the messages of a record file to a directory of text format protos.
+
+  The files are named by the index of the message in the record file, padded
+  with zeros so that the order of the file names is the order of the messages.
+
+  Args:
+    path: The path of the record file.
+    directory: The directory to write the text format protos to. It is created
+      if required.
+    message_class: The class of the messages.
+
+  Returns:
+    The number of messages written.
+  """
+  directory.mkdir(parents=True, exist_ok=True)
+  with RecordReader(path, message_class) as reader:
+    width = len(str(max(len(reader) - 1, 0)))
+    for i, message in enumerate(reader):
+      ToFile(message, directory / f'{i:0{width}d}.pbtxt')
+    return len(reader)
+
+
 def _TruncatedString(string: str, n: int = 80) -> str:
   """Return the truncated first 'n' characters of a string.
 
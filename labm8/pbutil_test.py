@@ -1,4 +1,5 @@
 """Unit tests for //labm8:pbutil."""
+import multiprocessing
 import pathlib
 import sys
 import tempfile
@@ -339,6 +340,159 @@ def test_ProtoBackedMixin_FromProtoFile(suffix: str, tempdir: pathlib.Path):
   assert instance.number == 42
 
 
+# RecordWriter() and RecordReader() tests.
+
+def _TestMessages(n: int):
+  return [test_protos_pb2.TestMessage(string=f'message {i}', number=i)
+          for i in range(n)]
+
+
+def _MessageNumber(message: test_protos_pb2.TestMessage) -> int:
+  return message.number
+
+
+@pytest.mark.parametrize('compression', ['none', 'gzip'])
+def test_RecordReader_iter(tempdir: pathlib.Path, compression: str):
+  """Test that messages are read in the order that they were written."""
+  messages = _TestMessages(1000)
+  with pbutil.RecordWriter(tempdir / 'records', compression=compression,
+                           block_size_bytes=256) as writer:
+    for message in messages:
+      writer.Write(message)
+  assert writer.num_records == 1000
+
+  with pbutil.RecordReader(tempdir / 'records',
+                           test_protos_pb2.TestMessage) as reader:
+    assert len(reader) == 1000
+    assert list(reader) == messages
+
+
+@pytest.mark.parametrize('compression', ['none', 'gzip'])
+def test_RecordReader_getitem(tempdir: pathlib.Path, compression: str):
+  """Test random access to messages."""
+  messages = _TestMessages(1000)
+  with pbutil.RecordWriter(tempdir / 'records', compression=compression,
+                           block_size_bytes=256) as writer:
+    for message in messages:
+      writer.Write(message)
+
+  with pbutil.RecordReader(tempdir / 'records',
+                           test_protos_pb2.TestMessage) as reader:
+    for i in [0, 999, 500, 501, 3, -1]:
+      assert reader[i] == messages[i]
+    with pytest.raises(IndexError):
+      reader[1000]
+
+
+def test_RecordReader_empty_file(tempdir: pathlib.Path):
+  """Test reading a record file which contains no messages."""
+  with pbutil.RecordWriter(tempdir / 'records'):
+    pass
+  with pbutil.RecordReader(tempdir / 'records',
+                           test_protos_pb2.TestMessage) as reader:
+    assert not len(reader)
+    assert not list(reader)
+
+
+def test_RecordReader_IterRecords(tempdir: pathlib.Path):
+  """Test iterating over serialized messages."""
+  messages = _TestMessages(10)
+  with pbutil.RecordWriter(tempdir / 'records') as writer:
+    for message in messages:
+      writer.Write(message)
+  with pbutil.RecordReader(tempdir / 'records',
+                           test_protos_pb2.TestMessage) as reader:
+    assert list(reader.IterRecords()) == [
+      m.SerializeToString() for m in messages]
+
+
+def test_RecordReader_ParallelDecode(tempdir: pathlib.Path):
+  """Test decoding blocks in parallel."""
+  messages = _TestMessages(1000)
+  with pbutil.RecordWriter(tempdir / 'records', compression='gzip',
+                           block_size_bytes=256) as writer:
+    for message in messages:
+      writer.Write(message)
+
+  pool = multiprocessing.Pool(2)
+  with pbutil.RecordReader(tempdir / 'records',
+                           test_protos_pb2.TestMessage) as reader:
+    assert list(reader.ParallelDecode(pool)) == messages
+    assert list(reader.ParallelDecode(pool, _MessageNumber)) == list(
+        range(1000))
+
+
+def test_RecordWriter_message_missing_required_fields(tempdir: pathlib.Path):
+  """Test that EncodeError is raised if required field is not set."""
+  with pbutil.RecordWriter(tempdir / 'records') as writer:
+    with pytest.raises(pbutil.EncodeError):
+      writer.Write(test_protos_pb2.TestMessage(number=1))
+
+
+def test_RecordWriter_unknown_compression(tempdir: pathlib.Path):
+  """Test that ValueError is raised for an unknown compression type."""
+  with pytest.raises(ValueError):
+    pbutil.RecordWriter(tempdir / 'records', compression='foo')
+
+
+def test_RecordReader_corrupt_record(tempdir: pathlib.Path):
+  """Test that DecodeError is raised if a record is corrupt."""
+  with pbutil.RecordWriter(tempdir / 'records') as writer:
+    writer.Write(test_protos_pb2.TestMessage(string='abc'))
+  data = bytearray((tempdir / 'records').read_bytes())
+  data[data.index(b'abc')] = ord('x')
+  (tempdir / 'records').write_bytes(bytes(data))
+
+  with pbutil.RecordReader(tempdir / 'records',
+                           test_protos_pb2.TestMessage) as reader:
+    with pytest.raises(pbutil.DecodeError):
+      list(reader)
+
+
+def test_RecordReader_not_closed(tempdir: pathlib.Path):
+  """Test that DecodeError is raised if the writer was not closed."""
+  writer = pbutil.RecordWriter(tempdir / 'records')
+  writer.Write(test_protos_pb2.TestMessage(string='abc'))
+  writer._file.flush()
+  with pytest.raises(pbutil.DecodeError):
+    pbutil.RecordReader(tempdir / 'records', test_protos_pb2.TestMessage)
+
+
+def test_RecordReader_writer_exception(tempdir: pathlib.Path):
+  """Test that DecodeError is raised if the writer context raised."""
+  with pytest.raises(ValueError):
+    with pbutil.RecordWriter(tempdir / 'records') as writer:
+      writer.Write(test_protos_pb2.TestMessage(string='abc'))
+      raise ValueError('interrupted')
+  with pytest.raises(pbutil.DecodeError) as e_info:
+    pbutil.RecordReader(tempdir / 'records', test_protos_pb2.TestMessage)
+  assert 'was not closed' in str(e_info.value)
+
+
+def test_RecordReader_file_not_found(tempdir: pathlib.Path):
+  """Test that FileNotFoundError is raised if the file does not exist."""
+  with pytest.raises(FileNotFoundError):
+    pbutil.RecordReader(tempdir / 'records', test_protos_pb2.TestMessage)
+
+
+def test_PbtxtDirectoryToRecordFile_round_trip(tempdir: pathlib.Path):
+  """Test converting a directory of protos to a record file and back."""
+  messages = _TestMessages(20)
+  (tempdir / 'a').mkdir()
+  for i, message in enumerate(messages):
+    pbutil.ToFile(message, tempdir / 'a' / f'{i:03d}.pbtxt')
+
+  assert pbutil.PbtxtDirectoryToRecordFile(
+      tempdir / 'a', tempdir / 'records', test_protos_pb2.TestMessage) == 20
+  assert pbutil.RecordFileToPbtxtDirectory(
+      tempdir / 'records', tempdir / 'b', test_protos_pb2.TestMessage) == 20
+
+  paths = sorted((tempdir / 'b').iterdir())
+  assert [p.name for p in paths[:2]] == ['00.pbtxt', '01.pbtxt']
+  assert [pbutil.FromFile(p, test_protos_pb2.TestMessage())
+          for p in paths] == messages
+
+
 def main(argv):
   del argv
   sys.exit(pytest.main([__file__, '-vv']))
@@ -3,18 +3,30 @@
 The goal of the module is to provide easy to use implementations of typical
 parallel workloads, such as data parallel map operations.
 """
+import collections
+import functools
 import multiprocessing
+import os
+import queue
 import subprocess
+import threading
+import time
 import typing
 
 from absl import flags
 
 from labm8 import bazelutil
+from labm8 import framedproc
 from labm8 import pbutil
 
 
 FLAGS = flags.FLAGS
 
+# The environment variable which instructs a binary built using one of the
+# PBUTIL_*PROCESS_MAIN macros of //phd:pbutil to process a stream of messages,
+# rather than a single message. See phd/pbutil.h.
+_STREAM_ENVIRONMENT_VARIABLE = 'PBUTIL_STREAM'
+
 
 class MapWorkerError(EnvironmentError):
   """Resulting error from a _MapWorker that fails."""
@@ -36,6 +48,13 @@ class MapWorkerError(EnvironmentError):
     return self._returncode
 
 
+class MapWorkerTimeout(MapWorkerError):
+  """Resulting error from a _MapWorker that did not complete in time."""
+
+  def __repr__(self) -> str:
+    return f"Command timed out and was killed with code {self.returncode}"
+
+
 class _MapWorker(object):
   """A work unit for a data parallel workload.
 
@@ -66,14 +85,19 @@ class _MapWorker(object):
     self._output_proto: typing.Optional[pbutil.ProtocolBuffer] = None
     self._output_proto_decoded = False
     self._returncode: typing.Optional[int] = None
+    self._timed_out = False
     self._done = False
 
-  def Run(self) -> None:
+  def Run(self, timeout_seconds: typing.Optional[float] = None) -> None:
     """Execute the process and store the output.
 
     If the process fails, no exception is raised. The error can be accessed
     using the error() method. After calling this method, SetProtos() *must* be
     called.
+
+    Args:
+      timeout_seconds: The maximum number of seconds to wait for the process.
+        If the process does not complete in time, it is killed.
     """
     assert not self._done
 
@@ -81,8 +105,13 @@ class _MapWorker(object):
     process = subprocess.Popen(
         self._cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
     # Send the input proto to the C++ worker process.
-    # TODO: Add timeout.
-    stdout, _ = process.communicate(self._input_proto_string)
+    try:
+      stdout, _ = process.communicate(self._input_proto_string,
+                                      timeout=timeout_seconds)
+    except subprocess.TimeoutExpired:
+      process.kill()
+      stdout, _ = process.communicate()
+      self._timed_out = True
     self._returncode = process.returncode
     del self._input_proto_string
 
@@ -90,6 +119,30 @@ class _MapWorker(object):
       # Store the C++ binary output in wire format.
       self._output_proto_string = stdout
 
+  def RunInProcess(self, process: '_ProtoProcessingBinaryProcess',
+                   timeout_seconds: typing.Optional[float] = None) -> None:
+    """Process the input using a long-lived process and store the output.
+
+    This is the equivalent of Run() for a process which processes a stream of
+    messages. After calling this method, SetProtos() *must* be called.
+
+    Args:
+      process: The process to send the input proto to.
+      timeout_seconds: The maximum number of seconds to wait for the output.
+        If the process does not respond in time, it is killed.
+    """
+    assert not self._done
+    try:
+      self._output_proto_string = process.Process(
+          self._input_proto_string, timeout_seconds)
+      self._returncode = 0
+    except MapWorkerTimeout as e:
+      self._returncode = e.returncode
+      self._timed_out = True
+    except MapWorkerError as e:
+      self._returncode = e.returncode
+    del self._input_proto_string
+
   def SetProtos(self, input_proto: pbutil.ProtocolBuffer,
                 output_proto_class: typing.Type) -> None:
     """Set the input protocol buffer, and decode the output protocol buffer.
@@ -138,7 +191,9 @@ class _MapWorker(object):
 
     If the process succeeded (e.g. _MapWorker.ok()), None is returned.
     """
-    if self._returncode:
+    if self._timed_out:
+      return MapWorkerTimeout(self._returncode)
+    elif self._returncode:
       return MapWorkerError(self._returncode)
 
   def ok(self) -> bool:
@@ -146,40 +201,237 @@ class _MapWorker(object):
     return not self._returncode
 
 
-def _RunNativeProtoProcessingWorker(map_worker: _MapWorker) -> _MapWorker:
+class _ProtoProcessingBinaryProcess(object):
+  """A long-lived process of a binary which processes a stream of messages.
+
+  The binary must be built using one of the PBUTIL_*PROCESS_MAIN macros of
+  //phd:pbutil. The process is started lazily, and restarted after it fails.
+  Instances must not be shared between threads.
+  """
+
+  def __init__(self, cmd: typing.List[str]):
+    """Instantiate a process.
+
+    Args:
+      cmd: The command to execute, as a list of arguments to subprocess.Popen().
+    """
+    self._process = framedproc.FramedProcess(
+        cmd, env=dict(os.environ, **{_STREAM_ENVIRONMENT_VARIABLE: '1'}))
+
+  def Process(self, data: bytes,
+              timeout_seconds: typing.Optional[float] = None) -> bytes:
+    """Send a serialized message to the process and wait for the output.
+
+    Args:
+      data: The serialized input message.
+      timeout_seconds: The maximum number of seconds to wait for the output.
+
+    Returns:
+      The serialized output message.
+
+    Raises:
+      MapWorkerTimeout: If the process does not respond in time. The process
+        is killed, and will be restarted by the next call.
+      MapWorkerError: If the process fails. It will be restarted by the next
+        call.
+    """
+    if not self._process.running:
+      self._process.Start()
+    deadline = time.time() + timeout_seconds if timeout_seconds else None
+    try:
+      return self._process.Call(data, deadline)
+    except framedproc.FrameTimeout:
+      raise MapWorkerTimeout(self._process.Stop())
+    except (OSError, EOFError):
+      # The process has closed its end of a pipe, so it has exited or is about
+      # to exit. Wait for it to determine why.
+      raise MapWorkerError(self._process.Stop(kill=False) or 1)
+
+  def Stop(self) -> None:
+    """Terminate the process, if it is running."""
+    self._process.Stop(kill=False)
+
+
+def _RunNativeProtoProcessingWorker(
+    map_worker: _MapWorker,
+    timeout_seconds: typing.Optional[float] = None) -> _MapWorker:
   """Private helper message to execute Run() method of _MapWorker.
 
   This is passed to Pool.imap_unordered() as the function to execute for every
   work unit. This is needed because only module-level functions can be pickled.
   """
-  map_worker.Run()
+  map_worker.Run(timeout_seconds)
   return map_worker
 
 
+def _MapNativeProtoProcessingBinaryProcesses(
+    cmd: typing.List[str],
+    input_protos: typing.Iterable[pbutil.ProtocolBuffer],
+    output_proto_class: typing.Type, num_processes: int,
+    timeout_seconds: typing.Optional[float],
+    ordered: bool) -> typing.Iterator[_MapWorker]:
+  """Run a binary over a stream of inputs using long-lived processes.
+
+  Each of num_processes threads owns a process of the binary, and feeds it
+  inputs one at a time. At most 2 * num_processes inputs are read ahead of the
+  results which have been generated. This includes inputs which are queued,
+  in progress, or waiting to be generated, so in ordered mode a slow input
+  stalls the reading of inputs rather than buffering the stream.
+  """
+  max_pending = 2 * num_processes
+  # A slot is acquired for every input which is read, and released once its
+  # result is generated.
+  slots = threading.BoundedSemaphore(max_pending)
+  inputs = queue.Queue(maxsize=max_pending)
+  outputs = queue.Queue(maxsize=max_pending)
+  stop = threading.Event()
+
+  def _Put(q: queue.Queue, item) -> bool:
+    """Put an item on a queue, returning False if stopped before then."""
+    while not stop.is_set():
+      try:
+        q.put(item, timeout=.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _AcquireSlot() -> bool:
+    """Acquire a slot, returning False if stopped before then."""
+    while not stop.is_set():
+      if slots.acquire(timeout=.1):
+        return True
+    return False
+
+  def _ReadInputs() -> None:
+    try:
+      input_protos_iterator = iter(input_protos)
+      i = 0
+      while _AcquireSlot():
+        try:
+          input_proto = next(input_protos_iterator)
+        except StopIteration:
+          break
+        if not _Put(inputs, (i, input_proto)):
+          return
+        i += 1
+    except Exception as e:
+      # Errors raised by the input iterator are re-raised by the consumer.
+      _Put(outputs, e)
+    for _ in range(num_processes):
+      _Put(inputs, None)
+
+  def _RunProcess() -> None:
+    process = _ProtoProcessingBinaryProcess(cmd)
+    try:
+      while not stop.is_set():
+        try:
+          item = inputs.get(timeout=.1)
+        except queue.Empty:
+          continue
+        if item is None:
+          break
+        i, input_proto = item
+        map_worker = _MapWorker(i, cmd, input_proto)
+        map_worker.RunInProcess(process, timeout_seconds)
+        if not _Put(outputs, (map_worker, input_proto)):
+          break
+    except Exception as e:
+      _Put(outputs, e)
+    finally:
+      process.Stop()
+      _Put(outputs, None)
+
+  threads = [threading.Thread(target=_ReadInputs)] + [
+    threading.Thread(target=_RunProcess) for _ in range(num_processes)]
+  for thread in threads:
+    thread.start()
+
+  # Results which have completed out of order, keyed by ID.
+  reorder_buffer: typing.Dict[int, _MapWorker] = {}
+  next_id = 0
+  try:
+    num_running = num_processes
+    while num_running:
+      item = outputs.get()
+      if item is None:
+        num_running -= 1
+        continue
+      elif isinstance(item, Exception):
+        raise item
+      map_worker, input_proto = item
+      map_worker.SetProtos(input_proto, output_proto_class)
+      if not ordered:
+        slots.release()
+        yield map_worker
+        continue
+      reorder_buffer[map_worker.id] = map_worker
+      while next_id in reorder_buffer:
+        slots.release()
+        yield reorder_buffer.pop(next_id)
+        next_id += 1
+  finally:
+    stop.set()
+    for thread in threads:
+      thread.join()
+
+
 def MapNativeProtoProcessingBinary(
     binary_data_path: str, input_protos: typing.List[pbutil.ProtocolBuffer],
     output_proto_class: typing.Type,
     binary_args: typing.Optional[typing.List[str]] = None,
     pool: typing.Optional[multiprocessing.Pool] = None,
-    num_processes: typing.Optional[int] = None) -> typing.Iterator[_MapWorker]:
+    num_processes: typing.Optional[int] = None,
+    persistent_processes: bool = False,
+    timeout_seconds: typing.Optional[float] = None,
+    ordered: bool = False) -> typing.Iterator[_MapWorker]:
   """Run a protocol buffer processing binary over a set of inputs.
 
+  By default, the binary is executed once for every input. If
+  persistent_processes is True, num_processes long-lived processes of the
+  binary are started, and the inputs are streamed to them. This avoids the
+  cost of starting a process for every input, but requires that the binary is
+  built using one of the PBUTIL_*PROCESS_MAIN macros of //phd:pbutil. A process
+  which fails or times out is restarted for the next input.
+
   Args:
     binary_data_path: The path of the binary to execute, as provied to
       bazelutil.DataPath().
     input_protos: An iterable list of input protos.
     output_proto_class: The proto class of the output.
     binary_args: An optional list of additional arguments to pass to binaries.
-    pool: The multiprocessing pool to use.
-    num_processes: The number of processes for the multiprocessing pool.
+    pool: The multiprocessing pool to use. Not used if persistent_processes
+      is True.
+    num_processes: The number of processes for the multiprocessing pool, or
+      the number of persistent processes.
+    persistent_processes: If True, stream the inputs to long-lived processes
+      of the binary.
+    timeout_seconds: The maximum number of seconds to process a single input.
+      If exceeded, the process is killed and the _MapWorker fails with a
+      MapWorkerTimeout error.
+    ordered: If True, results are generated in the order of the inputs. This
+      is only supported if persistent_processes is True.
 
   Returns:
-    A generator of _MapWorker instances. The order is random.
+    A generator of _MapWorker instances. The order is random, unless ordered
+    is True.
+
+  Raises:
+    ValueError: If ordered is True but persistent_processes is not.
   """
+  if ordered and not persistent_processes:
+    raise ValueError('Ordered results require persistent processes')
+
   binary_path = bazelutil.DataPath(binary_data_path)
   binary_args = binary_args or []
   cmd = [str(binary_path)] + binary_args
 
+  if persistent_processes:
+    yield from _MapNativeProtoProcessingBinaryProcesses(
+        cmd, input_protos, output_proto_class,
+        num_processes or multiprocessing.cpu_count(), timeout_seconds, ordered)
+    return
+
   # Read all inputs to a list. We need the inputs in a list so that we can
   # map an inputs position in the list to a _MapWorker.id.
   input_protos = list(input_protos)
@@ -192,7 +444,8 @@ def MapNativeProtoProcessingBinary(
     i, input_proto in enumerate(input_protos))
 
   for map_worker in pool.imap_unordered(
-      _RunNativeProtoProcessingWorker, map_worker_iterator):
+      functools.partial(_RunNativeProtoProcessingWorker,
+                        timeout_seconds=timeout_seconds), map_worker_iterator):
     map_worker.SetProtos(input_protos[map_worker.id], output_proto_class)
     yield map_worker
 
@@ -239,3 +492,34 @@ def MapNativeProcessingBinaries(
     map_worker.SetProtos(
         input_protos[map_worker.id], output_proto_classes[map_worker.id])
     yield map_worker
+
+
+def BoundedMap(
+    fn: typing.Callable[[typing.Any], typing.Any],
+    inputs: typing.Iterable[typing.Any], pool: multiprocessing.Pool,
+    max_pending: typing.Optional[int] = None) -> typing.Iterator[typing.Any]:
+  """An ordered parallel map which consumes its inputs lazily.
+
+  Unlike Pool.imap(), which reads the entire input iterable as fast as it can
+  and queues every task, this reads at most max_pending inputs ahead of the
+  results which have been yielded. This bounds the memory required for mapping
+  over large, streaming inputs.
+
+  Args:
+    fn: The function to apply. Must be a picklable, module-level function.
+    inputs: An iterable of inputs to fn.
+    pool: The multiprocessing pool to use.
+    max_pending: The maximum number of inputs which may be queued or in
+      progress at once. If not provided, twice the number of CPUs is used.
+
+  Returns:
+    A generator of fn(x) for every x in inputs, in the order of inputs.
+  """
+  max_pending = max_pending or 2 * multiprocessing.cpu_count()
+  pending = collections.deque()
+  for x in inputs:
+    pending.append(pool.apply_async(fn, (x,)))
+    if len(pending) >= max_pending:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
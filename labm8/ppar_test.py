@@ -1,6 +1,7 @@
 """Unit tests for //labm8:ppar."""
 import multiprocessing
 import sys
+import time
 
 import progressbar
 import pytest
@@ -192,6 +193,194 @@ def test_MapWorker_binary_args():
   assert not results[0].ok()
 
 
+def test_MapWorker_timeout():
+  """Test that a binary which does not complete in time is killed."""
+  results = list(ppar.MapNativeProtoProcessingBinary(
+      'phd/labm8/data/test/ppar/proto_worker',
+      [protos_pb2.AddXandY(x=20, y=2)], protos_pb2.AddXandY, num_processes=1,
+      timeout_seconds=1))
+  assert len(results) == 1
+  assert not results[0].ok()
+  assert type(results[0].error()) is ppar.MapWorkerTimeout
+
+
+def test_MapWorker_ordered_requires_persistent_processes():
+  """Test that ordered results are not supported by one-shot processes."""
+  with pytest.raises(ValueError):
+    next(ppar.MapNativeProtoProcessingBinary(
+        'phd/labm8/data/test/ppar/proto_worker',
+        [protos_pb2.AddXandY(x=2, y=2)], protos_pb2.AddXandY, ordered=True))
+
+
+def test_MapWorker_persistent_processes_okay():
+  """Test processing a stream of inputs with persistent processes."""
+  inputs = [protos_pb2.AddXandY(x=i, y=2) for i in range(5)]
+  results = list(ppar.MapNativeProtoProcessingBinary(
+      'phd/labm8/data/test/ppar/proto_worker', inputs, protos_pb2.AddXandY,
+      num_processes=2, persistent_processes=True))
+
+  assert len(results) == 5
+  assert all(r.ok() for r in results)
+  assert sorted(r.output().result for r in results) == [2, 3, 4, 5, 6]
+  for r in results:
+    assert r.input() is inputs[r.id]
+
+
+def test_MapWorker_persistent_processes_ordered():
+  """Test that ordered results are generated in the order of inputs."""
+  inputs = [protos_pb2.AddXandY(x=2, y=i) for i in range(20)]
+  results = list(ppar.MapNativeProtoProcessingBinary(
+      'phd/labm8/data/test/ppar/proto_worker', inputs, protos_pb2.AddXandY,
+      num_processes=3, persistent_processes=True, ordered=True))
+
+  assert [r.id for r in results] == list(range(20))
+  assert [r.output().result for r in results] == [i + 2 for i in range(20)]
+
+
+def test_MapWorker_persistent_processes_failure_restarts_process():
+  """Test that a failed process is restarted to process subsequent inputs."""
+  inputs = [protos_pb2.AddXandY(x=2, y=2), protos_pb2.AddXandY(x=10, y=1),
+            protos_pb2.AddXandY(x=3, y=2)]
+  results = list(ppar.MapNativeProtoProcessingBinary(
+      'phd/labm8/data/test/ppar/proto_worker', inputs, protos_pb2.AddXandY,
+      num_processes=1, persistent_processes=True, ordered=True))
+
+  assert len(results) == 3
+  assert results[0].output().result == 4
+  assert not results[1].ok()
+  assert results[1].output() is None
+  error = results[1].error()
+  assert type(error) is ppar.MapWorkerError
+  assert error.returncode == 1
+  assert results[2].output().result == 5
+
+
+def test_MapWorker_persistent_processes_timeout_restarts_process():
+  """Test that a process which times out is killed and restarted."""
+  inputs = [protos_pb2.AddXandY(x=20, y=2), protos_pb2.AddXandY(x=3, y=2)]
+  results = list(ppar.MapNativeProtoProcessingBinary(
+      'phd/labm8/data/test/ppar/proto_worker', inputs, protos_pb2.AddXandY,
+      num_processes=1, persistent_processes=True, timeout_seconds=1,
+      ordered=True))
+
+  assert len(results) == 2
+  assert type(results[0].error()) is ppar.MapWorkerTimeout
+  assert results[1].output().result == 5
+
+
+def test_MapWorker_persistent_processes_lazy_inputs():
+  """Test that a stream of inputs is not read far ahead of the results."""
+  consumed = []
+
+  def InputGenerator():
+    """An infinite generator of inputs."""
+    i = 0
+    while True:
+      consumed.append(i)
+      yield protos_pb2.AddXandY(x=2, y=i)
+      i += 1
+
+  results = ppar.MapNativeProtoProcessingBinary(
+      'phd/labm8/data/test/ppar/proto_worker', InputGenerator(),
+      protos_pb2.AddXandY, num_processes=1, persistent_processes=True)
+  assert next(results).output().result == 2
+  # Give the threads time to read ahead as far as they are able to.
+  time.sleep(1)
+  # Two inputs may be pending, plus one for the result which was generated.
+  assert len(consumed) == 3
+  results.close()
+
+
+def test_MapWorker_persistent_processes_ordered_slow_input():
+  """Test that a slow input in ordered mode stalls the reading of inputs."""
+  consumed = []
+
+  def InputGenerator():
+    """An infinite generator of inputs, the first of which hangs."""
+    consumed.append(0)
+    yield protos_pb2.AddXandY(x=20, y=0)
+    i = 1
+    while True:
+      consumed.append(i)
+      yield protos_pb2.AddXandY(x=2, y=i)
+      i += 1
+
+  results = ppar.MapNativeProtoProcessingBinary(
+      'phd/labm8/data/test/ppar/proto_worker', InputGenerator(),
+      protos_pb2.AddXandY, num_processes=2, persistent_processes=True,
+      timeout_seconds=2, ordered=True)
+  # While the first input hangs, the other process may complete no more than
+  # the pending inputs.
+  assert type(next(results).error()) is ppar.MapWorkerTimeout
+  assert len(consumed) <= 2 * 2 + 1
+  assert next(results).output().result == 3
+  results.close()
+
+
+def test_MapWorker_persistent_processes_no_inputs():
+  """Test that no output is produced when run with no inputs."""
+  results = list(ppar.MapNativeProtoProcessingBinary(
+      'phd/labm8/data/test/ppar/proto_worker', [], protos_pb2.AddXandY,
+      persistent_processes=True))
+  assert not results
+
+
+def test_MapWorker_persistent_processes_binary_not_found():
+  """Test that FileNotFoundError raised when binary does not exist."""
+  generator = ppar.MapNativeProtoProcessingBinary(
+      'phd/labm8/data/test/ppar/not/a/real/binary',
+      [protos_pb2.AddXandY()], protos_pb2.AddXandY, persistent_processes=True)
+  with pytest.raises(FileNotFoundError):
+    next(generator)
+
+
+@pytest.mark.parametrize('persistent_processes', [False, True])
+def test_benchmark_MapNativeProtoProcessingBinary(benchmark,
+                                                  persistent_processes: bool):
+  """Benchmark processing 10k protos with one-shot and persistent processes."""
+  inputs = [protos_pb2.AddXandY(x=2, y=i) for i in range(10000)]
+
+  def Run():
+    results = list(ppar.MapNativeProtoProcessingBinary(
+        'phd/labm8/data/test/ppar/proto_worker', inputs, protos_pb2.AddXandY,
+        persistent_processes=persistent_processes))
+    assert len(results) == 10000
+
+  benchmark.pedantic(Run, rounds=1)
+
+
+def _Square(x: int) -> int:
+  return x * x
+
+
+def test_BoundedMap_ordered_results():
+  """Test that results are yielded in the order of inputs."""
+  pool = multiprocessing.Pool(2)
+  assert list(ppar.BoundedMap(_Square, range(20), pool, max_pending=3)) == [
+    x * x for x in range(20)]
+
+
+def test_BoundedMap_lazy_inputs():
+  """Test that inputs are not consumed more than max_pending ahead."""
+  pool = multiprocessing.Pool(2)
+  consumed = []
+
+  def _Inputs():
+    for i in range(10):
+      consumed.append(i)
+      yield i
+
+  results = ppar.BoundedMap(_Square, _Inputs(), pool, max_pending=3)
+  assert next(results) == 0
+  assert len(consumed) == 3
+
+
+def test_BoundedMap_empty_inputs():
+  """Test that an empty input produces no results."""
+  pool = multiprocessing.Pool(1)
+  assert not list(ppar.BoundedMap(_Square, [], pool))
+
+
 def main(argv):
   del argv
   sys.exit(pytest.main([__file__, '-vv']))
@@ -3,10 +3,52 @@
 
 #include "phd/macros.h"
 
+#include <cstdint>
+#include <cstdlib>
+#include <functional>
 #include <iostream>
+#include <string>
 
 namespace pbutil {
 
+// The environment variable which, when set to "1", causes the *_PROCESS_MAIN
+// programs to process a stream of messages, rather than a single message.
+constexpr char kStreamEnvironmentVariable[] = "PBUTIL_STREAM";
+
+// Return whether the current process should process a stream of messages.
+inline bool IsStreamingProcess() {
+  const char* value = std::getenv(kStreamEnvironmentVariable);
+  return value && std::string(value) == "1";
+}
+
+// Read a length-prefixed message from an istream. The length is a big-endian
+// uint32. Returns false if the istream is at its end.
+inline bool ReadFrame(std::istream* istream, std::string* buffer) {
+  unsigned char header[4];
+  if (!istream->read(reinterpret_cast<char*>(header), sizeof(header))) {
+    CHECK(!istream->gcount());
+    return false;
+  }
+  uint32_t size = (uint32_t(header[0]) << 24) | (uint32_t(header[1]) << 16) |
+                  (uint32_t(header[2]) << 8) | uint32_t(header[3]);
+  buffer->resize(size);
+  CHECK(istream->read(&(*buffer)[0], size));
+  return true;
+}
+
+// Write a length-prefixed message to an ostream and flush it.
+inline void WriteFrame(const std::string& buffer, std::ostream* ostream) {
+  uint32_t size = buffer.size();
+  const unsigned char header[4] = {
+      static_cast<unsigned char>(size >> 24),
+      static_cast<unsigned char>(size >> 16),
+      static_cast<unsigned char>(size >> 8),
+      static_cast<unsigned char>(size)};
+  ostream->write(reinterpret_cast<const char*>(header), sizeof(header));
+  ostream->write(buffer.data(), buffer.size());
+  CHECK(ostream->flush());
+}
+
 // Run a process_function callback that accepts a proto message and mutates
 // it in place. The proto message is decoded from the given istream, and
 // serialized to to the ostream.
@@ -49,22 +91,70 @@ void ProcessMessage(
   CHECK(output_message.SerializeToOstream(ostream));
 }
 
+// Run a process_function callback that accepts a proto message and mutates
+// it in place, over a stream of length-prefixed messages. Messages are
+// processed one at a time until the istream is closed, so that a single
+// process can serve many requests.
+template<typename Message>
+void ProcessMessageStreamInPlace(
+    std::function<void(Message*)> process_function,
+    std::istream* istream = &std::cin, std::ostream* ostream = &std::cout) {
+  std::string buffer;
+  while (ReadFrame(istream, &buffer)) {
+    Message message;
+    CHECK(message.ParseFromString(buffer));
+    process_function(&message);
+    CHECK(message.SerializeToString(&buffer));
+    WriteFrame(buffer, ostream);
+  }
+}
+
+// Run a process_function callback that accepts a proto message and writes
+// to an output proto message, over a stream of length-prefixed messages.
+// Messages are processed one at a time until the istream is closed, so that a
+// single process can serve many requests.
+template<typename InputMessage, typename OutputMessage>
+void ProcessMessageStream(
+    std::function<void(const InputMessage&, OutputMessage*)> process_function,
+    std::istream* istream = &std::cin, std::ostream* ostream = &std::cout) {
+  std::string buffer;
+  while (ReadFrame(istream, &buffer)) {
+    InputMessage input_message;
+    OutputMessage output_message;
+    CHECK(input_message.ParseFromString(buffer));
+    process_function(input_message, &output_message);
+    CHECK(output_message.SerializeToString(&buffer));
+    WriteFrame(buffer, ostream);
+  }
+}
+
 }  // namespace pbutil
 
 // A convenience macro to run an in-place process_function as the main()
-// function of a program.
+// function of a program. If the PBUTIL_STREAM environment variable is set to
+// "1", the program processes a stream of length-prefixed messages.
 #define PBUTIL_INPLACE_PROCESS_MAIN(process_function, message_type) \
   int main() { \
-    pbutil::ProcessMessageInPlace<message_type>(process_function); \
+    if (pbutil::IsStreamingProcess()) { \
+      pbutil::ProcessMessageStreamInPlace<message_type>(process_function); \
+    } else { \
+      pbutil::ProcessMessageInPlace<message_type>(process_function); \
+    } \
     return 0; \
   }
 
 // A convenience macro to run an process_function as the main() function of a
-// program.
+// program. If the PBUTIL_STREAM environment variable is set to "1", the program
+// processes a stream of length-prefixed messages.
 #define PBUTIL_PROCESS_MAIN( \
     process_function, input_message_type, output_message_type) \
   int main() { \
-    pbutil::ProcessMessage<input_message_type, output_message_type>( \
-      process_function); \
+    if (pbutil::IsStreamingProcess()) { \
+      pbutil::ProcessMessageStream<input_message_type, output_message_type>( \
+        process_function); \
+    } else { \
+      pbutil::ProcessMessage<input_message_type, output_message_type>( \
+        process_function); \
+    } \
     return 0; \
   }
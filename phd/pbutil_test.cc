@@ -77,6 +77,46 @@ TEST(ProcessMessage, AddXandY) {
   EXPECT_EQ(message.result(), 4);
 }
 
+TEST(ProcessMessageStream, AddXandY) {
+  std::stringstream istream;
+  std::stringstream ostream;
+
+  // Write two length-prefixed input messages.
+  for (int i = 0; i < 2; ++i) {
+    AddXandY message;
+    message.set_x(i);
+    message.set_y(2);
+    WriteFrame(message.SerializeAsString(), &istream);
+  }
+
+  ProcessMessageStream<AddXandY, AddXandY>(
+      [](const AddXandY& input, AddXandY* output) {
+        output->set_result(input.x() + input.y());
+      }, &istream, &ostream);
+
+  // Read the two length-prefixed output messages.
+  std::string buffer;
+  AddXandY message;
+  ASSERT_TRUE(ReadFrame(&ostream, &buffer));
+  ASSERT_TRUE(message.ParseFromString(buffer));
+  EXPECT_EQ(message.result(), 2);
+  ASSERT_TRUE(ReadFrame(&ostream, &buffer));
+  ASSERT_TRUE(message.ParseFromString(buffer));
+  EXPECT_EQ(message.result(), 3);
+  EXPECT_FALSE(ReadFrame(&ostream, &buffer));
+}
+
+TEST(ProcessMessageStreamInPlace, EmptyStream) {
+  std::stringstream istream;
+  std::stringstream ostream;
+
+  ProcessMessageStreamInPlace<AddXandY>([](AddXandY* message) {
+    message->set_x(5);
+  }, &istream, &ostream);
+
+  EXPECT_TRUE(ostream.str().empty());
+}
+
 void BM_ProcessMessageInPlace(benchmark::State& state) {
   std::stringstream istream;
   std::stringstream ostream;